@@ -0,0 +1,309 @@
+"""
+Benchmarks of the exchange client hot paths on fixed synthetic data.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import random
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime
+from types import SimpleNamespace
+
+from optibook.base_client import RawClient, STATE_CONNECTED
+from optibook.exchange_client import InfoClient, PositionAccountant
+from optibook.market_stats import MarketStats
+from optibook.journal import FillJournal
+from optibook.shared_risk import SharedRiskBook
+from optibook import greeks_calculator
+from optibook.greeks_calculator import GreeksEngine, OptionChain, SECONDS_PER_YEAR, black_scholes, implied_volatility
+from optibook.synchronous_client import Exchange
+from optibook.synchronous_wrapper import SynchronousWrapper
+from optibook.common_types import TradeTick
+from optibook.idl import common_capnp, info_capnp
+
+from harness import benchmark
+
+logging.getLogger('client').setLevel('ERROR')
+
+INSTRUMENTS = ['AIRBUS', 'ALLIANZ', 'ASML', 'LVMH', 'SAP', 'SIEMENS', 'TOTAL', 'UNILEVER']
+BOOK_DEPTH = 5
+NR_MESSAGES = 1000
+
+
+def _price_book_message(rng, instrument_id):
+    pb = info_capnp.PriceBook.new_message()
+    pb.instrumentId = instrument_id
+    mid = round(rng.uniform(50, 150), 1)
+    bids = pb.init('bids', BOOK_DEPTH)
+    asks = pb.init('asks', BOOK_DEPTH)
+    for i in range(BOOK_DEPTH):
+        bids[i].price = round(mid - 0.1 * (i + 1), 1)
+        bids[i].volume = rng.randint(1, 200)
+        asks[i].price = round(mid + 0.1 * (i + 1), 1)
+        asks[i].volume = rng.randint(1, 200)
+    return pb
+
+
+def _trade_tick_message(rng, instrument_id):
+    tt = common_capnp.TradeTick.new_message()
+    tt.tradeId = rng.randint(0, 1 << 32)
+    tt.timestamp = 1597750000 * 1000000000 + rng.randint(0, 10 ** 12)
+    tt.instrumentId = instrument_id
+    tt.price = round(rng.uniform(50, 150), 1)
+    tt.volume = rng.randint(1, 100)
+    tt.aggressorSide = 'bid' if rng.random() < 0.5 else 'ask'
+    tt.buyer = 'buyer'
+    tt.seller = 'seller'
+    return tt
+
+
+def _price_books(n=NR_MESSAGES, seed=1):
+    rng = random.Random(seed)
+    return [_price_book_message(rng, INSTRUMENTS[i % len(INSTRUMENTS)]).as_reader() for i in range(n)]
+
+
+def _trade_ticks(n=NR_MESSAGES, seed=2):
+    rng = random.Random(seed)
+    return [_trade_tick_message(rng, INSTRUMENTS[i % len(INSTRUMENTS)]).as_reader() for i in range(n)]
+
+
+class _OpenTransport:
+    def is_closing(self):
+        return False
+
+
+class _FramingClient(RawClient):
+    async def _on_message(self, msg):
+        pass
+
+
+@benchmark('raw_client_read_1000_price_books', number=20)
+def bench_raw_client_read():
+    rng = random.Random(3)
+    buf = b''
+    for i in range(NR_MESSAGES):
+        raw = common_capnp.RawMessage.new_message()
+        raw.type = info_capnp.PriceBook.schema.node.id
+        raw.msg = _price_book_message(rng, INSTRUMENTS[i % len(INSTRUMENTS)])
+        buf += raw.to_bytes()
+
+    loop = asyncio.new_event_loop()
+    client = _FramingClient('localhost', 0)
+
+    async def read_all():
+        client._reader = asyncio.StreamReader()
+        client._reader.feed_data(buf)
+        client._reader.feed_eof()
+        client._writer = SimpleNamespace(transport=_OpenTransport())
+        try:
+            await client._read()
+        except asyncio.IncompleteReadError:
+            # end of the synthetic stream
+            pass
+
+    return lambda: loop.run_until_complete(read_all())
+
+
+@benchmark('info_on_price_book', number=20000)
+def bench_on_price_book():
+    client = InfoClient('localhost', 0)
+    messages = itertools.cycle(_price_books())
+    return lambda: client.onPriceBook(next(messages))
+
+
+@benchmark('info_on_trade_tick', number=20000)
+def bench_on_trade_tick():
+    client = InfoClient('localhost', 0)
+    messages = itertools.cycle(_trade_ticks())
+    return lambda: client.onTradeTick(next(messages))
+
+
+@benchmark('info_on_price_book_market_stats', number=20000)
+def bench_on_price_book_market_stats():
+    client = InfoClient('localhost', 0, market_stats=MarketStats())
+    messages = itertools.cycle(_price_books())
+    return lambda: client.onPriceBook(next(messages))
+
+
+@benchmark('info_on_trade_tick_market_stats', number=20000)
+def bench_on_trade_tick_market_stats():
+    client = InfoClient('localhost', 0, market_stats=MarketStats())
+    messages = itertools.cycle(_trade_ticks())
+    return lambda: client.onTradeTick(next(messages))
+
+
+@benchmark('info_poll_new_trade_ticks_100k_history', number=2000)
+def bench_poll_new_trade_ticks():
+    history_size = 100000
+    client = InfoClient('localhost', 0, max_nr_trade_history=history_size)
+    rng = random.Random(4)
+    client._trade_tick_history['SAP'] = deque(
+        TradeTick(timestamp=datetime(2020, 8, 18), instrument_id='SAP', price=rng.uniform(50, 150), volume=rng.randint(1, 100))
+        for _ in range(history_size))
+
+    def poll():
+        # 10 new ticks since the last poll, at the end of a long history
+        client._trade_tick_history_last_polled_index['SAP'] = history_size - 10
+        client.poll_new_trade_ticks('SAP')
+    return poll
+
+
+def _trades(n=NR_MESSAGES, seed=5):
+    rng = random.Random(seed)
+    return [SimpleNamespace(instrumentId=INSTRUMENTS[i % len(INSTRUMENTS)], side='bid' if rng.random() < 0.5 else 'ask',
+                            volume=rng.randint(1, 50), price=round(rng.uniform(50, 150), 1))
+            for i in range(n)]
+
+
+@benchmark('position_accountant_handle_trade', number=50000)
+def bench_handle_trade():
+    accountant = PositionAccountant(positions=[])
+    trades = itertools.cycle(_trades())
+    return lambda: accountant.handle_trade(next(trades))
+
+
+def _journaled_trades(n=NR_MESSAGES, seed=7):
+    return [SimpleNamespace(tradeId=i, timestamp=i * 1000000, orderId=i // 3, **vars(t)) for i, t in enumerate(_trades(n, seed))]
+
+
+@benchmark('fill_journal_record_trade', number=50000)
+def bench_journal_record_trade():
+    # The cost on the exec callback, the writes happen on the journal thread
+    journal = FillJournal(os.path.join(tempfile.mkdtemp(), 'journal.db'))
+    trades = itertools.cycle(_journaled_trades())
+    return lambda: journal.record_trade(next(trades))
+
+
+@benchmark('fill_journal_query_time_range_100k_fills', number=500)
+def bench_journal_query():
+    journal = FillJournal(os.path.join(tempfile.mkdtemp(), 'journal.db'))
+    trades = _journaled_trades(100000)
+    for t in trades:
+        journal.record_trade(t)
+    journal.flush()
+    # 1% of the session for one instrument
+    return lambda: journal.get_fills(instrument_id='SAP', start=50000 * 1000000, end=51000 * 1000000)
+
+
+@benchmark('shared_risk_reserve_and_release', number=20000)
+def bench_shared_risk():
+    name = f"optibook-bench-{os.getpid()}"
+    created = SharedRiskBook.create(name, INSTRUMENTS, max_position=500)
+    book = SharedRiskBook.attach(name)
+    # Still mapped and locked through the open handles, closing book afterwards leaves nothing behind
+    created.remove()
+    index = book.get_index(INSTRUMENTS[0])
+
+    def reserve_and_release():
+        book.reserve(index, 10, 'bid')
+        book.set_outstanding(index, 0, 0)
+    return reserve_and_release, book.close
+
+
+@benchmark('exchange_get_last_price_book', number=50000)
+def bench_get_last_price_book():
+    # The connection check in front of every Exchange call and the lookup, as in the trading loop
+    exchange = Exchange(host='localhost')
+    exchange._wrapper._state = STATE_CONNECTED
+    for pb in _price_books(len(INSTRUMENTS)):
+        exchange._i.onPriceBook(pb)
+    return lambda: exchange.get_last_price_book('SAP')
+
+
+@benchmark('exchange_get_pnl', number=20000)
+def bench_get_pnl():
+    exchange = Exchange(host='localhost')
+    # get_pnl only reads local state, skip the connection check instead of connecting
+    exchange._wrapper.is_connected = lambda: True
+    rng = random.Random(6)
+    exchange._e._position_accountant = PositionAccountant(positions=[
+        SimpleNamespace(instrumentId=instrument_id, position=rng.randint(-100, 100), cash=rng.uniform(-1e4, 1e4))
+        for instrument_id in INSTRUMENTS])
+    for tt in _trade_ticks(800):
+        exchange._i.onTradeTick(tt)
+    return exchange.get_pnl
+
+
+@benchmark('synchronous_wrapper_run_on_loop', number=5000)
+def bench_run_on_loop():
+    wrapper = SynchronousWrapper([])
+    thread = threading.Thread(target=wrapper.get_loop().run_forever, daemon=True)
+    thread.start()
+
+    async def noop():
+        return None
+
+    return lambda: wrapper.run_on_loop(noop())
+
+
+def _option_chain(n=500, seed=8):
+    rng = random.Random(seed)
+    now = 1597750000.0
+    chain = OptionChain([f"OPT{i}" for i in range(n)], [rng.uniform(60, 140) for _ in range(n)],
+                        [now + rng.uniform(0.01, 2) * SECONDS_PER_YEAR for _ in range(n)], [rng.random() < 0.5 for _ in range(n)])
+    return chain, now
+
+
+@benchmark('greeks_engine_500_options_new_spot', number=1000)
+def bench_greeks_engine():
+    chain, now = _option_chain()
+    engine = GreeksEngine(chain, volatilities=0.3)
+    spots = itertools.cycle([100 + 0.01 * i for i in range(10000)])
+    return lambda: engine.greeks(next(spots), now)
+
+
+@benchmark('black_scholes_scalar_without_scipy', number=5000)
+def bench_black_scholes_scalar_without_scipy():
+    # The math.erf fallback on a single option, as a notebook without scipy would price one
+    ndtr = greeks_calculator._ndtr
+    greeks_calculator._ndtr = None
+
+    def restore():
+        greeks_calculator._ndtr = ndtr
+    return lambda: black_scholes(100.0, 100.0, 0.5, 0.2, 0.01, True), restore
+
+
+@benchmark('implied_volatility_500_options', number=100)
+def bench_implied_volatility():
+    chain, now = _option_chain()
+    rng = random.Random(9)
+    time_to_expiry = (chain.expiries - now) / SECONDS_PER_YEAR
+    prices = black_scholes(100.0, chain.strikes, time_to_expiry, [rng.uniform(0.05, 1.0) for _ in range(len(chain))], 0.0, chain.is_call)['price']
+    return lambda: implied_volatility(prices, 100.0, chain.strikes, time_to_expiry, 0.0, chain.is_call)
+
+
+def _raw_messages(nr_instruments, n=NR_MESSAGES, seed=9):
+    # Price books of an exchange listing many more instruments than the strategy trades
+    rng = random.Random(seed)
+    instrument_ids = INSTRUMENTS + [f"OTHER{i}" for i in range(nr_instruments - len(INSTRUMENTS))]
+    messages = []
+    for i in range(n):
+        raw = common_capnp.RawMessage.new_message()
+        raw.type = info_capnp.PriceBook.schema.node.id
+        raw.msg = _price_book_message(rng, instrument_ids[rng.randrange(nr_instruments)])
+        messages.append(raw.as_reader())
+    return messages
+
+
+def _dispatch(client, messages):
+    def f():
+        try:
+            client._on_message(next(messages)).send(None)
+        except StopIteration:
+            pass
+    return f
+
+
+@benchmark('info_on_message_64_instruments', number=20000)
+def bench_on_message_all_instruments():
+    client = InfoClient('localhost', 0)
+    return _dispatch(client, itertools.cycle(_raw_messages(64)))
+
+
+@benchmark('info_on_message_64_instruments_8_of_interest', number=20000)
+def bench_on_message_instrument_interest():
+    client = InfoClient('localhost', 0, instrument_ids=INSTRUMENTS)
+    return _dispatch(client, itertools.cycle(_raw_messages(64)))
@@ -0,0 +1,132 @@
+"""
+Iterations per second of Pair_Trader.single_loop_iteration against an in-memory exchange.
+
+Run from the repository root with the optibook package installed:
+
+    python benchmarks/bench_pair_trader.py
+
+The book tops move with a fixed probability per iteration, so both the unchanged-book fast path and the
+recalculation path are exercised. All randomness is seeded, every run sees the same books.
+"""
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+from math import log
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+
+from autotrader import Pair_Trader
+from optibook.common_types import PriceBook, PriceVolume
+
+from harness import benchmark
+
+logging.getLogger('client').setLevel('ERROR')
+
+STOCK_Y = 'Y'
+STOCK_X = 'X'
+NR_ITERATIONS = 200000
+NR_BOOKS = 256
+
+
+def synthetic_log_stock_values(nr_points=2000, seed=1):
+    rng = random.Random(seed)
+    x = [log(100.0)]
+    for _ in range(nr_points - 1):
+        x.append(x[-1] + rng.gauss(0, 0.001))
+    y = [0.3 + 0.9 * v + rng.gauss(0, 0.0005) for v in x]
+    return {STOCK_Y: y, STOCK_X: x}
+
+
+def synthetic_books(instrument_id, mid, nr_books, seed):
+    rng = random.Random(seed)
+    books = []
+    for _ in range(nr_books):
+        m = round(mid + rng.uniform(-0.5, 0.5), 1)
+        books.append(PriceBook(instrument_id=instrument_id,
+                               bids=[PriceVolume(round(m - 0.1, 1), rng.randint(1, 50))],
+                               asks=[PriceVolume(round(m + 0.1, 1), rng.randint(1, 50))]))
+    return books
+
+
+class FakeAutotrader:
+    def __init__(self, books_by_instrument):
+        self.books = {instrument_id: books[0] for instrument_id, books in books_by_instrument.items()}
+
+    def get_order_book(self, order_book_id):
+        return self.books[order_book_id]
+
+    def get_position(self, order_book_id):
+        return 0
+
+    def insert_order(self, order_book_id, price, volume, side, order_type):
+        return 0
+
+    def amend_order(self, order_book_id, order_id, volume):
+        return True
+
+    def delete_order(self, order_book_id, order_id):
+        return True
+
+    def get_outstanding_order(self, order_id):
+        return None
+
+    def is_order_done(self, order_id):
+        return True
+
+    def delete_all_orders(self, order_book_id):
+        pass
+
+
+def setup_loop(book_change_probability, nr_iterations=NR_ITERATIONS):
+    """
+    Returns a function that moves a book top with the given probability and then runs one loop iteration.
+    """
+    random.seed(0)
+    log_stock_values = synthetic_log_stock_values()
+    books_by_instrument = {
+        STOCK_X: synthetic_books(STOCK_X, 100.0, NR_BOOKS, seed=2),
+        STOCK_Y: synthetic_books(STOCK_Y, 85.0, NR_BOOKS, seed=3),
+    }
+    at = FakeAutotrader(books_by_instrument)
+    trader = Pair_Trader(at, STOCK_Y, STOCK_X, log_stock_values, 0.1, 300, "limit")
+    trader.get_initial_data()
+
+    rng = random.Random(4)
+    changes = [rng.random() < book_change_probability for _ in range(nr_iterations)]
+    indices = [rng.randrange(NR_BOOKS) for _ in range(nr_iterations)]
+    counter = itertools.count()
+
+    def step():
+        i = next(counter) % nr_iterations
+        if changes[i]:
+            instrument_id = STOCK_X if i % 2 else STOCK_Y
+            at.books[instrument_id] = books_by_instrument[instrument_id][indices[i]]
+        trader.single_loop_iteration()
+    return step
+
+
+@benchmark('pair_trader_single_loop_iteration_static_book', number=50000)
+def bench_loop_static_book():
+    return setup_loop(0.0)
+
+
+@benchmark('pair_trader_single_loop_iteration_moving_book', number=50000)
+def bench_loop_moving_book():
+    return setup_loop(0.1)
+
+
+def run(book_change_probability, nr_iterations=NR_ITERATIONS):
+    step = setup_loop(book_change_probability, nr_iterations)
+    start = time.perf_counter()
+    for _ in range(nr_iterations):
+        step()
+    elapsed = time.perf_counter() - start
+    return nr_iterations / elapsed
+
+
+if __name__ == '__main__':
+    for p in [0.0, 0.01, 0.1, 1.0]:
+        print(f"book change probability {p:5.2f}: {run(p):12.0f} iterations/s")
@@ -0,0 +1,168 @@
+"""
+Latency distribution and GC pauses with and without the low latency RuntimeProfile.
+
+Run from the repository root with the optibook package installed:
+
+    python benchmarks/bench_runtime.py
+
+Wakeup latency is measured on the IO loop for two paths: a socket becoming readable (like a message from the exchange)
+and run_on_loop() from the strategy thread (like an order). Busy polling needs a CPU of its own for the IO thread, on
+a single core machine it competes with the thread that measures it.
+
+GC pauses are measured with gc.callbacks while processing price books against a long lived heap that is about the
+size of a client that has been trading for a while.
+"""
+import gc
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from optibook.common_types import PriceBook, PriceVolume, TradeTick
+from optibook.runtime import RuntimeProfile
+from optibook.synchronous_wrapper import SynchronousWrapper
+
+logging.getLogger('client').setLevel('ERROR')
+
+NR_WAKEUPS = 20000
+NR_BOOKS = 300000
+LONG_LIVED_OBJECTS = 300000
+
+
+def _percentiles(values):
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'p50': pick(0.5), 'p99': pick(0.99), 'p99.9': pick(0.999), 'max': values[-1]}
+
+
+def _print(name, stats, unit='us', scale=1e-3):
+    print(f"{name:40} " + "  ".join(f"{k} {v * scale:9.1f}{unit}" for k, v in stats.items()))
+
+
+def _start_wrapper(runtime):
+    wrapper = SynchronousWrapper([], runtime=runtime)
+    loop = wrapper.get_loop()
+
+    def run():
+        if runtime is not None:
+            runtime.on_io_thread_start(loop)
+        loop.run_forever()
+    threading.Thread(target=run, name='optibook-loop', daemon=True).start()
+    while not loop.is_running():
+        time.sleep(0.01)
+    return wrapper, loop
+
+
+def _stop_wrapper(loop):
+    loop.call_soon_threadsafe(loop.stop)
+    while loop.is_running():
+        time.sleep(0.01)
+
+
+def bench_wakeups(name, runtime):
+    wrapper, loop = _start_wrapper(runtime)
+
+    async def noop():
+        return None
+
+    round_trips = []
+    for _ in range(NR_WAKEUPS):
+        start = time.perf_counter_ns()
+        wrapper.run_on_loop(noop())
+        round_trips.append(time.perf_counter_ns() - start)
+
+    reader, writer = socket.socketpair()
+    reader.setblocking(False)
+    received = threading.Event()
+    latencies = []
+
+    def on_readable():
+        data = reader.recv(8)
+        latencies.append(time.perf_counter_ns() - int.from_bytes(data, 'little'))
+        received.set()
+    loop.call_soon_threadsafe(loop.add_reader, reader.fileno(), on_readable)
+    time.sleep(0.1)
+    for _ in range(NR_WAKEUPS):
+        received.clear()
+        writer.send(time.perf_counter_ns().to_bytes(8, 'little'))
+        received.wait()
+    loop.call_soon_threadsafe(loop.remove_reader, reader.fileno())
+    _stop_wrapper(loop)
+    reader.close()
+    writer.close()
+
+    _print(f"{name} run_on_loop round trip", _percentiles(round_trips))
+    _print(f"{name} socket to callback", _percentiles(latencies))
+
+
+def _long_lived_heap():
+    # Trade history, books and order state of a session, all reachable for the lifetime of the process
+    return [TradeTick(instrument_id='SAP', price=100.0 + i % 100, volume=i % 50) for i in range(LONG_LIVED_OBJECTS)]
+
+
+def bench_gc(name, runtime):
+    thresholds = gc.get_threshold()
+    heap = _long_lived_heap()
+    if runtime is not None:
+        runtime.new_event_loop().close()
+        runtime.on_strategy_ready()
+
+    pauses = []
+    started = [0]
+
+    def on_gc(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter_ns()
+        else:
+            pauses.append(time.perf_counter_ns() - started[0])
+    gc.callbacks.append(on_gc)
+
+    last_books = {}
+    history = []
+    iterations = []
+    for i in range(NR_BOOKS):
+        start = time.perf_counter_ns()
+        mid = 100 + (i % 17) * 0.1
+        pb = PriceBook(instrument_id=f"I{i % 8}", bids=[PriceVolume(mid - 0.1 * k, 10) for k in range(1, 6)],
+                       asks=[PriceVolume(mid + 0.1 * k, 10) for k in range(1, 6)])
+        # Consecutive books reference each other, so replaced books are cyclic garbage only the collector frees
+        previous = last_books.get(pb.instrument_id)
+        if previous is not None:
+            pb.previous = previous
+            previous.next = pb
+            previous.previous = None
+        last_books[pb.instrument_id] = pb
+        if i % 4 == 0:
+            history.append(TradeTick(instrument_id=pb.instrument_id, price=mid, volume=1))
+        iterations.append(time.perf_counter_ns() - start)
+
+    gc.callbacks.remove(on_gc)
+    gc.unfreeze()
+    gc.set_threshold(*thresholds)
+    del heap
+
+    print(f"{name:40} {len(pauses)} collections, total {sum(pauses) / 1e6:.1f}ms")
+    if pauses:
+        _print(f"{name} GC pause", _percentiles(pauses))
+    _print(f"{name} book processing", _percentiles(iterations))
+
+
+if __name__ == '__main__':
+    print(f"{os.cpu_count()} CPUs, python {sys.version.split()[0]}")
+    try:
+        import uvloop
+        have_uvloop = True
+    except ImportError:
+        have_uvloop = False
+        print("uvloop not installed, skipping the uvloop runs")
+
+    bench_wakeups('default', None)
+    if have_uvloop:
+        bench_wakeups('uvloop', RuntimeProfile(gc_thresholds=None, freeze_gc=False))
+    bench_wakeups('busy poll', RuntimeProfile(use_uvloop=False, gc_thresholds=None, freeze_gc=False, busy_poll=True))
+
+    print()
+    bench_gc('default gc', None)
+    bench_gc('tuned gc + freeze', RuntimeProfile(use_uvloop=False))
@@ -0,0 +1,117 @@
+"""
+Benchmarks of the strategy side on fixed synthetic data.
+"""
+import random
+from math import log
+
+from autotrader import CreditCache
+from basket_hedger import BasketHedger
+from cointegration_analysis import estimate_long_run_short_run_relationships
+from optibook.common_types import PriceBook, PriceVolume
+from signal_engine import PairSignalEngine, sweep_depth
+
+from bench_pair_trader import synthetic_log_stock_values, STOCK_X, STOCK_Y
+from harness import benchmark
+
+
+@benchmark('estimate_long_run_short_run_relationships_2000', number=20)
+def bench_estimate_relationships():
+    log_stock_values = synthetic_log_stock_values(nr_points=2000)
+    y = log_stock_values[STOCK_Y]
+    x = log_stock_values[STOCK_X]
+    return lambda: estimate_long_run_short_run_relationships(y, x)
+
+
+def _synthetic_basket(nr_substitutes=6, nr_points=2000, seed=7):
+    # Y and all substitutes follow one common factor plus their own noise
+    rng = random.Random(seed)
+    factor = [0.0]
+    for _ in range(nr_points - 1):
+        factor.append(factor[-1] + rng.gauss(0, 0.001))
+    instruments = [f"S{i}" for i in range(nr_substitutes)]
+    log_stock_values = {STOCK_Y: [log(85.0) + 0.9 * f + rng.gauss(0, 0.0005) for f in factor]}
+    for i, instrument_id in enumerate(instruments):
+        beta = rng.uniform(0.5, 1.5)
+        log_stock_values[instrument_id] = [log(50.0 + 10 * i) + beta * f + rng.gauss(0, 0.0005 * (i + 1)) for f in factor]
+    books = [PriceBook(instrument_id=instrument_id, bids=[PriceVolume(49.9 + 10 * i, rng.randint(1, 50))],
+                       asks=[PriceVolume(50.1 + 10 * i, rng.randint(1, 50))]) for i, instrument_id in enumerate(instruments)]
+    return instruments, log_stock_values, books
+
+
+@benchmark('basket_hedger_solve_6_substitutes', number=5000)
+def bench_basket_solve():
+    instruments, log_stock_values, books = _synthetic_basket()
+    basket = BasketHedger(STOCK_Y, instruments, log_stock_values, min_r_squared=0.0)
+    return lambda: basket.solve(-120, 85.0, books)
+
+
+def _synthetic_pairs(nr_instruments=40, nr_pairs=200, seed=11):
+    rng = random.Random(seed)
+    instruments = [f"S{i}" for i in range(nr_instruments)]
+    books = {}
+    for instrument_id in instruments:
+        m = round(rng.uniform(20, 200), 1)
+        books[instrument_id] = PriceBook(instrument_id=instrument_id, bids=[PriceVolume(round(m - 0.1, 1), rng.randint(1, 50))],
+                                         asks=[PriceVolume(round(m + 0.1, 1), rng.randint(1, 50))])
+    pairs = []
+    for _ in range(nr_pairs):
+        y, x = rng.sample(instruments, 2)
+        gamma = rng.uniform(0.8, 1.2)
+        # Fair value of Y close to its mid, so credits hover around zero like in the market
+        c = log(books[y].bids[0].price + 0.1) - gamma * log(books[x].bids[0].price + 0.1) + rng.gauss(0, 0.001)
+        pairs.append((y, x, c, gamma))
+    return books, pairs
+
+
+def _shifted(book, shift):
+    return PriceBook(instrument_id=book.instrument_id, bids=[PriceVolume(round(book.bids[0].price + shift, 1), book.bids[0].volume)],
+                     asks=[PriceVolume(round(book.asks[0].price + shift, 1), book.asks[0].volume)])
+
+
+@benchmark('signal_engine_refresh_200_pairs', number=2000)
+def bench_signal_engine_refresh():
+    books, pairs = _synthetic_pairs()
+    engine = PairSignalEngine(books.get)
+    for y, x, c, gamma in pairs:
+        engine.add_pair(y, x, c, gamma, 0.1)
+    # One instrument moves per call, so every refresh recomputes
+    moves = [(instrument_id, _shifted(book, 0.1), book) for instrument_id, book in books.items()]
+    step = iter(range(1 << 62))
+
+    def f():
+        instrument_id, moved, book = moves[next(step) % len(moves)]
+        books[instrument_id] = moved if books[instrument_id] is book else book
+        engine.refresh()
+    return f
+
+
+@benchmark('scalar_credits_200_pairs', number=2000)
+def bench_scalar_credits():
+    books, pairs = _synthetic_pairs()
+    caches = [(y, x, CreditCache(c, gamma, "bid"), CreditCache(c, gamma, "ask")) for y, x, c, gamma in pairs]
+    moves = [(instrument_id, _shifted(book, 0.1), book) for instrument_id, book in books.items()]
+    step = iter(range(1 << 62))
+
+    def f():
+        instrument_id, moved, book = moves[next(step) % len(moves)]
+        books[instrument_id] = moved if books[instrument_id] is book else book
+        # What the pairs compute between them without the engine, every pair reads its own two books
+        for y, x, bid_credit, ask_credit in caches:
+            book_x = books[x]
+            book_y = books[y]
+            if bid_credit.credit(book_x.asks[0].price, book_y.bids[0].price) > 0.1:
+                pass
+            if ask_credit.credit(book_x.bids[0].price, book_y.asks[0].price) > 0.1:
+                pass
+    return f
+
+
+@benchmark('sweep_depth_5_levels', number=20000)
+def bench_sweep_depth():
+    rng = random.Random(12)
+    gamma = 0.95
+    # Thin top levels with the credit running out a few levels deep
+    asks_x = [PriceVolume(round(100.1 + 0.1 * i, 1), rng.randint(1, 5)) for i in range(5)]
+    bids_y = [PriceVolume(round(85.0 - 0.1 * i, 1), rng.randint(1, 5)) for i in range(5)]
+    c = log(84.5) - gamma * log(100.0)
+    return lambda: sweep_depth(c, gamma, asks_x, bids_y, "bid", 0.1)
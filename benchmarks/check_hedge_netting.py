@@ -0,0 +1,218 @@
+"""
+Checks allocate_netted_fill() and the hedge netting of pairs that hedge on the same instrument.
+
+Run from the repository root with the optibook package installed:
+
+    python benchmarks/check_hedge_netting.py                     # edge cases, 100000 random fills, 20000 cycles
+    python benchmarks/check_hedge_netting.py --cycles 200000 --seed 7
+
+allocate_netted_fill() is run on edge cases with known allocations: a net of 0 that is only crossed internally,
+no fill, a partial fill, a full fill, rounding left overs and pairs without a hedge. Then on random deltas and fills,
+where the allocations must add up to the fill, every hedge against the net direction gets its full delta and every
+other hedge gets its pro rata share of what was crossed plus the fill, rounded down or up.
+
+Then two pairs hedging on the same Y trade against an in-memory exchange for --cycles cycles with
+Autotrader(hedge_netting=True)'s HedgeNetter. The books move at random every cycle and IOCs fill a random part of
+every level they reach. After every cycle the internal positions of the pairs must add up to the account position
+in every instrument. Exits with code 1 on any mismatch.
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+
+from autotrader import Pair_Trader
+from hedge_netter import HedgeNetter, allocate_netted_fill
+from optibook.common_types import PriceBook, PriceVolume
+
+logging.getLogger('client').setLevel('CRITICAL')
+
+STOCK_Y = 'Y'
+STOCK_X1 = 'X1'
+STOCK_X2 = 'X2'
+BOOK_DEPTH = 3
+
+
+def edge_cases():
+    """
+    Returns (name, deltas, filled, expected allocations).
+    """
+    return [
+        ('net 0, only crossed', [5, -5], 0, [5, -5]),
+        ('net 0 with a pair without hedge', [3, 0, -3], 0, [3, 0, -3]),
+        ('no fill, nothing crossed', [4, 6], 0, [0, 0]),
+        ('no fill, the crossed part is shared', [10, -4], 0, [4, -4]),
+        ('partial fill', [10, -4], 3, [7, -4]),
+        ('full fill', [10, -4], 6, [10, -4]),
+        ('single pair, partial fill', [-7], -3, [-3]),
+        ('left over share goes to the largest remainder', [-6, -2, 3], -2, [-4, -1, 3]),
+        ('left over shares of equal remainders', [1, 1, 1], 2, [1, 1, 0]),
+    ]
+
+
+def check_allocation(deltas, filled):
+    """
+    Returns what is wrong with the allocation of filled over deltas, None if nothing.
+    """
+    allocations = allocate_netted_fill(deltas, filled)
+    if sum(allocations) != filled:
+        return f"allocations {allocations} add up to {sum(allocations)}, not the fill"
+    net = sum(deltas)
+    if net == 0:
+        return None if allocations == deltas else f"net 0 but allocations {allocations}"
+    sign = 1 if net > 0 else -1
+    wanted = sum(abs(delta) for delta in deltas if delta * sign > 0)
+    obtained = wanted - abs(net) + abs(filled)
+    for delta, allocation in zip(deltas, allocations):
+        if delta * sign <= 0:
+            if allocation != delta:
+                return f"hedge {delta} against the net direction got {allocation}"
+            continue
+        share = abs(delta) * obtained / wanted
+        if allocation * sign < 0 or not math.floor(share) <= abs(allocation) <= math.ceil(share):
+            return f"hedge {delta} got {allocation}, its pro rata share is {share:.2f}"
+    return None
+
+
+def random_fill(rng):
+    deltas = [rng.randint(-30, 30) if rng.random() < 0.8 else 0 for _ in range(rng.randint(1, 5))]
+    net = sum(deltas)
+    filled = int(math.copysign(rng.randint(0, abs(net)), net)) if rng.random() < 0.7 else net
+    return deltas, filled
+
+
+class InMemoryAutotrader:
+    """
+    Stands in for the Autotrader. IOCs take a random part of every level they reach, positions change before
+    insert_order returns.
+    """
+    def __init__(self, rng, fair_prices):
+        self._rng = rng
+        self._fair_prices = fair_prices
+        self.positions = defaultdict(int)
+        self.books = {}
+        self.nr_orders = 0
+        self.move()
+
+    def move(self):
+        for instrument_id, fair_price in self._fair_prices.items():
+            mid = fair_price * math.exp(self._rng.gauss(0, 0.004))
+            bid = math.floor(mid * 10) / 10
+            self.books[instrument_id] = PriceBook(
+                instrument_id=instrument_id,
+                bids=[PriceVolume(round(bid - 0.1 * i, 1), self._rng.randint(1, 40)) for i in range(BOOK_DEPTH)],
+                asks=[PriceVolume(round(bid + 0.1 * (i + 1), 1), self._rng.randint(1, 40)) for i in range(BOOK_DEPTH)])
+
+    def get_order_book(self, order_book_id):
+        return self.books[order_book_id]
+
+    def get_position(self, order_book_id):
+        return self.positions[order_book_id]
+
+    def insert_order(self, order_book_id, price, volume, side, order_type):
+        assert order_type == 'ioc', "Netted pairs only send IOCs"
+        book = self.books[order_book_id]
+        filled = 0
+        for level in (book.asks if side == 'bid' else book.bids):
+            if (side == 'bid' and level.price > price) or (side == 'ask' and level.price < price):
+                break
+            filled += min(volume - filled, self._rng.randint(0, level.volume))
+        self.positions[order_book_id] += filled if side == 'bid' else -filled
+        self.nr_orders += 1
+        return self.nr_orders
+
+
+def synthetic_log_stock_values(rng, nr_points=2000):
+    x1 = [math.log(100.0)]
+    for _ in range(nr_points - 1):
+        x1.append(x1[-1] + rng.gauss(0, 0.001))
+    x2 = [0.1 + v + rng.gauss(0, 0.0005) for v in x1]
+    y = [0.3 + 0.9 * v + rng.gauss(0, 0.0005) for v in x1]
+    return {STOCK_Y: y, STOCK_X1: x1, STOCK_X2: x2}
+
+
+def run_cycles(nr_cycles, seed):
+    """
+    Returns the mismatches, the number of pair hedges, the number of net orders and the cycles with crossed hedges.
+    """
+    rng = random.Random(seed)
+    # The pairs draw their sanity check intervals from the module level generator
+    random.seed(seed)
+    log_stock_values = synthetic_log_stock_values(rng)
+    at = InMemoryAutotrader(rng, {instrument_id: math.exp(values[-1]) for instrument_id, values in log_stock_values.items()})
+    pairs = [Pair_Trader(at, STOCK_Y, STOCK_X1, log_stock_values, 0.05, 300, "ioc"),
+             Pair_Trader(at, STOCK_Y, STOCK_X2, log_stock_values, 0.05, 300, "ioc")]
+    netter = HedgeNetter(at)
+    for pair in pairs:
+        pair.share_positions_with([p for p in pairs if p is not pair])
+        pair.use_hedge_netting(netter)
+        pair.get_initial_data()
+
+    mismatches = []
+    nr_crossed = 0
+    for cycle in range(nr_cycles):
+        at.move()
+        try:
+            for pair in pairs:
+                pair.single_loop_iteration()
+        except SystemExit:
+            # A pair found its internal positions off from the account in its sanity check
+            mismatches.append(f"cycle {cycle}: a pair failed its sanity check")
+            break
+        missing = [pair.get_missing_hedge() for pair in pairs]
+        if min(missing) < 0 < max(missing):
+            nr_crossed += 1
+        netter.run()
+        internal = defaultdict(int)
+        for pair in pairs:
+            for instrument_id in (pair.stock_x_id, pair.stock_y_id):
+                internal[instrument_id] += pair.get_internal_position(instrument_id)
+        for instrument_id, position in internal.items():
+            if position != at.positions[instrument_id]:
+                mismatches.append(f"cycle {cycle}: pairs hold {position} {instrument_id}, the account {at.positions[instrument_id]}")
+    return mismatches, netter.nr_hedges, netter.nr_orders, nr_crossed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check allocate_netted_fill() and netted hedging against an in-memory exchange')
+    parser.add_argument('--nr-fills', type=int, default=100000, help='Random fills to allocate')
+    parser.add_argument('--cycles', type=int, default=20000, help='Cycles of the two pairs against the in-memory exchange')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    failures = 0
+    for name, deltas, filled, expected in edge_cases():
+        allocations = allocate_netted_fill(deltas, filled)
+        problem = check_allocation(deltas, filled)
+        if allocations != expected or problem:
+            failures += 1
+            print(f"FAIL {name}: {deltas} filled {filled} allocated {allocations}, expected {expected}. {problem or ''}")
+
+    rng = random.Random(args.seed)
+    for _ in range(args.nr_fills):
+        deltas, filled = random_fill(rng)
+        problem = check_allocation(deltas, filled)
+        if problem:
+            failures += 1
+            print(f"FAIL {deltas} filled {filled}: {problem}")
+
+    mismatches, nr_hedges, nr_orders, nr_crossed = run_cycles(args.cycles, args.seed)
+    for mismatch in mismatches[:20]:
+        print(f"FAIL {mismatch}")
+    failures += len(mismatches)
+
+    if failures:
+        print(f"{failures} checks failed")
+        sys.exit(1)
+    print(f"OK, {len(edge_cases())} edge cases and {args.nr_fills} random fills allocated correctly. Over {args.cycles} cycles "
+          f"the pair positions always added up to the account, {nr_hedges} pair hedges went out as {nr_orders} orders, "
+          f"{nr_crossed} cycles had hedges in opposite directions")
+
+
+if __name__ == '__main__':
+    main()
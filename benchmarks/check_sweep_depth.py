@@ -0,0 +1,142 @@
+"""
+Checks sweep_depth() against a lot by lot walk through both books.
+
+Run from the repository root:
+
+    python benchmarks/check_sweep_depth.py                       # the edge cases and 5000 random books
+    python benchmarks/check_sweep_depth.py --nr-books 100000 --seed 7
+
+The walk takes one lot of X at a time, at the first X level that still has volume for it, hedged at the first Y level
+whose volume, truncated to whole lots of X, covers it. It stops at the first lot whose credit is not above the
+threshold. sweep_depth() must return the same volume and the same deepest X and Y prices. The edge cases are run
+first: a first Y level too thin to hedge a single lot, X and Y depths that break at the same volumes, nothing or
+everything profitable and a Y book that can't hedge anything at all. The random books are for both sides of X, with
+thresholds around the top of book credit so that the trades end at every depth.
+
+Only needs NumPy. Exits with code 1 if any book disagrees.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+from collections import namedtuple
+from itertools import accumulate, count
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+
+from signal_engine import sweep_depth, SIDE_BID, SIDE_ASK
+
+Level = namedtuple('Level', ['price', 'volume'])
+MAX_LEVELS = 6
+
+
+def walk(c, gamma, x_levels, y_levels, x_side, threshold):
+    ratio = gamma * x_levels[0].price / y_levels[0].price
+    depth_x = list(accumulate(level.volume for level in x_levels))
+    # Lots of X the Y levels up to and including each one can hedge, truncated like the pair does
+    depth_y = [math.floor(volume / ratio) for volume in accumulate(level.volume for level in y_levels)]
+    result = (0, x_levels[0].price, y_levels[0].price)
+    for lot in count(1):
+        index_x = next((i for i, depth in enumerate(depth_x) if depth >= lot), None)
+        index_y = next((i for i, depth in enumerate(depth_y) if depth >= lot), None)
+        if index_x is None or index_y is None:
+            return result
+        implied_y = math.exp(c + gamma * math.log(x_levels[index_x].price))
+        price_y = y_levels[index_y].price
+        credit = price_y - implied_y if x_side == SIDE_BID else implied_y - price_y
+        if not credit > threshold:
+            return result
+        result = (lot, x_levels[index_x].price, price_y)
+
+
+def random_levels(rng, top, direction, nr_levels):
+    # Prices on a 0.1 tick grid moving away from the top, so deeper levels are always worse
+    levels = []
+    price = top
+    for _ in range(nr_levels):
+        volume = rng.randint(1, 3) if rng.random() < 0.2 else rng.randint(1, 60)
+        levels.append(Level(round(price, 1), volume))
+        price += direction * 0.1 * rng.randint(1, 3)
+    return levels
+
+
+def random_case(rng):
+    x_side = SIDE_BID if rng.random() < 0.5 else SIDE_ASK
+    gamma = rng.uniform(0.5, 2.0)
+    top_x = round(rng.uniform(20, 150), 1)
+    top_y = round(rng.uniform(20, 150), 1)
+    # The implied Y price at the top of X lands within a few ticks of the top of Y
+    c = math.log(top_y + rng.uniform(-0.5, 0.5)) - gamma * math.log(top_x)
+    if x_side == SIDE_BID:
+        # Taking the X asks upward and the Y bids downward
+        x_levels = random_levels(rng, top_x, 1, rng.randint(1, MAX_LEVELS))
+        y_levels = random_levels(rng, top_y, -1, rng.randint(1, MAX_LEVELS))
+    else:
+        x_levels = random_levels(rng, top_x, -1, rng.randint(1, MAX_LEVELS))
+        y_levels = random_levels(rng, top_y, 1, rng.randint(1, MAX_LEVELS))
+    threshold = rng.uniform(-0.5, 0.5)
+    return c, gamma, x_levels, y_levels, x_side, threshold
+
+
+def edge_cases():
+    """
+    Returns (name, arguments, expected volume). c and gamma make the implied Y price equal to the X price.
+    """
+    flat = (0.0, 1.0)
+    return [
+        # A ratio of 2.5: the first Y level hedges 0 lots after truncation, the first lot already needs the second Y level
+        ('first Y level floors to 0 lots', (*flat, [Level(10.0, 5)], [Level(4.0, 2), Level(3.9, 10)], SIDE_BID, -100.0), 4),
+        ('X and Y depths break at the same volumes',
+         (*flat, [Level(10.0, 3), Level(10.1, 3)], [Level(10.5, 3), Level(10.4, 3)], SIDE_BID, 0.25), 6),
+        ('duplicate breaks, the second level is not profitable',
+         (*flat, [Level(10.0, 3), Level(10.1, 3)], [Level(10.5, 3), Level(10.2, 3)], SIDE_BID, 0.25), 3),
+        # A tick away from the threshold, at exactly 0 credit math.exp and NumPy's exp can round to either side
+        ('nothing profitable', (*flat, [Level(10.0, 5)], [Level(9.9, 5)], SIDE_BID, 0.0), 0),
+        ('everything profitable, X is shallower', (*flat, [Level(10.0, 2), Level(10.1, 2)], [Level(12.0, 50)], SIDE_BID, 0.0), 4),
+        ('everything profitable, Y is shallower', (*flat, [Level(10.0, 50)], [Level(12.0, 2), Level(11.9, 1)], SIDE_BID, 0.0), 3),
+        ('Y can hedge no lot at all', (*flat, [Level(10.0, 5)], [Level(4.0, 1), Level(3.9, 1)], SIDE_BID, -100.0), 0),
+        ('ask side, X bids down and Y asks up',
+         (*flat, [Level(10.0, 2), Level(9.8, 4)], [Level(9.5, 3), Level(9.7, 10)], SIDE_ASK, 0.05), 6),
+        ('negative threshold, crossing the spread for an exit', (*flat, [Level(10.0, 2), Level(10.2, 2)], [Level(9.9, 10)], SIDE_BID, -0.2), 2),
+    ]
+
+
+def check(args):
+    expected = walk(*args)
+    actual = sweep_depth(*args)
+    return actual == expected, expected, actual
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check sweep_depth() against a lot by lot walk through both books')
+    parser.add_argument('--nr-books', type=int, default=5000, help='Random books to check')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    failures = 0
+    for name, case, volume in edge_cases():
+        same, expected, actual = check(case)
+        if not same or actual[0] != volume:
+            failures += 1
+            print(f"FAIL {name}: expected volume {volume}, walk {expected}, sweep_depth {actual}")
+
+    rng = random.Random(args.seed)
+    volumes = [0] * 2
+    for i in range(args.nr_books):
+        case = random_case(rng)
+        same, expected, actual = check(case)
+        volumes[0 if expected[0] == 0 else 1] += 1
+        if not same:
+            failures += 1
+            print(f"FAIL random book {i}: {case} walk {expected}, sweep_depth {actual}")
+
+    if failures:
+        print(f"{failures} books disagree")
+        sys.exit(1)
+    print(f"OK, {len(edge_cases())} edge cases and {args.nr_books} random books agree "
+          f"({volumes[0]} with nothing to trade, {volumes[1]} with a trade)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Minimal benchmark harness.
+
+A benchmark is a setup function decorated with @benchmark that returns the zero-argument callable to time, or a tuple
+of that callable and a teardown called once the timing is done, also when it fails. Every benchmark is timed in `repeat` rounds of `number` calls; per call timings of all rounds are stored so runs on
+different commits can be compared with compare().
+"""
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+_registry = []
+
+
+def benchmark(name=None, number=1000, repeat=5):
+    def register(setup):
+        _registry.append((name or setup.__name__, setup, number, repeat))
+        return setup
+    return register
+
+
+def get_benchmarks():
+    return list(_registry)
+
+
+def run_benchmark(setup, number, repeat):
+    f = setup()
+    teardown = None
+    if isinstance(f, tuple):
+        f, teardown = f
+    try:
+        # warm up caches and lazily created state before timing
+        for _ in range(min(number, 100)):
+            f()
+        rounds = []
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                f()
+            rounds.append((time.perf_counter_ns() - start) / number)
+    finally:
+        if teardown is not None:
+            teardown()
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min_ns': min(rounds),
+        'median_ns': statistics.median(rounds),
+        'rounds_ns': rounds,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_all(name_filter=None, log=print):
+    results = {}
+    for name, setup, number, repeat in _registry:
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            result = run_benchmark(setup, number, repeat)
+        except Exception as e:
+            # Keep going, a broken benchmark should not hide the results of the others
+            results[name] = {'error': repr(e)}
+            log(f"{name:45} FAILED: {e!r}")
+            continue
+        results[name] = result
+        log(f"{name:45} {result['median_ns'] / 1000:12.3f} us/call  (min {result['min_ns'] / 1000:.3f})")
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def save(run, path):
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=1)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compares the median timings of two runs. Returns rows of (name, baseline_ns, current_ns, ratio, regressed)
+    where regressed means current is more than threshold slower than baseline.
+    """
+    rows = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or 'error' in base or 'error' in result:
+            continue
+        ratio = result['median_ns'] / base['median_ns']
+        rows.append((name, base['median_ns'], result['median_ns'], ratio, ratio > 1 + threshold))
+    return rows
@@ -0,0 +1,60 @@
+"""
+Runs the benchmark suite and stores the results as JSON.
+
+Run from the repository root with the optibook package installed:
+
+    python benchmarks/run.py                           # writes benchmarks/results/<commit>.json
+    python benchmarks/run.py --filter info             # only benchmarks with 'info' in their name
+    python benchmarks/run.py --compare benchmarks/results/abc1234.json
+
+With --compare the new run is compared against an earlier result file and the exit code is 1 if any benchmark got
+slower by more than --threshold.
+"""
+import argparse
+import importlib
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'notebooks'))
+
+import harness
+
+BENCHMARK_MODULES = ['bench_client', 'bench_pair_trader', 'bench_strategy']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite')
+    parser.add_argument('--filter', default=None, help='Only run benchmarks whose name contains this string')
+    parser.add_argument('--output', default=None, help='Result file, defaults to benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None, help='Earlier result file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as regression')
+    args = parser.parse_args()
+
+    for module in BENCHMARK_MODULES:
+        importlib.import_module(module)
+
+    run = harness.run_all(args.filter)
+
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(BENCHMARK_DIR, 'results'), exist_ok=True)
+        output = os.path.join(BENCHMARK_DIR, 'results', f"{run['commit']}.json")
+    harness.save(run, output)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        regressed = False
+        baseline = harness.load(args.compare)
+        print(f"\nCompared to {baseline['commit']}:")
+        for name, base_ns, current_ns, ratio, is_regression in harness.compare(baseline, run, args.threshold):
+            marker = '  REGRESSION' if is_regression else ''
+            print(f"{name:45} {base_ns / 1000:10.3f} -> {current_ns / 1000:10.3f} us  x{ratio:5.2f}{marker}")
+            regressed = regressed or is_regression
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
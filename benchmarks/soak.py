@@ -0,0 +1,377 @@
+"""
+Soak test of the exchange client against a local stand-in exchange.
+
+Run from the repository root with the optibook package installed:
+
+    python benchmarks/soak.py --duration 14400 --rate 2000      # four hours at 2000 messages/s
+    python benchmarks/soak.py --duration 120                    # quick check
+
+The stand-in info server streams price books and trade ticks of --nr-instruments instruments at --rate messages per
+second, the client only keeps the ones the Autotrader trades. Meanwhile the main thread polls the client the way the
+strategy does, private trades and order updates are fed to an ExecClient on the event loop and requests are sent of
+which the stand-in only answers every other one. Outstanding orders are looked up, also of instruments without any,
+and price books are waited for with a timeout like Exchange.connect(instrument_ids=...) does, including for an
+instrument whose books are never kept. Every --sample-interval seconds the harness samples RSS, the number of live objects per
+type, event loop lag and the latency of a call to the event loop.
+
+The first --warmup seconds, in which histories and caches fill up, are not judged. Of the remaining samples the median
+of the last third is compared to the median of the first third, the run fails with exit code 1 if any metric grew by
+more than its tolerance.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+
+from optibook.exchange_client import InfoClient, ExecClient
+from optibook.synchronous_wrapper import SynchronousWrapper
+from optibook.idl import common_capnp, exec_capnp, info_capnp
+
+logging.getLogger('client').setLevel('ERROR')
+
+TRADED_INSTRUMENTS = ['AIRBUS', 'ALLIANZ', 'ASML', 'LVMH', 'SAP', 'SIEMENS', 'TOTAL', 'UNILEVER']
+BOOK_DEPTH = 5
+NR_PREBUILT_MESSAGES = 4096
+SEND_INTERVAL = 0.01
+POLL_INTERVAL = 0.001
+LAG_PROBE_INTERVAL = 0.01
+REQUEST_TIMEOUT = 0.2
+BOOKS_TIMEOUT = 0.01
+# Per metric the relative growth and the absolute growth that both have to be exceeded to fail the run
+TOLERANCES = {
+    'rss_mb': (0.10, 4.0),
+    'nr_objects': (0.05, 5000),
+    'loop_lag_ms': (0.50, 2.0),
+    'call_latency_p99_us': (0.50, 100.0),
+    'waiters': (0.0, 2),
+    'book_waiters': (0.0, 2),
+    'order_index_views': (0.0, 2),
+    'message_callbacks': (0.0, 2),
+}
+OBJECT_TYPE_TOLERANCE = (0.10, 1000)
+
+
+def _raw(schema, msg):
+    raw = common_capnp.RawMessage.new_message()
+    raw.type = schema.schema.node.id
+    raw.msg = msg
+    return raw.to_bytes()
+
+
+def _prebuilt_messages(nr_instruments, seed=1):
+    # Encoded once, the stand-in only cycles through them so it doesn't grow itself
+    rng = random.Random(seed)
+    instrument_ids = TRADED_INSTRUMENTS + [f"OTHER{i}" for i in range(max(0, nr_instruments - len(TRADED_INSTRUMENTS)))]
+    messages = []
+    for i in range(NR_PREBUILT_MESSAGES):
+        instrument_id = instrument_ids[rng.randrange(len(instrument_ids))]
+        mid = round(rng.uniform(50, 150), 1)
+        if rng.random() < 0.8:
+            pb = info_capnp.PriceBook.new_message()
+            pb.instrumentId = instrument_id
+            bids = pb.init('bids', BOOK_DEPTH)
+            asks = pb.init('asks', BOOK_DEPTH)
+            for level in range(BOOK_DEPTH):
+                bids[level].price = round(mid - 0.1 * (level + 1), 1)
+                bids[level].volume = rng.randint(1, 200)
+                asks[level].price = round(mid + 0.1 * (level + 1), 1)
+                asks[level].volume = rng.randint(1, 200)
+            messages.append(_raw(info_capnp.PriceBook, pb))
+        else:
+            tt = common_capnp.TradeTick.new_message()
+            tt.tradeId = i
+            tt.timestamp = time.time_ns()
+            tt.instrumentId = instrument_id
+            tt.price = mid
+            tt.volume = rng.randint(1, 100)
+            tt.aggressorSide = 'bid' if rng.random() < 0.5 else 'ask'
+            tt.buyer = 'buyer'
+            tt.seller = 'seller'
+            messages.append(_raw(common_capnp.TradeTick, tt))
+    return messages
+
+
+async def _read_message(reader):
+    nr_segments_b = await reader.readexactly(4)
+    nr_segments = int.from_bytes(nr_segments_b, byteorder='little') + 1
+    segment_sizes_b = await reader.readexactly(nr_segments * 4 + (4 if nr_segments % 2 == 0 else 0))
+    total_size = sum(int.from_bytes(segment_sizes_b[i * 4:(i + 1) * 4], byteorder='little') * 8 for i in range(nr_segments))
+    return common_capnp.RawMessage.from_bytes(nr_segments_b + segment_sizes_b + await reader.readexactly(total_size))
+
+
+class StandInExchange:
+    """
+    Info server that acknowledges the subscription and then streams prebuilt messages at a fixed rate. Later requests
+    are answered too, except every other one so that the client has replies that never arrive.
+    """
+    def __init__(self, port, rate, nr_instruments):
+        self.port = port
+        self._batch = max(1, round(rate * SEND_INTERVAL))
+        self._messages = _prebuilt_messages(nr_instruments)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='soak-exchange', daemon=True)
+
+    def start(self):
+        self._loop.run_until_complete(asyncio.start_server(self._on_client, '127.0.0.1', self.port))
+        self._thread.start()
+
+    async def _on_client(self, reader, writer):
+        # The stream starts once the subscription is acknowledged, like on the exchange
+        subscribed = asyncio.Event()
+        requests = asyncio.ensure_future(self._answer_requests(reader, writer, subscribed))
+        await subscribed.wait()
+        index = 0
+        next_send = time.monotonic()
+        try:
+            while not writer.is_closing() and not requests.done():
+                for _ in range(self._batch):
+                    writer.write(self._messages[index])
+                    index = (index + 1) % len(self._messages)
+                await writer.drain()
+                next_send += SEND_INTERVAL
+                await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        except ConnectionError:
+            pass
+        requests.cancel()
+
+    async def _answer_requests(self, reader, writer, subscribed):
+        nr_requests = 0
+        while True:
+            msg = await _read_message(reader)
+            request_id = msg.msg.as_struct(info_capnp.InfoSubscribeRequest.schema).requestId
+            if nr_requests == 0 or nr_requests % 2:
+                reply = common_capnp.GenericReply.new_message()
+                reply.requestId = request_id
+                writer.write(_raw(common_capnp.GenericReply, reply))
+            nr_requests += 1
+            subscribed.set()
+
+
+class Sampler:
+    def __init__(self, info, exec_client):
+        self._info = info
+        self._exec_client = exec_client
+        self._max_lag = 0.0
+        self._latencies = []
+        self.samples = []
+
+    async def probe_loop_lag(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            self._max_lag = max(self._max_lag, time.monotonic() - start - LAG_PROBE_INTERVAL)
+
+    def record_latency(self, seconds):
+        self._latencies.append(seconds)
+
+    def sample(self, elapsed, nr_messages):
+        gc.collect()
+        types = Counter(type(o).__name__ for o in gc.get_objects())
+        latencies = sorted(self._latencies) or [0.0]
+        sample = {
+            'time_s': elapsed,
+            'rss_mb': _rss_mb(),
+            'nr_objects': sum(types.values()),
+            'loop_lag_ms': self._max_lag * 1e3,
+            'call_latency_p99_us': latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1e6,
+            'waiters': len(self._info._waiters),
+            'book_waiters': sum(len(waiters) for waiters in self._info._book_waiters.values()),
+            'order_index_views': len(self._exec_client._order_index._views),
+            'message_callbacks': len(self._info._extra_callbacks),
+            'nr_messages': nr_messages,
+            'types': dict(types.most_common(50)),
+        }
+        self._max_lag = 0.0
+        self._latencies = []
+        self.samples.append(sample)
+        return sample
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def _grew(first, last, tolerance):
+    relative, absolute = tolerance
+    return last - first > absolute and last > first * (1 + relative)
+
+
+def judge(samples, warmup):
+    """
+    Returns the metrics that trend upward as (name, median of the first third, median of the last third).
+    """
+    judged = [s for s in samples if s['time_s'] >= warmup]
+    if len(judged) < 6:
+        raise Exception(f"Only {len(judged)} samples after the warm up, run longer or sample more often")
+    third = len(judged) // 3
+    first, last = judged[:third], judged[-third:]
+    grown = []
+    for name, tolerance in TOLERANCES.items():
+        first_median = statistics.median(s[name] for s in first)
+        last_median = statistics.median(s[name] for s in last)
+        if _grew(first_median, last_median, tolerance):
+            grown.append((name, first_median, last_median))
+    for type_name in last[-1]['types']:
+        first_median = statistics.median(s['types'].get(type_name, 0) for s in first)
+        last_median = statistics.median(s['types'].get(type_name, 0) for s in last)
+        if _grew(first_median, last_median, OBJECT_TYPE_TOLERANCE):
+            grown.append((f"objects of type {type_name}", first_median, last_median))
+    return grown
+
+
+def _private_trade(trade_id, instrument_id):
+    trade = exec_capnp.Trade.new_message()
+    trade.tradeId = trade_id
+    trade.timestamp = time.time_ns()
+    trade.instrumentId = instrument_id
+    trade.orderId = trade_id
+    trade.price = 100.0
+    trade.volume = 1
+    trade.side = 'bid' if trade_id % 2 else 'ask'
+    return trade.as_reader()
+
+
+def _order_update(order_id, instrument_id, volume):
+    order = common_capnp.Order.new_message()
+    order.instrumentId = instrument_id
+    order.orderId = order_id
+    order.price = 100.0
+    order.volume = volume
+    order.side = 'bid' if order_id % 2 else 'ask'
+    return order.as_reader()
+
+
+def run(duration, rate, nr_instruments, sample_interval, port):
+    exchange = StandInExchange(port, rate, nr_instruments)
+    exchange.start()
+
+    info = InfoClient('127.0.0.1', port, instrument_ids=TRADED_INSTRUMENTS)
+    # Never connected, its exec feed handlers are called directly on the event loop
+    exec_client = ExecClient('127.0.0.1', 0)
+    exec_feed = ExecClient.ExecSubscription(exec_client)
+    wrapper = SynchronousWrapper([info])
+    wrapper.connect()
+    loop = wrapper.get_loop()
+    sampler = Sampler(info, exec_client)
+
+    async def start_probe():
+        return loop.create_task(sampler.probe_loop_lag())
+    probe = wrapper.run_on_loop(start_probe())
+
+    nr_messages = [0]
+
+    def count(msg):
+        nr_messages[0] += 1
+    info.add_message_callback(count)
+
+    async def noop():
+        pass
+
+    async def request(request_id):
+        msg = common_capnp.RawMessage.new_message()
+        msg.type = info_capnp.InfoSubscribeRequest.schema.node.id
+        subscribe = info_capnp.InfoSubscribeRequest.new_message()
+        subscribe.requestId = request_id
+        subscribe.bookUpdateType = 'price'
+        msg.msg = subscribe
+        try:
+            await asyncio.wait_for(info.send_request(request_id, msg), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def private_trade(trade_id):
+        exec_feed.onTrade(_private_trade(trade_id, TRADED_INSTRUMENTS[trade_id % len(TRADED_INSTRUMENTS)]))
+
+    async def order_updates(order_id):
+        # One order rests for a while, an older one is done
+        exec_feed.onOrderUpdate(_order_update(order_id, TRADED_INSTRUMENTS[order_id % len(TRADED_INSTRUMENTS)], 5))
+        if order_id > 100:
+            exec_feed.onOrderUpdate(_order_update(order_id - 100, TRADED_INSTRUMENTS[(order_id - 100) % len(TRADED_INSTRUMENTS)], 0))
+
+    async def wait_for_books(instrument_ids):
+        try:
+            await asyncio.wait_for(info.wait_for_price_books(instrument_ids), BOOKS_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    start = time.monotonic()
+    next_sample = start + sample_interval
+    iteration = 0
+    try:
+        while time.monotonic() - start < duration and wrapper.is_connected():
+            iteration += 1
+            for instrument_id in TRADED_INSTRUMENTS:
+                info.get_last_price_book(instrument_id)
+                info.poll_new_trade_ticks(instrument_id)
+                exec_client.poll_new_trades(instrument_id)
+            # Instruments that are never received, polling them must not leave anything behind
+            info.poll_new_trade_ticks(f"OTHER{iteration % 64}")
+            exec_client.poll_new_trades(f"OTHER{iteration % 64}")
+            exec_client.get_outstanding_orders(TRADED_INSTRUMENTS[iteration % len(TRADED_INSTRUMENTS)])
+            exec_client.get_outstanding_order(iteration)
+            exec_client.is_order_done(iteration)
+            # An instrument id that was never seen before on every iteration, anything kept per id shows up as growth
+            exec_client.get_outstanding_orders(f"UNLISTED{iteration}")
+
+            call_start = time.perf_counter()
+            wrapper.run_on_loop(noop())
+            sampler.record_latency(time.perf_counter() - call_start)
+            if iteration % 10 == 0:
+                wrapper.run_on_loop(private_trade(iteration))
+                wrapper.run_on_loop(order_updates(iteration))
+            if iteration % 100 == 0:
+                c_id = info.add_message_callback(lambda msg: None)
+                info.remove_message_callback(c_id)
+                wrapper.run_on_loop(request(1000 + iteration))
+                wrapper.run_on_loop(wait_for_books([TRADED_INSTRUMENTS[0], f"OTHER{iteration % 64}"]))
+
+            now = time.monotonic()
+            if now >= next_sample:
+                s = sampler.sample(now - start, nr_messages[0])
+                print(f"{s['time_s']:8.0f}s  rss {s['rss_mb']:7.1f} MB  objects {s['nr_objects']:8}  loop lag {s['loop_lag_ms']:7.2f} ms  "
+                      f"call p99 {s['call_latency_p99_us']:8.1f} us  waiters {s['waiters']:3}  book waiters {s['book_waiters']:3}  "
+                      f"order views {s['order_index_views']:3}  messages {s['nr_messages']}", flush=True)
+                next_sample += sample_interval
+            time.sleep(POLL_INTERVAL)
+    finally:
+        # The loop only stops once all of its tasks are done
+        loop.call_soon_threadsafe(probe.cancel)
+        wrapper.disconnect()
+    return sampler.samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test of the exchange client against a local stand-in exchange')
+    parser.add_argument('--duration', type=float, default=600, help='Seconds to run')
+    parser.add_argument('--rate', type=float, default=2000, help='Messages per second sent by the stand-in exchange')
+    parser.add_argument('--nr-instruments', type=int, default=64, help='Instruments listed by the stand-in exchange')
+    parser.add_argument('--sample-interval', type=float, default=10, help='Seconds between samples')
+    parser.add_argument('--warmup', type=float, default=None, help='Seconds not judged, defaults to a tenth of the duration')
+    parser.add_argument('--port', type=int, default=17900)
+    parser.add_argument('--output', default=None, help='Write all samples to this JSON file')
+    args = parser.parse_args()
+
+    samples = run(args.duration, args.rate, args.nr_instruments, args.sample_interval, args.port)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(samples, f, indent=1)
+
+    grown = judge(samples, args.warmup if args.warmup is not None else args.duration / 10)
+    if grown:
+        for name, first, last in grown:
+            print(f"FAIL {name} grew from {first:.1f} to {last:.1f}")
+        sys.exit(1)
+    print(f"OK, no metric trended upward over {len(samples)} samples")
+
+
+if __name__ == '__main__':
+    main()
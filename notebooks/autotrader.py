@@ -3,8 +3,20 @@ import random
 from math import ceil, log, exp
 from typing import Dict, List
 from cointegration_analysis import estimate_long_run_short_run_relationships
+from basket_hedger import BasketHedger
+from hedge_manager import HedgeManager
+from recalibration import Recalibrator
+from signal_engine import PairSignalEngine, sweep_depth
+from hedge_netter import HedgeNetter
 
 from optibook.synchronous_client import Exchange
+from optibook.risk import RiskLimitBreached
+from optibook.instruments import InstrumentNotTradable
+from optibook.tracing import tracer
+from optibook.profiler import SamplingProfiler
+from optibook.runtime import RuntimeProfile
+from optibook.journal import FillJournal
+from optibook.shared_risk import SharedRiskBook
 from time import sleep
 
 import logging
@@ -12,12 +24,44 @@ logger = logging.getLogger('client')
 logger.setLevel('INFO')
 
 SANITY_CHECK_RESET = 150
-HEDGE_TIMER_RESET = 400
+TRACE_FILE = 'trace.json'
+EXCHANGE_POSITION_LIMIT = 500
+MAX_ORDER_VOLUME = 499
+# Inserts, amends and deletes all count toward the message rate the exchange allows before a forced disconnect.
+# Requests above these rates are queued by the exchange client, a queued IOC is replaced by a newer one.
+MAX_ORDER_REQUESTS_PER_SECOND = 20
+MAX_ORDER_REQUESTS_PER_SECOND_PER_INSTRUMENT = 10
+# Every pair needs a book for both legs before it can compute its initial hedge
+PAIR_INSTRUMENTS = ["ALLIANZ", "LVMH", "ASML", "SAP", "SIEMENS", "AIRBUS", "UNILEVER", "TOTAL"]
 
 class Autotrader:
-    def __init__(self, host, username, password, log_stock_values):
-        self._e = Exchange(host=host)
-        self._a = self._e.connect(username=username, password=password)
+    def __init__(self, host, username, password, log_stock_values, trace: bool = False, recalibrate: bool = False, basket_hedging: bool = False,
+                 profile_socket: str = None, runtime: RuntimeProfile = None, journal_path: str = None,
+                 shared_risk: str = None, signal_engine: bool = False, hedge_netting: bool = False, depth_sizing: bool = False):
+        if trace:
+            tracer.enable()
+        # kill -USR2 <pid> starts and stops the sampling profiler, it costs nothing until then
+        self._profiler = SamplingProfiler()
+        self._profiler.install_signal_handler()
+        if profile_socket is not None:
+            self._profiler.serve_control_socket(profile_socket)
+        self._runtime = runtime
+        self._journal = FillJournal(journal_path) if journal_path is not None else None
+        journaled = self._journal.rebuild_accountant().get_positions() if self._journal is not None else None
+        # Name of a risk book created with python -m optibook.shared_risk, when other processes trade on the same account
+        self._shared_risk = SharedRiskBook.attach(shared_risk) if shared_risk is not None else None
+        # Books of the other instruments on the exchange are dropped unread, basket hedges need the substitutes as well
+        instrument_ids = sorted(set(PAIR_INSTRUMENTS) | set(log_stock_values)) if basket_hedging else PAIR_INSTRUMENTS
+        self._e = Exchange(host=host, runtime=runtime, journal=self._journal, shared_risk=self._shared_risk, instrument_ids=instrument_ids,
+                           max_orders_per_second=MAX_ORDER_REQUESTS_PER_SECOND,
+                           max_orders_per_second_per_instrument=MAX_ORDER_REQUESTS_PER_SECOND_PER_INSTRUMENT)
+        self._a = self._e.connect(username=username, password=password, instrument_ids=PAIR_INSTRUMENTS)
+        self._e.add_connection_state_callback(lambda state: logger.warning(f"Exchange connection {state}"))
+        if journaled is not None:
+            self._check_journal(journaled)
+        self._e.set_risk_limits(max_position=EXCHANGE_POSITION_LIMIT, max_order_volume=MAX_ORDER_VOLUME)
+        # Positions taken by basket hedges, these don't belong to the pair trading the instrument
+        self._basket_positions = {}
         self.lvmh_allianz_trader = Pair_Trader(self, "ALLIANZ", "LVMH", log_stock_values, 0.1, 300, "limit")
         self.asml_sap_trader = Pair_Trader(self, "ASML", "SAP", log_stock_values, 0.2, 300, "limit")
 
@@ -25,10 +69,58 @@ class Autotrader:
         self.airbus_siemens_trader = Pair_Trader(self, "SIEMENS", "AIRBUS", log_stock_values, 0.3, 100, "limit")
         self.unilever_total_trader = Pair_Trader(self, "UNILEVER", "TOTAL", log_stock_values, 0.2, 150, "limit")
 
+        traders = [self.lvmh_allianz_trader, self.asml_sap_trader, self.airbus_siemens_trader, self.unilever_total_trader]
+        self._traders = traders
+        # Pairs trading the same instrument each own part of the account position in it
+        for trader in traders:
+            trader.share_positions_with([t for t in traders if t is not trader and
+                                         {t.stock_x_id, t.stock_y_id} & {trader.stock_x_id, trader.stock_y_id}])
+        # Pauses are pushed to the traders as they happen, so they stop sending orders that would only be rejected
+        self._e.add_instrument_callback(self._on_instrument_update)
+        for trader in traders:
+            for instrument_id in (trader.stock_x_id, trader.stock_y_id):
+                instrument = self._e.get_instrument(instrument_id)
+                if instrument is not None:
+                    trader.on_instrument_update(instrument)
+        if basket_hedging:
+            for trader in traders:
+                substitutes = [instrument_id for instrument_id in log_stock_values if instrument_id not in (trader.stock_x_id, trader.stock_y_id)]
+                trader.use_basket_hedging(BasketHedger(trader.stock_y_id, substitutes, log_stock_values))
+
+        # One vectorized credit evaluation per cycle for all pairs, pairs without an opportunity skip their own
+        self._signals = None
+        if signal_engine:
+            self._signals = PairSignalEngine(self.get_order_book)
+            for trader in traders:
+                trader.use_signal_engine(self._signals)
+
+        if depth_sizing:
+            for trader in traders:
+                trader.use_depth_sizing()
+
+        # Hedges of all pairs go out once per cycle, netted per instrument
+        self._netter = None
+        if hedge_netting:
+            self._netter = HedgeNetter(self)
+            for trader in traders:
+                trader.use_hedge_netting(self._netter)
+
+        self._recalibrator = None
+        if recalibrate:
+            self._recalibrator = Recalibrator(self.get_order_book, [(t.stock_y_id, t.stock_x_id) for t in traders])
+            for trader in traders:
+                trader.follow_recalibration(self._recalibrator)
 
     def __del__(self):
         self._e.disconnect()
 
+    def _check_journal(self, journaled):
+        # Fills that happened while we were not running are missing from the journal, the login snapshot covers them from now on
+        for instrument_id, position in self._e.get_positions().items():
+            journaled_position = journaled.get(instrument_id, {'volume': 0})['volume']
+            if journaled_position != position:
+                logger.warning(f"Journal has position {journaled_position} in {instrument_id}, exchange reports {position}")
+
     def _log_order_book(self, instrument_id):
         pb = self._e.get_last_price_book(instrument_id)
         logger.debug("| BID |  PRICE  | ASK |")
@@ -40,14 +132,36 @@ class Autotrader:
         logger.debug("|-----|---------|-----|")
 
     def insert_order(self, order_book_id: str, price: float, volume: int, side: str, order_type: str) -> int:
-        assert volume > 0 and volume < 500, "Volume must be between 0 and 500"
-        assert price > 0, "Price must be greater than 0"
-        return self._e.insert_order(order_book_id, price=round(price, 2), volume=volume, side=side, order_type=order_type)
+        # Volume, price and position limits and the instrument state are checked by the exchange client before the
+        # order is sent, it also rounds the price onto the tick grid
+        try:
+            return self._e.insert_order(order_book_id, price=price, volume=volume, side=side, order_type=order_type)
+        except RiskLimitBreached as e:
+            logger.warning(f"Order {side} {volume}@{price} on {order_book_id} rejected by risk check: {e}")
+            return None
+        except InstrumentNotTradable as e:
+            logger.warning(f"Order {side} {volume}@{price} on {order_book_id} not sent: {e}")
+            return None
+
+    def _on_instrument_update(self, instrument):
+        # Called on the event loop thread
+        for trader in self._traders:
+            trader.on_instrument_update(instrument)
 
     def delete_order(self, order_book_id: str, order_id: int) -> bool:
         assert order_id > 0
         return self._e.delete_order(order_book_id, order_id=order_id)
 
+    def amend_order(self, order_book_id: str, order_id: int, volume: int) -> bool:
+        assert order_id > 0 and volume > 0
+        return self._e.amend_order(order_book_id, order_id=order_id, volume=volume)
+
+    def get_outstanding_order(self, order_id: int):
+        return self._e.get_outstanding_order(order_id)
+
+    def is_order_done(self, order_id: int) -> bool:
+        return self._e.is_order_done(order_id)
+
     def delete_all_orders(self, order_book_id: str) -> None:
         self._e.delete_orders(order_book_id)
 
@@ -55,7 +169,10 @@ class Autotrader:
         return self._e.get_last_price_book(order_book_id)
 
     def get_position(self, order_book_id: str) -> int:
-        return self._e.get_positions()[order_book_id]
+        return self._e.get_positions()[order_book_id] - self._basket_positions.get(order_book_id, 0)
+
+    def record_basket_fill(self, order_book_id: str, volume: int) -> None:
+        self._basket_positions[order_book_id] = self._basket_positions.get(order_book_id, 0) + volume
 
     def start(self):
         # connection check
@@ -69,17 +186,83 @@ class Autotrader:
         self.airbus_siemens_trader.get_initial_data()
         self.unilever_total_trader.exit_position_negative = True
         self.airbus_siemens_trader.exit_position_negative = True
+        if self._runtime is not None:
+            # Everything that lives for the whole session exists now
+            self._runtime.on_strategy_ready()
+        if self._recalibrator is not None:
+            self._recalibrator.start()
         # Run the actual market operation loop
         while self._e.is_connected():
+            if self._signals is not None:
+                self._signals.refresh()
             self.unilever_total_trader.single_loop_iteration()
             self.lvmh_allianz_trader.single_loop_iteration()
             self.asml_sap_trader.single_loop_iteration()
             self.airbus_siemens_trader.single_loop_iteration()
+            if self._netter is not None:
+                self._netter.run()
             #sleep(0.01)
 
+        if self._recalibrator is not None:
+            self._recalibrator.stop()
+        for trader in [self.unilever_total_trader, self.lvmh_allianz_trader, self.asml_sap_trader, self.airbus_siemens_trader]:
+            logger.info(trader.hedge_report())
+        if self._netter is not None:
+            logger.info(self._netter.report())
+        logger.info(f"Order throttle: {self._e.get_throttle_metrics()}")
+        # Don't lose a profile that was still running when we got disconnected
+        self._profiler.stop()
+        if self._journal is not None:
+            self._journal.close()
+        if self._shared_risk is not None:
+            self._shared_risk.close()
+        if tracer.enabled:
+            tracer.dump(TRACE_FILE)
+            for label, stats in tracer.report().items():
+                logger.info(f"Latency for {label}: {stats}")
+
+class CreditCache:
+    """
+    Credit of one direction of a pair for the last seen top of book.
+
+    The implied Y price only depends on the X price, so log/exp are evaluated only when the X price moves.
+    An unchanged book top costs two float comparisons. The credit is computed with exactly the same
+    expression as before caching, so the trading decision boundaries do not move.
+    """
+    def __init__(self, c: float, gamma: float, x_side: str):
+        assert x_side == "bid" or x_side == "ask", "x_side must be bid or ask"
+        self._c = c
+        self._gamma = gamma
+        self._x_side = x_side
+        self.invalidate()
+
+    def invalidate(self):
+        self._price_x = None
+        self._price_y = None
+        self._implied_y = 0.0
+        self._credit = 0.0
+
+    def credit(self, price_x: float, price_y: float) -> float:
+        if price_x == self._price_x and price_y == self._price_y:
+            return self._credit
+
+        if price_x != self._price_x:
+            implied_y_t = self._c + self._gamma * log(price_x)
+            self._implied_y = exp(implied_y_t)
+            self._price_x = price_x
+        self._price_y = price_y
+
+        if self._x_side == "bid":
+            # Buying X at the ask, selling Y at the bid
+            self._credit = price_y - self._implied_y
+        else:
+            # Selling X at the bid, buying Y at the ask
+            self._credit = self._implied_y - price_y
+        return self._credit
+
 class Pair_Trader:
     def __init__(self, autotrader: Autotrader, stock_y_id: str, stock_x_id: str, log_stock_values: Dict[str, List[float]], required_credit: float, risk_limit: int = 50, hedge_type: str = "ioc"):
-        assert risk_limit > 0 and risk_limit <= 500, "Risk limit must be between 0 and 500" # Limits set by exchange
+        assert risk_limit > 0 and risk_limit <= EXCHANGE_POSITION_LIMIT, "Risk limit must be between 0 and 500" # Limits set by exchange
         assert hedge_type == "ioc" or hedge_type == "limit", "Can only hedge with limit or IOC orders"
         assert required_credit >= 0, "Required credit can't be negative or we will lose money"
         self.stock_x_id = stock_x_id
@@ -91,16 +274,89 @@ class Pair_Trader:
         self._hedge_type = hedge_type
         self._c, self._gamma, _, _ = estimate_long_run_short_run_relationships(log_stock_values[stock_y_id], log_stock_values[stock_x_id])
         logger.info(f"For pair Y:{stock_y_id}, X:{stock_x_id} c is {self._c} and gamma is {self._gamma}")
+        self._bid_credit = CreditCache(self._c, self._gamma, "bid")
+        self._ask_credit = CreditCache(self._c, self._gamma, "ask")
         self._internal_position_x = 0
         self._internal_position_y = 0
         self._missing_hedge = 0
-        self._hedge_timer = 0
-        self._limit_order_out = False
+        self._hedger = HedgeManager(autotrader, stock_y_id)
+        self._trace_label = f"Y:{stock_y_id} X:{stock_x_id}"
         self._sanity_check_counter = SANITY_CHECK_RESET
+        self._recalibrator = None
+        self._model_version = 0
+        self._basket = None
+        self._halted_instruments = set()
+        self._signals = None
+        self._signal_index = None
+        self._netter = None
+        self._peers = []
+        self._depth_sizing = False
+
+    def use_basket_hedging(self, basket: BasketHedger):
+        self._basket = basket
+
+    def use_signal_engine(self, signals: PairSignalEngine):
+        self._signals = signals
+        # The lowest credit _min_credit can ever ask for, whatever exit_position_negative and the position are
+        self._signal_index = signals.add_pair(self.stock_y_id, self.stock_x_id, self._c, self._gamma,
+                                              min(self.required_credit, -self.required_credit + .2))
+
+    def use_depth_sizing(self):
+        # Size trades on all levels of both books instead of the top of book, taking them with one IOC each
+        self._depth_sizing = True
+
+    def use_hedge_netting(self, netter: HedgeNetter):
+        # The netter sends the hedges, a limit hedge is never worked by the pair itself
+        self._netter = netter
+        netter.add_pair(self)
+
+    def share_positions_with(self, peers: List['Pair_Trader']):
+        self._peers = peers
+
+    def get_internal_position(self, instrument_id: str) -> int:
+        if instrument_id == self.stock_x_id:
+            return self._internal_position_x
+        if instrument_id == self.stock_y_id:
+            return self._internal_position_y
+        return 0
+
+    def get_missing_hedge(self) -> int:
+        return self._missing_hedge
+
+    def on_netted_hedge(self, volume: int):
+        # Our part of a net hedge order, or of the hedge of another pair we were crossed with
+        self._internal_position_y += volume
+        self._missing_hedge -= volume
+
+    def hedge_remainder_in_basket(self):
+        # Only once every pair got its part of the net hedge, until then the positions of the peers are off
+        if self._missing_hedge and self._basket is not None:
+            self._hedge_basket()
+
+    def _get_position(self, instrument_id: str) -> int:
+        position = self._at.get_position(instrument_id)
+        for peer in self._peers:
+            position -= peer.get_internal_position(instrument_id)
+        return position
+
+    def on_instrument_update(self, instrument):
+        if instrument.id != self.stock_x_id and instrument.id != self.stock_y_id:
+            return
+        if instrument.paused or instrument.expired:
+            if instrument.id not in self._halted_instruments:
+                logger.warning(f"{instrument.id} is {'expired' if instrument.expired else 'paused'}, halting pair Y:{self.stock_y_id} X:{self.stock_x_id}")
+            self._halted_instruments.add(instrument.id)
+        elif instrument.id in self._halted_instruments:
+            self._halted_instruments.discard(instrument.id)
+            logger.info(f"{instrument.id} resumed, pair Y:{self.stock_y_id} X:{self.stock_x_id} trades again once both legs are tradable")
+
+    def follow_recalibration(self, recalibrator: Recalibrator):
+        self._recalibrator = recalibrator
+        self._model_version = recalibrator.version
 
     def get_initial_data(self):
-        self._internal_position_x = self._at.get_position(self.stock_x_id)
-        self._internal_position_y = self._at.get_position(self.stock_y_id)
+        self._internal_position_x = self._get_position(self.stock_x_id)
+        self._internal_position_y = self._get_position(self.stock_y_id)
 
         order_book_x = self._at.get_order_book(self.stock_x_id)
         order_book_y = self._at.get_order_book(self.stock_y_id)
@@ -115,7 +371,15 @@ class Pair_Trader:
         logger.info(f"Collected all necessary information. {self.stock_y_id} position {self._internal_position_y} and {self.stock_x_id} position {self._internal_position_x} with missing hedge {self._missing_hedge}")
 
     def single_loop_iteration(self):
-        if self._hedge_type == "limit" and self._missing_hedge != 0 and self._limit_order_out:
+        # Nothing can be traded or hedged while either leg is paused
+        if self._halted_instruments:
+            return
+
+        # Only a version compare per iteration, the parameters themselves are swapped in between iterations
+        if self._recalibrator is not None and self._recalibrator.version != self._model_version:
+            self._update_model()
+
+        if self._hedger.is_working():
             self._process_limit_hedges()
 
         if self._sanity_check_counter == 0:
@@ -127,54 +391,96 @@ class Pair_Trader:
         order_book_x = self._at.get_order_book(self.stock_x_id)
         order_book_y = self._at.get_order_book(self.stock_y_id)
 
-        if self._hedge_timer > 0:
-            self._hedge_timer -= 1
-        if self._missing_hedge != 0 and self._hedge_timer == 0:
-            # Do something to hedge
-            # self._fill_hedges(order_book_y)
-            pass
-
-        if len(order_book_y.bids) > 0 and len(order_book_x.asks) > 0:
-            y_t = log(order_book_y.bids[0].price)
-            x_t = log(order_book_x.asks[0].price)
-            #z_t = y_t - self._c - self._gamma * x_t
-            implied_y_t = self._c + self._gamma * x_t
-            implied_Y = exp(implied_y_t)
-            credit = order_book_y.bids[0].price - implied_Y
-            volume = self._calculate_volume_from_credit(credit, order_book_y.bids[0].volume, "bid", order_book_x.asks[0].price, order_book_y.bids[0].price)
-            # logger.info(f"z_t for buying x, selling y: {z_t}. Seeing credit of {credit}")
+        signals = self._signals
+        if len(order_book_y.bids) > 0 and len(order_book_x.asks) > 0 and (
+                signals is None or not signals.is_quiet(self._signal_index, "bid", order_book_x, order_book_y)):
+            credit = self._bid_credit.credit(order_book_x.asks[0].price, order_book_y.bids[0].price)
+            # Most iterations see no opportunity, skip the volume calculation for those
+            price_x, price_y = order_book_x.asks[0].price, order_book_y.bids[0].price
+            if credit > self._min_credit("bid"):
+                available_volume = None
+                if self._depth_sizing:
+                    available_volume, price_x, price_y = sweep_depth(self._c, self._gamma, order_book_x.asks, order_book_y.bids, "bid", self._min_credit("bid"))
+                volume = self._calculate_volume_from_credit(credit, order_book_y.bids[0].volume, "bid", order_book_x.asks[0].price, order_book_y.bids[0].price, available_volume)
+            else:
+                volume = 0
+            # logger.info(f"Seeing credit of {credit} for buying x, selling y")
             if (self._internal_position_y > -self._internal_risk_limit and volume > 0):
                 # Insert Bid on X, Hedge with Ask on Y
                 # logger.info(f"when selling {self.stock_y_id} and buying {self.stock_x_id}, y_t = {y_t} x_t = {x_t}, z_t = {z_t}. Credit is {credit}")
-                self._buy_x_sell_y(order_book_x, order_book_y, volume)
+                token = self._begin_trace(order_book_x, order_book_y)
+                self._buy_x_sell_y(order_book_x, order_book_y, volume, price_x, price_y)
+                if token is not None: tracer.end(token)
 
                 # it's likely market has since moved, so get price books again
                 order_book_x = self._at.get_order_book(self.stock_x_id)
                 order_book_y = self._at.get_order_book(self.stock_y_id)
 
-        if len(order_book_y.asks) > 0 and len(order_book_x.bids) > 0:
-            y_t = log(order_book_y.asks[0].price)
-            x_t = log(order_book_x.bids[0].price)
-            #z_t = y_t - self._c - self._gamma * x_t
-            implied_y_t = self._c + self._gamma * x_t
-            implied_Y = exp(implied_y_t)
-            credit = implied_Y - order_book_y.asks[0].price
-            volume = self._calculate_volume_from_credit(credit, order_book_y.asks[0].volume, "ask", order_book_x.bids[0].price, order_book_y.asks[0].price)
-            # logger.info(f"z_t for selling x, buying y: {z_t}. Seeing credit of {credit}")
+        if len(order_book_y.asks) > 0 and len(order_book_x.bids) > 0 and (
+                signals is None or not signals.is_quiet(self._signal_index, "ask", order_book_x, order_book_y)):
+            credit = self._ask_credit.credit(order_book_x.bids[0].price, order_book_y.asks[0].price)
+            price_x, price_y = order_book_x.bids[0].price, order_book_y.asks[0].price
+            if credit > self._min_credit("ask"):
+                available_volume = None
+                if self._depth_sizing:
+                    available_volume, price_x, price_y = sweep_depth(self._c, self._gamma, order_book_x.bids, order_book_y.asks, "ask", self._min_credit("ask"))
+                volume = self._calculate_volume_from_credit(credit, order_book_y.asks[0].volume, "ask", order_book_x.bids[0].price, order_book_y.asks[0].price, available_volume)
+            else:
+                volume = 0
+            # logger.info(f"Seeing credit of {credit} for selling x, buying y")
             if (self._internal_position_y < self._internal_risk_limit and volume > 0):
                 # Insert Ask on X, Hedge with Bid on Y
                 # logger.info(f"when buying {self.stock_y_id} and selling {self.stock_x_id}, y_t = {y_t} x_t = {x_t}, z_t = {z_t}. Credit is {credit}")
-                self._sell_x_buy_y(order_book_x, order_book_y, volume)
+                token = self._begin_trace(order_book_x, order_book_y)
+                self._sell_x_buy_y(order_book_x, order_book_y, volume, price_x, price_y)
+                if token is not None: tracer.end(token)
+
+    def _update_model(self):
+        self._model_version = self._recalibrator.version
+        params = self._recalibrator.get_parameters(self.stock_y_id, self.stock_x_id)
+        if params is None or (params.c == self._c and params.gamma == self._gamma):
+            return
+        logger.info(f"Recalibrated pair Y:{self.stock_y_id}, X:{self.stock_x_id} (version {params.version}): c {self._c} -> {params.c}, gamma {self._gamma} -> {params.gamma}")
+        self._c, self._gamma = params.c, params.gamma
+        # Credits cached for the old parameters are no longer valid
+        self._bid_credit = CreditCache(self._c, self._gamma, "bid")
+        self._ask_credit = CreditCache(self._c, self._gamma, "ask")
+        if self._signals is not None:
+            self._signals.set_parameters(self._signal_index, self._c, self._gamma)
+
+        # The hedge ratio changed, so the hedge we are missing did as well
+        order_book_x = self._at.get_order_book(self.stock_x_id)
+        order_book_y = self._at.get_order_book(self.stock_y_id)
+        basket_equivalent = self._basket_equivalent(order_book_y)
+        if len(order_book_x.asks) and len(order_book_y.bids) and basket_equivalent is not None:
+            correct_position_y = self._calculate_hedge_amount(order_book_x.asks[0].price, order_book_y.bids[0].price, self._internal_position_x)
+            self._missing_hedge = correct_position_y - basket_equivalent - self._internal_position_y
+
+    def _begin_trace(self, order_book_x, order_book_y):
+        # The decision is driven by whichever of the two books arrived last
+        if not tracer.enabled:
+            return None
+        return tracer.begin(self._trace_label, max(order_book_x.received_ns, order_book_y.received_ns))
+
+    def _min_credit(self, x_side: str) -> float:
+        # Lowest credit for which _calculate_volume_from_credit can return a non-zero volume.
+        # Any credit at or below this is skipped without sizing the trade.
+        if (
+            (x_side == "bid" and self._internal_position_y > 0) or
+            (x_side == "ask" and self._internal_position_y < 0)
+        ) and self.exit_position_negative:
+            return min(self.required_credit, -self.required_credit + .2)
+        return self.required_credit
 
     def _calculate_hedge_amount(self, price_x: float, price_y: float, quantity_x: int) -> int:
         return round((self._gamma * price_x / price_y) * -quantity_x)
 
     def _sanity_check(self):
-        if self._at.get_position(self.stock_x_id) != self._internal_position_x:
-            logger.error(f"Actual {self.stock_x_id} position is {self._at.get_position(self.stock_x_id)}, not self.internal_position_x {self._internal_position_x}")
+        if self._get_position(self.stock_x_id) != self._internal_position_x:
+            logger.error(f"Actual {self.stock_x_id} position is {self._get_position(self.stock_x_id)}, not self.internal_position_x {self._internal_position_x}")
             exit(1)
-        if self._at.get_position(self.stock_y_id) != self._internal_position_y:
-            logger.error(f"Actual Y position is {self._at.get_position(self.stock_y_id)}, not self.internal_position_y {self._internal_position_y}")
+        if self._get_position(self.stock_y_id) != self._internal_position_y:
+            logger.error(f"Actual Y position is {self._get_position(self.stock_y_id)}, not self.internal_position_y {self._internal_position_y}")
             exit(1)
 
         # Check for proper missing hedge count
@@ -182,15 +488,18 @@ class Pair_Trader:
         order_book_y = self._at.get_order_book(self.stock_y_id)
         if not len(order_book_x.asks) or not len(order_book_y.bids): return
 
-        correct_position_y = self._calculate_hedge_amount(order_book_x.asks[0].price, order_book_y.bids[0].price, self._internal_position_x)
+        basket_equivalent = self._basket_equivalent(order_book_y)
+        if basket_equivalent is None: return
+        correct_position_y = self._calculate_hedge_amount(order_book_x.asks[0].price, order_book_y.bids[0].price, self._internal_position_x) - basket_equivalent
         if (self._missing_hedge > correct_position_y - self._internal_position_y + 3) or (self._missing_hedge < correct_position_y - self._internal_position_y - 3):
             logger.error(f"Missing hedge is {self._missing_hedge}, but the two positions are X({self.stock_x_id}): {self._internal_position_x}, Y({self.stock_y_id}): {self._internal_position_y}. Calculated missing hedge is {correct_position_y - self._internal_position_y}")
             # exit(1)
         self._missing_hedge = correct_position_y - self._internal_position_y
         logger.debug("Passed sanity check.")
 
-    def _calculate_volume_from_credit(self, credit: float, hedge_volume: int, x_side: str, price_x: float, price_y: float) -> int:
-        available_volume = int(self._gamma * price_y / price_x * hedge_volume)  # Truncate not round just to be safe
+    def _calculate_volume_from_credit(self, credit: float, hedge_volume: int, x_side: str, price_x: float, price_y: float, available_volume: int = None) -> int:
+        if available_volume is None:
+            available_volume = int(self._gamma * price_y / price_x * hedge_volume)  # Truncate not round just to be safe
 
         if (
             (x_side == "bid" and self._internal_position_y > 0) or
@@ -224,12 +533,12 @@ class Pair_Trader:
 
         return 0
 
-    def _buy_x_sell_y(self, order_book_x, order_book_y, volume):
+    def _buy_x_sell_y(self, order_book_x, order_book_y, volume, price_x: float, price_y: float):
         #insert bid on total
-        self._at.insert_order(self.stock_x_id, price=order_book_x.asks[0].price, volume=volume, side="bid", order_type="ioc")
+        self._at.insert_order(self.stock_x_id, price=price_x, volume=volume, side="bid", order_type="ioc")
 
         # look at how much total we got
-        post_trade_position_x = self._at.get_position(self.stock_x_id)
+        post_trade_position_x = self._get_position(self.stock_x_id)
         change_in_position = post_trade_position_x - self._internal_position_x
         self._internal_position_x = post_trade_position_x
 
@@ -237,15 +546,20 @@ class Pair_Trader:
         if change_in_position != 0:
             # calculate ratio based on gamma * Y_t/X_t. i.e. for every 1 lot in X you want to hedge with 'ratio' lots of Y
             volume_to_hedge = self._calculate_hedge_amount(order_book_x.asks[0].price, order_book_y.bids[0].price, -change_in_position) #round((self._unilever_total_gamma * price_bookY.bids[0].price / price_bookX.asks[0].price) * change_in_position)
+            if self._netter is not None:
+                self._missing_hedge -= volume_to_hedge
+                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {price_x}, netting hedge. Missing hedge is now {self._missing_hedge}")
+                return
+            self._stop_working_hedge()
             hedge_to_issue = volume_to_hedge - self._missing_hedge #volume_to_hedge = 16, missing_hedge = -32, want to hedge -16
             if hedge_to_issue > 0:
                 # insert ask on unilever
-                self._at.insert_order(self.stock_y_id, price=order_book_y.bids[0].price, volume=hedge_to_issue, side="ask", order_type=self._hedge_type)
-                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {order_book_x.asks[0].price}")
-                logger.info(f"We are trying to hedge {hedge_to_issue} by selling on {self.stock_y_id} at price {order_book_y.bids[0].price}. Missing_hedge is currently {self._missing_hedge}")
+                hedge_order_id = self._at.insert_order(self.stock_y_id, price=price_y, volume=hedge_to_issue, side="ask", order_type=self._hedge_type)
+                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {price_x}")
+                logger.info(f"We are trying to hedge {hedge_to_issue} by selling on {self.stock_y_id} at price {price_y}. Missing_hedge is currently {self._missing_hedge}")
                 self._missing_hedge = 0
                 # look at how much y we got, wait for ioc trade
-                post_trade_position_y = self._at.get_position(self.stock_y_id)
+                post_trade_position_y = self._get_position(self.stock_y_id)
                 change_in_position = post_trade_position_y - self._internal_position_y
                 logger.info(f"Change in position from selling {self.stock_y_id} is {change_in_position}")
                 self._internal_position_y = post_trade_position_y
@@ -253,20 +567,22 @@ class Pair_Trader:
                 # handle missed hedge at a later time
                 if self._missing_hedge: 
                     logger.warning(f"We missed some hedge. Still need to hedge {self._missing_hedge} on {self.stock_y_id}")
-                    self._limit_order_out = (self._hedge_type == "limit")
-                    self._hedge_timer = HEDGE_TIMER_RESET
+                    if self._hedge_type == "limit":
+                        self._hedger.start(hedge_order_id, "ask", price_y)
+                    if self._basket is not None:
+                        self._hedge_basket()
             else:
-                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {order_book_x.asks[0].price}")
+                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {price_x}")
                 logger.info(f"Avoided hedging on {self.stock_y_id} when it would be ill-advised.")
                 logger.info(f"Missing hedge is {self._missing_hedge}, volume to hedge is {volume_to_hedge}. Setting new missing hedge to {-hedge_to_issue}")
                 self._missing_hedge = -hedge_to_issue
         else:
-            logger.info(f"Inserted IOC bid on {self.stock_x_id} at price {order_book_x.asks[0].price} for quantity {6} but missed")
+            logger.info(f"Inserted IOC bid on {self.stock_x_id} at price {price_x} for quantity {6} but missed")
 
-    def _sell_x_buy_y(self, order_book_x, order_book_y, volume):
-        self._at.insert_order(self.stock_x_id, price=order_book_x.bids[0].price, volume=volume, side="ask", order_type="ioc")
+    def _sell_x_buy_y(self, order_book_x, order_book_y, volume, price_x: float, price_y: float):
+        self._at.insert_order(self.stock_x_id, price=price_x, volume=volume, side="ask", order_type="ioc")
         # look at how much total we got
-        post_trade_position_x = self._at.get_position(self.stock_x_id)
+        post_trade_position_x = self._get_position(self.stock_x_id)
         change_in_position = post_trade_position_x - self._internal_position_x
         self._internal_position_x = post_trade_position_x
 
@@ -274,15 +590,20 @@ class Pair_Trader:
         if change_in_position != 0:
             # calculate ratio based on gamma * Y_t/X_t. i.e. for every 1 lot in X you want to hedge with 'ratio' lots of Y
             volume_to_hedge = self._calculate_hedge_amount(order_book_x.bids[0].price, order_book_y.asks[0].price, change_in_position)
+            if self._netter is not None:
+                self._missing_hedge += volume_to_hedge
+                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {price_x}, netting hedge. Missing hedge is now {self._missing_hedge}")
+                return
+            self._stop_working_hedge()
             hedge_to_issue = volume_to_hedge + self._missing_hedge #volume_to_hedge = 5, missing_hedge = 7, want to hedge 12
             if hedge_to_issue > 0:
                 # insert bid on unilever
-                self._at.insert_order(self.stock_y_id, price=order_book_y.asks[0].price, volume=hedge_to_issue, side="bid", order_type=self._hedge_type)
-                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {order_book_x.bids[0].price}")
-                logger.info(f"We are trying to hedge {hedge_to_issue} by buying on {self.stock_y_id} at price {order_book_y.asks[0].price}. Missing_hedge is currently {self._missing_hedge}")
+                hedge_order_id = self._at.insert_order(self.stock_y_id, price=price_y, volume=hedge_to_issue, side="bid", order_type=self._hedge_type)
+                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {price_x}")
+                logger.info(f"We are trying to hedge {hedge_to_issue} by buying on {self.stock_y_id} at price {price_y}. Missing_hedge is currently {self._missing_hedge}")
                 self._missing_hedge = 0
                 # look at how much unilever we got, wait for ioc trade
-                post_trade_position_y = self._at.get_position(self.stock_y_id)
+                post_trade_position_y = self._get_position(self.stock_y_id)
                 change_in_position = post_trade_position_y - self._internal_position_y
                 logger.info(f"Change in position from buying {self.stock_y_id} is {change_in_position}")
                 self._internal_position_y = post_trade_position_y
@@ -290,15 +611,17 @@ class Pair_Trader:
                 # handle missed hedge at a later time
                 if self._missing_hedge:
                     logger.warning(f"We missed some hedge. Still need to hedge {self._missing_hedge} on {self.stock_y_id}")
-                    self._limit_order_out = (self._hedge_type == "limit")
-                    self._hedge_timer = HEDGE_TIMER_RESET
+                    if self._hedge_type == "limit":
+                        self._hedger.start(hedge_order_id, "bid", price_y)
+                    if self._basket is not None:
+                        self._hedge_basket()
             else:
-                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {order_book_x.bids[0].price}")
+                logger.info(f"We aquired {change_in_position} new {self.stock_x_id} for the price of {price_x}")
                 logger.info(f"Avoided hedging on {self.stock_y_id} when it would be ill-advised.")
                 logger.info(f"Missing hedge is {self._missing_hedge}, volume to hedge is {volume_to_hedge}. Setting new missing hedge to {-hedge_to_issue}")
                 self._missing_hedge = hedge_to_issue
         else:
-            logger.info(f"Inserted IOC ask on {self.stock_x_id} at price {order_book_x.bids[0].price} for quantity {6} but missed")
+            logger.info(f"Inserted IOC ask on {self.stock_x_id} at price {price_x} for quantity {6} but missed")
 
     def _fill_hedges(self, order_book_y):
         if len(order_book_y.bids) > 0 and self._missing_hedge < 0:
@@ -308,41 +631,76 @@ class Pair_Trader:
             self._at.insert_order(self.stock_y_id, price=order_book_y.asks[0].price, volume=self._missing_hedge, side="bid", order_type="ioc")
             logger.info(f"Filling out our hedge on {self.stock_y_id} by buying y. Inserting bid at {order_book_y.asks[0].price} for missing hedge quantity {self._missing_hedge}")
         
-        post_trade_position_y = self._at.get_position(self.stock_y_id)
+        post_trade_position_y = self._get_position(self.stock_y_id)
         change_in_position = post_trade_position_y - self._internal_position_y
         self._missing_hedge = self._missing_hedge - change_in_position
         self._internal_position_y = post_trade_position_y
         logger.info(f"Change in position from hedge fill is {change_in_position}. Setting new missing hedge to {self._missing_hedge}")
 
-    def _process_limit_hedges(self):
-        self._at.delete_all_orders(self.stock_y_id)
-        post_limit_position_y = self._at.get_position(self.stock_y_id)
+    def _hedge_basket(self):
+        # Hedge what Y's book couldn't take in the basket of substitutes
+        self._update_hedge_fills()
+        order_book_y = self._at.get_order_book(self.stock_y_id)
+        if self._missing_hedge == 0 or not len(order_book_y.bids) or not len(order_book_y.asks):
+            return
+        price_y = (order_book_y.bids[0].price + order_book_y.asks[0].price) / 2
+        order_books = [self._at.get_order_book(instrument_id) for instrument_id in self._basket.instruments]
+        hedged = 0.0
+        for index, side, price, volume in self._basket.solve(self._missing_hedge, price_y, order_books):
+            instrument_id = self._basket.instruments[index]
+            position_before = self._at.get_position(instrument_id)
+            self._at.insert_order(instrument_id, price=price, volume=volume, side=side, order_type="ioc")
+            filled = self._at.get_position(instrument_id) - position_before
+            if filled:
+                self._at.record_basket_fill(instrument_id, filled)
+                hedged += self._basket.record_fill(index, filled, price, price_y)
+                logger.info(f"Basket hedged {self.stock_y_id} with {filled} {instrument_id} at {price}")
+        self._missing_hedge -= round(hedged)
+        logger.info(f"Basket hedge covered {hedged:.1f} {self.stock_y_id}, missing hedge is now {self._missing_hedge}")
+        # A resting Y hedge is still sized for the old missing hedge
+        if self._hedger.is_working():
+            self._process_limit_hedges()
+
+    def _basket_equivalent(self, order_book_y) -> int:
+        # Shares of Y hedged by the basket, None if the basket can't be valued right now
+        if self._basket is None or not self._basket.holdings.any():
+            return 0
+        if not len(order_book_y.bids) or not len(order_book_y.asks):
+            return None
+        mids = []
+        for instrument_id in self._basket.instruments:
+            book = self._at.get_order_book(instrument_id)
+            if not len(book.bids) or not len(book.asks):
+                return None
+            mids.append((book.bids[0].price + book.asks[0].price) / 2)
+        return round(self._basket.y_equivalent(mids, (order_book_y.bids[0].price + order_book_y.asks[0].price) / 2))
+
+    def _update_hedge_fills(self):
+        post_limit_position_y = self._get_position(self.stock_y_id)
         change_in_position = post_limit_position_y - self._internal_position_y
         self._internal_position_y = post_limit_position_y
         self._missing_hedge = self._missing_hedge - change_in_position
+        if change_in_position:
+            logger.info(f"Working hedge on {self.stock_y_id} aquired {change_in_position} shares. Missing hedge is now {self._missing_hedge}")
 
-        logger.info(f"Pulling limit orders from hedge {self.stock_y_id}. Leaving limit out aquired {change_in_position} shares compared to required {self._missing_hedge}")
-        self._limit_order_out = False
-
-        if self._missing_hedge != 0:
-            # Still need to insert IOC for trade
-            order_book_y = self._at.get_order_book(self.stock_y_id)
-
-            if self._missing_hedge < 0:
-                if len(order_book_y.bids) == 0: return # can't hedge w/o price
-                self._at.insert_order(self.stock_y_id, price=order_book_y.bids[0].price, volume=-self._missing_hedge, side="ask", order_type="ioc")
-                logger.info(f"Inserting IOC ask on {self.stock_y_id} to finish filling hedge price {order_book_y.bids[0].price} quantity {self._missing_hedge}")
-            else:
-                if len(order_book_y.asks) == 0: return # can't hedge w/o price
-                self._at.insert_order(self.stock_y_id, price=order_book_y.asks[0].price, volume=self._missing_hedge, side="bid", order_type="ioc")
-                logger.info(f"Inserting IOC bid on {self.stock_y_id} to finish filling hedge price {order_book_y.asks[0].price} quantity {self._missing_hedge}")
-
-            post_limit_position_y = self._at.get_position(self.stock_y_id)
-            change_in_position = post_limit_position_y - self._internal_position_y
-            self._internal_position_y = post_limit_position_y
-            self._missing_hedge = self._missing_hedge - change_in_position
-
-            logger.info(f"IOC hedge on {self.stock_y_id} after incomplete limits yielded {change_in_position} new quanity. Missing hedge is now {self._missing_hedge}")
+    def _process_limit_hedges(self):
+        self._update_hedge_fills()
+        order_book_y = self._at.get_order_book(self.stock_y_id)
+        self._hedger.work(self._missing_hedge, order_book_y)
+        # an IOC or a fill before a delete changes the position right away
+        self._update_hedge_fills()
+        if self._missing_hedge == 0:
+            self._hedger.finish()
+
+    def _stop_working_hedge(self):
+        # A new hedge order nets in the missing hedge, so the resting one has to go first
+        if self._hedger.is_working():
+            self._hedger.cancel()
+            self._update_hedge_fills()
+            self._hedger.finish(record=False)
+
+    def hedge_report(self) -> str:
+        return self._hedger.stats.report(f"Y:{self.stock_y_id} X:{self.stock_x_id}")
 
 # Used to initialize values
 def read_data(timestamps_pckl, stock_values_pckl):
@@ -0,0 +1,122 @@
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger('client')
+
+BASIS_RISK_AVERSION = 50.0 # weight of the residual variance of a substitute against its spread cost
+MIN_R_SQUARED = 0.8 # substitutes explaining less of Y than this are never used
+MAX_ORDER_VOLUME = 499
+
+
+def estimate_hedge_betas(log_stock_values: Dict[str, List[float]], target: str, instruments: List[str]):
+    """
+    Regresses log(target) on the log price of every instrument separately, all in one go.
+    Returns the betas, residual variances and R squared as arrays in the order of instruments.
+    """
+    y = np.asarray(log_stock_values[target], dtype=float)
+    x = np.array([log_stock_values[instrument_id] for instrument_id in instruments], dtype=float)
+    y = y - y.mean()
+    x = x - x.mean(axis=1, keepdims=True)
+    n = len(y)
+    cov = x @ y / n
+    var_x = np.einsum('ij,ij->i', x, x) / n
+    var_y = y @ y / n
+    betas = cov / var_x
+    resid_var = var_y - betas * cov
+    return betas, resid_var, 1 - resid_var / var_y
+
+
+class BasketHedger:
+    """
+    Hedges the part of a Y hedge that Y's own book can't take with IOCs in other instruments that are cointegrated
+    with Y.
+
+    Holding h shares of substitute k hedges h * p_k / (beta_k * p_y) shares of Y. Each substitute costs half its spread
+    plus its basis risk (residual variance) per share of Y hedged, and can take at most its top of book volume. The
+    missing hedge is split over the substitutes by the least squares allocation x_k ~ 1 / cost_k, capped per
+    substitute with the excess handed to the others, and then rounded to whole shares.
+    """
+    def __init__(self, target_id: str, instruments: List[str], log_stock_values: Dict[str, List[float]],
+                 risk_aversion: float = BASIS_RISK_AVERSION, min_r_squared: float = MIN_R_SQUARED,
+                 max_order_volume: int = MAX_ORDER_VOLUME):
+        betas, resid_var, r_squared = estimate_hedge_betas(log_stock_values, target_id, instruments)
+        usable = r_squared >= min_r_squared
+        self.target_id = target_id
+        self.instruments = [instrument_id for instrument_id, use in zip(instruments, usable) if use]
+        self._betas = betas[usable]
+        self._basis_cost = risk_aversion * resid_var[usable]
+        self._max_order_volume = max_order_volume
+        self.holdings = np.zeros(len(self.instruments), dtype=np.int64)
+        for instrument_id, beta, r2 in zip(self.instruments, self._betas, r_squared[usable]):
+            logger.info(f"Basket hedge for {target_id} can use {instrument_id} with beta {beta:.4f}, R squared {r2:.3f}")
+
+    def solve(self, missing_hedge: int, price_y: float, order_books) -> List[Tuple[int, str, float, int]]:
+        """
+        Returns the IOCs (instrument index, side, price, volume) that hedge missing_hedge shares of Y as cheaply as
+        possible against the given books, one per instrument in self.instruments.
+        """
+        n = len(self.instruments)
+        if missing_hedge == 0 or n == 0:
+            return []
+        bid = np.full(n, np.nan)
+        ask = np.full(n, np.nan)
+        bid_volume = np.zeros(n)
+        ask_volume = np.zeros(n)
+        for i, book in enumerate(order_books):
+            if len(book.bids) > 0:
+                bid[i] = book.bids[0].price
+                bid_volume[i] = book.bids[0].volume
+            if len(book.asks) > 0:
+                ask[i] = book.asks[0].price
+                ask_volume[i] = book.asks[0].volume
+
+        # Buying Y is replicated by buying substitutes with a positive beta and selling those with a negative one
+        buy = (self._betas > 0) == (missing_hedge > 0)
+        price = np.where(buy, ask, bid)
+        volume = np.minimum(np.where(buy, ask_volume, bid_volume), self._max_order_volume)
+        # Without both sides there's no mid to value the substitute at
+        mid = (bid + ask) / 2
+        volume[np.isnan(mid)] = 0
+        mid = np.where(np.isnan(mid), 1.0, mid)
+
+        ratio = np.abs(self._betas) * price_y / mid # shares of substitute per share of Y
+        capacity = volume / ratio
+        cost = (ask - bid) / 2 * ratio / price_y + self._basis_cost
+        weight = np.where(capacity > 0, 1 / np.where(np.isnan(cost), np.inf, cost), 0.0)
+
+        x = self._allocate(abs(missing_hedge), weight, capacity)
+        shares = np.minimum(np.rint(x * ratio), volume).astype(np.int64)
+        return [(int(i), "bid" if buy[i] else "ask", float(price[i]), int(shares[i])) for i in np.flatnonzero(shares)]
+
+    @staticmethod
+    def _allocate(total: float, weight, capacity):
+        # Water filling: allocate proportional to weight, cap what doesn't fit and redistribute the rest
+        x = np.zeros(len(weight))
+        free = weight > 0
+        for _ in range(len(weight)):
+            remaining = total - x.sum()
+            if remaining <= 0 or not free.any():
+                break
+            alloc = np.where(free, remaining * weight / weight[free].sum(), 0.0)
+            full = free & (x + alloc >= capacity)
+            if not full.any():
+                x += alloc
+                break
+            x[full] = capacity[full]
+            free &= ~full
+        return x
+
+    def record_fill(self, index: int, filled: int, price: float, price_y: float) -> float:
+        """
+        Books a fill of the basket and returns how many shares of Y it hedged.
+        """
+        self.holdings[index] += filled
+        return filled * price / (self._betas[index] * price_y)
+
+    def y_equivalent(self, mids, price_y: float) -> float:
+        """
+        Shares of Y the basket currently hedges, valued at the given mids of self.instruments.
+        """
+        return float(np.sum(self.holdings * np.asarray(mids) / (self._betas * price_y)))
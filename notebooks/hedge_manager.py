@@ -0,0 +1,172 @@
+import logging
+from time import monotonic
+
+logger = logging.getLogger('client')
+
+HEDGE_DEADLINE = 1.0 # seconds a hedge may rest passively before we cross the spread with an IOC
+
+
+class HedgeStats:
+    def __init__(self):
+        self._durations = []
+        self._nr_requests = []
+        self._nr_escalated = 0
+        self._nr_iocs = 0
+
+    def record(self, duration: float, nr_requests: int, escalated: bool, nr_iocs: int = 0):
+        self._durations.append(duration)
+        self._nr_requests.append(nr_requests)
+        self._nr_iocs += nr_iocs
+        if escalated:
+            self._nr_escalated += 1
+
+    def _percentile(self, sorted_values, q):
+        return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+    def summary(self):
+        if not self._durations:
+            return {'count': 0}
+        durations = sorted(self._durations)
+        return {
+            'count': len(durations),
+            'p50': self._percentile(durations, 0.5),
+            'p90': self._percentile(durations, 0.9),
+            'p99': self._percentile(durations, 0.99),
+            'max': durations[-1],
+            'mean_requests': sum(self._nr_requests) / len(self._nr_requests),
+            'escalated': self._nr_escalated,
+            'iocs': self._nr_iocs,
+        }
+
+    def report(self, name: str):
+        s = self.summary()
+        if s['count'] == 0:
+            return f"No hedges completed for {name}"
+        return (f"Hedges for {name}: {s['count']} completed, time to complete p50 {s['p50']*1000:.1f}ms p90 {s['p90']*1000:.1f}ms "
+                f"p99 {s['p99']*1000:.1f}ms max {s['max']*1000:.1f}ms, {s['mean_requests']:.2f} order requests per hedge, "
+                f"{s['escalated']} escalated to IOC with {s['iocs']} IOCs")
+
+
+class HedgeManager:
+    """
+    Works the missing hedge of one leg with a single resting limit order.
+
+    The order is left in the book at its price. When the missing hedge changes for another reason than a fill, its
+    volume is amended in place. The exchange can only amend volume, so a side change means delete and insert.
+    The order only counts as gone once its last order update or a successful delete shows it, an order whose first
+    update is still on its way is never inserted a second time.
+    Once the hedge has been outstanding for longer than the deadline, the resting order is pulled and the remainder
+    is crossed with IOCs until it is done, at most one IOC per book of Y: a book that didn't change since the last
+    IOC has nothing more to give.
+    """
+    def __init__(self, autotrader, instrument_id: str, deadline: float = HEDGE_DEADLINE, stats: HedgeStats = None):
+        self._at = autotrader
+        self.instrument_id = instrument_id
+        self._deadline = deadline
+        self.stats = stats if stats is not None else HedgeStats()
+        self._working = False
+        self._order_id = None
+        self._side = None
+        self._price = None
+        self._started_at = 0.0
+        self._nr_requests = 0
+        self._escalated = False
+        self._nr_iocs = 0
+        self._ioc_book = None
+        self._deleted_order_id = None
+
+    def is_working(self) -> bool:
+        return self._working
+
+    def start(self, order_id, side: str, price: float, nr_requests: int = 1):
+        """
+        Takes over a hedge whose first limit order was just inserted. order_id may be None if the order did not make
+        it to the exchange, a new one is then inserted on the next call to work().
+        """
+        self._working = True
+        self._order_id = order_id
+        self._side = side
+        self._price = price
+        self._started_at = monotonic()
+        self._nr_requests = nr_requests
+        self._escalated = False
+        self._nr_iocs = 0
+        self._ioc_book = None
+        self._deleted_order_id = None
+
+    def work(self, missing_hedge: int, order_book):
+        if missing_hedge == 0:
+            self.finish()
+            return
+
+        side = "bid" if missing_hedge > 0 else "ask"
+        volume = abs(missing_hedge)
+        resting = None
+        if self._order_id is not None:
+            # The order index only has the order once its first update is in, until then it is still ours
+            resting = self._at.get_outstanding_order(self._order_id)
+            if resting is None and self._at.is_order_done(self._order_id):
+                self._order_id = None
+            elif side != self._side:
+                self.cancel()
+
+        if monotonic() - self._started_at >= self._deadline:
+            self._escalate(side, volume, order_book)
+            return
+
+        if self._order_id is None:
+            price = self._marketable_price(side, order_book)
+            if price is None: return # can't hedge w/o price
+            self._order_id = self._at.insert_order(self.instrument_id, price=price, volume=volume, side=side, order_type="limit")
+            self._nr_requests += 1
+            self._side = side
+            self._price = price
+            logger.info(f"Resting hedge {side} on {self.instrument_id} at {price} for {volume}")
+        elif resting is not None and side == self._side and resting.volume != volume:
+            self._at.amend_order(self.instrument_id, order_id=self._order_id, volume=volume)
+            self._nr_requests += 1
+            logger.info(f"Amended resting hedge on {self.instrument_id} from {resting.volume} to {volume}")
+
+    def _escalate(self, side: str, volume: int, order_book):
+        if self._order_id is not None:
+            self.cancel()
+            # The order may have (partially) filled before the delete, let the caller recompute the missing hedge first
+            return
+        # An unchanged book is the same object, the last IOC already took what it had
+        if order_book is self._ioc_book:
+            return
+        price = self._marketable_price(side, order_book)
+        if price is None: return # can't hedge w/o price
+        if not self._escalated:
+            logger.info(f"Hedge on {self.instrument_id} outstanding for more than {self._deadline}s, crossing with IOC")
+        self._escalated = True
+        self._ioc_book = order_book
+        self._at.insert_order(self.instrument_id, price=price, volume=volume, side=side, order_type="ioc")
+        self._nr_requests += 1
+        self._nr_iocs += 1
+
+    def _marketable_price(self, side: str, order_book):
+        if side == "bid":
+            return order_book.asks[0].price if len(order_book.asks) > 0 else None
+        return order_book.bids[0].price if len(order_book.bids) > 0 else None
+
+    def cancel(self):
+        # A failed delete means the order already traded, it is done once its last order update is in
+        if self._order_id is not None and self._order_id != self._deleted_order_id:
+            self._deleted_order_id = self._order_id
+            self._nr_requests += 1
+            if self._at.delete_order(self.instrument_id, order_id=self._order_id):
+                self._order_id = None
+
+    def finish(self, record: bool = True):
+        """
+        Stops working the hedge. Pass record=False when the remainder is taken over by a new hedge instead of being done.
+        """
+        if not self._working:
+            return
+        if self._order_id is not None and not self._at.is_order_done(self._order_id):
+            self.cancel()
+        if record:
+            self.stats.record(monotonic() - self._started_at, self._nr_requests, self._escalated, self._nr_iocs)
+        self._working = False
+        self._order_id = None
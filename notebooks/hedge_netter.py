@@ -0,0 +1,84 @@
+import logging
+from typing import List
+
+logger = logging.getLogger('client')
+
+
+def allocate_netted_fill(deltas: List[int], filled: int) -> List[int]:
+    """
+    Splits the outcome of one net hedge order over the hedges it was netted from.
+
+    Hedges against the net direction are crossed with the others internally and get their full delta. The hedges in
+    the net direction share what was crossed plus what the exchange filled, pro rata to their delta. Shares left over
+    after rounding down go to the largest remainders, so the allocations add up to the position change exactly.
+    """
+    net = sum(deltas)
+    if net == 0:
+        return list(deltas)
+    sign = 1 if net > 0 else -1
+    allocations = [0 if delta * sign > 0 else delta for delta in deltas]
+    wanted = [abs(delta) if delta * sign > 0 else 0 for delta in deltas]
+    total_wanted = sum(wanted)
+    # Everything crossed internally plus the fill, capped at what was asked for
+    obtained = min(total_wanted, total_wanted - abs(net) + abs(filled))
+    shares = [w * obtained // total_wanted for w in wanted]
+    left = obtained - sum(shares)
+    by_remainder = sorted((i for i in range(len(deltas)) if wanted[i]), key=lambda i: -(wanted[i] * obtained % total_wanted))
+    for i in by_remainder[:left]:
+        shares[i] += 1
+    for i, share in enumerate(shares):
+        if wanted[i]:
+            allocations[i] = sign * share
+    return allocations
+
+
+class HedgeNetter:
+    """
+    Sends the hedges of all pairs at the end of a cycle, one net IOC per instrument.
+
+    Pairs in netting mode only add to their missing hedge when they trade X. Once all pairs had their iteration, run()
+    adds up the missing hedges of all pairs hedging on the same instrument and crosses the net with a single IOC. The
+    fill is allocated back to the pairs with allocate_netted_fill(), pairs hedging in opposite directions are crossed
+    with each other without going to the exchange. Whatever is not filled stays missing and is retried next cycle.
+    """
+    def __init__(self, autotrader):
+        self._at = autotrader
+        self._pairs_by_instrument = {}
+        self.nr_hedges = 0
+        self.nr_orders = 0
+
+    def add_pair(self, pair) -> None:
+        self._pairs_by_instrument.setdefault(pair.stock_y_id, []).append(pair)
+
+    def run(self) -> None:
+        for instrument_id, pairs in self._pairs_by_instrument.items():
+            pairs = [pair for pair in pairs if pair.get_missing_hedge() != 0]
+            if not pairs:
+                continue
+            deltas = [pair.get_missing_hedge() for pair in pairs]
+            net = sum(deltas)
+            filled = 0
+            if net != 0:
+                filled = self._send(instrument_id, net)
+            self.nr_hedges += len(pairs)
+            for pair, volume in zip(pairs, allocate_netted_fill(deltas, filled)):
+                if volume:
+                    pair.on_netted_hedge(volume)
+            for pair in pairs:
+                pair.hedge_remainder_in_basket()
+
+    def _send(self, instrument_id: str, net: int) -> int:
+        order_book = self._at.get_order_book(instrument_id)
+        side = "bid" if net > 0 else "ask"
+        levels = order_book.asks if side == "bid" else order_book.bids
+        if not len(levels):
+            return 0
+        position_before = self._at.get_position(instrument_id)
+        self._at.insert_order(instrument_id, price=levels[0].price, volume=abs(net), side=side, order_type="ioc")
+        self.nr_orders += 1
+        filled = self._at.get_position(instrument_id) - position_before
+        logger.info(f"Net hedge {side} {abs(net)} {instrument_id} at {levels[0].price}, filled {filled}")
+        return filled
+
+    def report(self) -> str:
+        return f"Hedge netting sent {self.nr_orders} orders for {self.nr_hedges} pair hedges"
@@ -0,0 +1,116 @@
+import logging
+import multiprocessing
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from math import log
+from typing import Callable, Dict, List, Tuple
+
+from statsmodels.tsa.stattools import adfuller
+
+from cointegration_analysis import estimate_long_run_short_run_relationships
+
+logger = logging.getLogger('client')
+
+SAMPLE_INTERVAL = 1.0 # seconds between mid price samples
+REFIT_INTERVAL = 300.0 # seconds between refits
+MIN_SAMPLES = 600
+MAX_SAMPLES = 5000
+MAX_PVALUE = 0.01 # only publish a refit if the residuals are clearly stationary
+
+ModelParameters = namedtuple('ModelParameters', ['c', 'gamma', 'pvalue', 'version'])
+
+
+def fit_pair(log_y: List[float], log_x: List[float]) -> Tuple[float, float, float]:
+    # Runs in the worker process. The Engle-Granger test of engle_granger_two_step_cointegration_test on the residuals
+    # of this fit, without fitting the long-run relationship a second time.
+    c, gamma, _, z = estimate_long_run_short_run_relationships(log_y, log_x)
+    _, pvalue, _, _, _ = adfuller(z, maxlag=1, autolag=None)
+    return float(c), float(gamma), float(pvalue)
+
+
+class Recalibrator:
+    """
+    Refits the cointegration model of a set of pairs on live mid prices, away from the trading thread.
+
+    A sampler thread records the log mid of every instrument at a fixed interval, so all series are aligned. Every
+    refit interval the pairs are refitted in a separate process, so the fit never holds the GIL of the trading process.
+    A refit is only published if the Engle-Granger test on it still shows cointegration.
+
+    Published parameters are immutable and replaced with a single assignment, and the version attribute is bumped
+    afterwards. A trader only has to compare version with the last one it saw to know whether to pick up new parameters.
+    """
+    def __init__(self, get_order_book: Callable, pairs: List[Tuple[str, str]], sample_interval: float = SAMPLE_INTERVAL,
+                 refit_interval: float = REFIT_INTERVAL, min_samples: int = MIN_SAMPLES, max_samples: int = MAX_SAMPLES,
+                 max_pvalue: float = MAX_PVALUE):
+        self._get_order_book = get_order_book
+        self._pairs = list(pairs)
+        self._instruments = sorted({instrument_id for pair in self._pairs for instrument_id in pair})
+        self._sample_interval = sample_interval
+        self._refit_interval = refit_interval
+        self._min_samples = min_samples
+        self._max_pvalue = max_pvalue
+        self._samples = {instrument_id: deque(maxlen=max_samples) for instrument_id in self._instruments}
+        self._parameters: Dict[Tuple[str, str], ModelParameters] = {}
+        self.version = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._pool = None
+
+    def get_parameters(self, stock_y_id: str, stock_x_id: str) -> ModelParameters:
+        return self._parameters.get((stock_y_id, stock_x_id))
+
+    def start(self):
+        # Forking copies the locks held by the loop, trading and journal threads at that moment, the worker could
+        # deadlock on them. A spawned worker starts from a fresh interpreter.
+        self._pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        self._thread = threading.Thread(target=self._run, name='recalibrate', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    def _run(self):
+        samples_since_fit = 0
+        samples_per_refit = max(1, int(self._refit_interval / self._sample_interval))
+        while not self._stop.wait(self._sample_interval):
+            if self._sample():
+                samples_since_fit += 1
+            if samples_since_fit >= samples_per_refit:
+                samples_since_fit = 0
+                try:
+                    self._refit()
+                except Exception as e:
+                    logger.error(f"Recalibration failed: {e!r}")
+
+    def _sample(self) -> bool:
+        mids = {}
+        for instrument_id in self._instruments:
+            book = self._get_order_book(instrument_id)
+            if book is None or len(book.bids) == 0 or len(book.asks) == 0:
+                # Skip the sample for all instruments to keep the series aligned
+                return False
+            mids[instrument_id] = log((book.bids[0].price + book.asks[0].price) / 2)
+        for instrument_id, mid in mids.items():
+            self._samples[instrument_id].append(mid)
+        return True
+
+    def _refit(self):
+        nr_samples = len(self._samples[self._instruments[0]])
+        if nr_samples < self._min_samples:
+            logger.info(f"Not recalibrating yet, {nr_samples} of {self._min_samples} samples collected")
+            return
+
+        futures = {pair: self._pool.submit(fit_pair, list(self._samples[pair[0]]), list(self._samples[pair[1]])) for pair in self._pairs}
+        for (stock_y_id, stock_x_id), future in futures.items():
+            c, gamma, pvalue = future.result()
+            if pvalue > self._max_pvalue:
+                logger.warning(f"Not publishing refit for Y:{stock_y_id} X:{stock_x_id}, residuals not stationary (p-value {pvalue:.4f})")
+                continue
+            self._parameters[(stock_y_id, stock_x_id)] = ModelParameters(c, gamma, pvalue, self.version + 1)
+            self.version += 1
+            logger.info(f"Published refit for Y:{stock_y_id} X:{stock_x_id}: c {c}, gamma {gamma}, p-value {pvalue:.4f}")
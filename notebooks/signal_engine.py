@@ -0,0 +1,143 @@
+import logging
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger('client')
+
+SIDE_BID = "bid"
+SIDE_ASK = "ask"
+# numpy's log/exp may differ from math's in the last bit, candidates this close to their threshold are kept
+THRESHOLD_MARGIN = 1e-9
+
+
+def sweep_depth(c: float, gamma: float, x_levels, y_levels, x_side: str, threshold: float) -> Tuple[int, float, float]:
+    """
+    Largest volume of X for which the marginal credit, taking X and its hedge in Y through the levels of both books,
+    is still above threshold. Returns the volume and the prices of the deepest X and Y levels needed for it, a volume
+    of 0 if not even the first lot makes it.
+
+    x_levels and y_levels are the levels the trade takes: the X asks and Y bids for x_side bid, the X bids and Y asks
+    for x_side ask. The hedge takes gamma * p_x / p_y lots of Y per lot of X at the top of book, like the pair does.
+    """
+    book_x = np.array([(level.price, level.volume) for level in x_levels], dtype=float)
+    book_y = np.array([(level.price, level.volume) for level in y_levels], dtype=float)
+    price_x = book_x[:, 0]
+    price_y = book_y[:, 0]
+    ratio = gamma * price_x[0] / price_y[0]
+    # Volume of X up to and including each level, for Y the volume of X it hedges, truncated to be safe
+    depth_x = np.cumsum(book_x[:, 1])
+    depth_y = np.floor(np.cumsum(book_y[:, 1]) / ratio)
+    # The marginal prices only change at these volumes, the credit is the same on the way to each of them
+    breaks = np.sort(np.concatenate((depth_x, depth_y)))
+    breaks = breaks[(breaks > 0) & (breaks <= min(depth_x[-1], depth_y[-1]))]
+    if not len(breaks):
+        return 0, float(price_x[0]), float(price_y[0])
+    index_x = np.searchsorted(depth_x, breaks)
+    index_y = np.searchsorted(depth_y, breaks)
+    implied_y = np.exp(c + gamma * np.log(price_x[index_x]))
+    credit = price_y[index_y] - implied_y if x_side == SIDE_BID else implied_y - price_y[index_y]
+    # Deeper levels only get worse on both sides, so the credit never goes up along the breaks and the profitable
+    # ones come first
+    nr_profitable = np.count_nonzero(credit > threshold)
+    if nr_profitable == 0:
+        return 0, float(price_x[0]), float(price_y[0])
+    last = nr_profitable - 1
+    return int(breaks[last]), float(price_x[index_x[last]]), float(price_y[index_y[last]])
+
+
+class PairSignalEngine:
+    """
+    Credits of all pairs in both directions, from one vectorized pass over the tops of book of all instruments.
+
+    The tops of book live in arrays indexed by instrument, the pairs are index arrays into them. refresh() reads
+    every instrument's book once, however many pairs share it, and recomputes all credits only if a book changed.
+    The result is the set of pairs per direction whose credit is above their threshold. Pairs use it as a filter
+    and still compute the exact credit of a candidate themselves, so decisions are the same as without the engine.
+    """
+    def __init__(self, get_order_book: Callable):
+        self._get_order_book = get_order_book
+        self._instruments = {}
+        self._books = []
+        self._bid = np.empty(0)
+        self._ask = np.empty(0)
+        self._x = np.empty(0, dtype=np.intp)
+        self._y = np.empty(0, dtype=np.intp)
+        self._c = np.empty(0)
+        self._gamma = np.empty(0)
+        self._threshold = np.empty(0)
+        self._legs = []
+        self._dirty = True
+        self.bid_candidates = set()
+        self.ask_candidates = set()
+
+    def _instrument_index(self, instrument_id: str) -> int:
+        index = self._instruments.get(instrument_id)
+        if index is None:
+            index = len(self._instruments)
+            self._instruments[instrument_id] = index
+            self._books.append(None)
+            self._bid = np.append(self._bid, np.nan)
+            self._ask = np.append(self._ask, np.nan)
+        return index
+
+    def add_pair(self, stock_y_id: str, stock_x_id: str, c: float, gamma: float, threshold: float) -> int:
+        """
+        Returns the index of the pair in bid_candidates and ask_candidates.
+        """
+        self._legs.append((self._instrument_index(stock_x_id), self._instrument_index(stock_y_id)))
+        self._x = np.append(self._x, self._legs[-1][0])
+        self._y = np.append(self._y, self._legs[-1][1])
+        self._c = np.append(self._c, c)
+        self._gamma = np.append(self._gamma, gamma)
+        self._threshold = np.append(self._threshold, threshold - THRESHOLD_MARGIN)
+        self._dirty = True
+        return len(self._c) - 1
+
+    def set_parameters(self, pair: int, c: float, gamma: float) -> None:
+        self._c[pair] = c
+        self._gamma[pair] = gamma
+        self._dirty = True
+
+    def is_quiet(self, pair: int, x_side: str, order_book_x, order_book_y) -> bool:
+        """
+        True if the last refresh() saw exactly these books and found no opportunity for the pair on x_side.
+        False whenever a book or the parameters changed since, the pair then has to compute the credit itself.
+        """
+        x_index, y_index = self._legs[pair]
+        if self._dirty or order_book_x is not self._books[x_index] or order_book_y is not self._books[y_index]:
+            return False
+        return pair not in (self.bid_candidates if x_side == SIDE_BID else self.ask_candidates)
+
+    def refresh(self) -> List[Tuple[int, str, float]]:
+        """
+        Reads the latest books and returns the candidates as (pair, side, credit), side being the side of X.
+        Returns an empty list without computing anything if no book changed.
+        """
+        get_order_book = self._get_order_book
+        bid = self._bid
+        ask = self._ask
+        changed = self._dirty
+        for instrument_id, index in self._instruments.items():
+            book = get_order_book(instrument_id)
+            # An unchanged book is the same object, snapshots are only replaced when a new one arrives
+            if book is self._books[index]:
+                continue
+            self._books[index] = book
+            changed = True
+            bid[index] = book.bids[0].price if book is not None and book.bids else np.nan
+            ask[index] = book.asks[0].price if book is not None and book.asks else np.nan
+        if not changed:
+            return []
+        self._dirty = False
+
+        with np.errstate(invalid='ignore'):
+            # Buying X at the ask, selling Y at the bid
+            bid_credit = bid[self._y] - np.exp(self._c + self._gamma * np.log(ask[self._x]))
+            # Selling X at the bid, buying Y at the ask
+            ask_credit = np.exp(self._c + self._gamma * np.log(bid[self._x])) - ask[self._y]
+            bid_pairs = np.flatnonzero(bid_credit > self._threshold).tolist()
+            ask_pairs = np.flatnonzero(ask_credit > self._threshold).tolist()
+        self.bid_candidates = set(bid_pairs)
+        self.ask_candidates = set(ask_pairs)
+        return [(pair, SIDE_BID, bid_credit[pair]) for pair in bid_pairs] + [(pair, SIDE_ASK, ask_credit[pair]) for pair in ask_pairs]
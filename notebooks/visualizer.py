@@ -0,0 +1,174 @@
+"""
+Terminal order book visualizer for several instruments at once.
+
+Runs in its own process with its own info connection, so it never competes with the trading process. Each frame
+polls the latest book and new trade ticks per instrument, keeps recent ticks in a time-indexed deque and only
+redraws the rows that changed since the previous frame.
+
+    python visualizer.py --host chi-tech-starters.optibook.net --hz 50 AIRBUS ALLIANZ ASML LVMH
+
+Press q to quit.
+"""
+import argparse
+import curses
+import time
+from collections import deque
+
+from optibook.synchronous_client import InfoOnly
+
+import logging
+logger = logging.getLogger('client')
+logger.setLevel('ERROR')
+
+DEFAULT_INSTRUMENTS = ['AIRBUS', 'ALLIANZ', 'ASML', 'LVMH', 'SAP', 'SIEMENS', 'TOTAL', 'UNILEVER']
+BOOK_LEVELS = 6
+TICK_ROWS = 8
+PANEL_WIDTH = 32
+TICK_MAX_AGE = 20.0
+
+
+class TickWindow:
+    """
+    Trade ticks of the last max_age seconds, oldest first. Expiring only looks at the oldest entries.
+    """
+    def __init__(self, max_age=TICK_MAX_AGE):
+        self._max_age = max_age
+        self._ticks = deque()
+
+    def add(self, now, trade_ticks):
+        for tt in trade_ticks:
+            self._ticks.append((now, tt))
+        return len(trade_ticks) > 0
+
+    def expire(self, now):
+        expired = False
+        while self._ticks and now - self._ticks[0][0] >= self._max_age:
+            self._ticks.popleft()
+            expired = True
+        return expired
+
+    def newest(self, n):
+        return [self._ticks[-i] for i in range(1, min(n, len(self._ticks)) + 1)]
+
+
+class Panel:
+    def __init__(self, instrument_id, top, left):
+        self.instrument_id = instrument_id
+        self._top = top
+        self._left = left
+        self._book = None
+        self._ticks = TickWindow()
+        self._rows = []
+        self._dirty = True
+
+    def update(self, info, now):
+        book = info.get_last_price_book(self.instrument_id)
+        if book is not self._book:
+            self._book = book
+            self._dirty = True
+        if self._ticks.add(now, info.poll_new_trade_ticks(self.instrument_id)):
+            self._dirty = True
+        if self._ticks.expire(now):
+            self._dirty = True
+
+    def _render(self):
+        rows = [f" {self.instrument_id} ".center(PANEL_WIDTH, '=')]
+        book = self._book
+        for level in reversed(range(BOOK_LEVELS)):
+            if book is None or level >= len(book.asks):
+                rows.append('')
+            else:
+                ask = book.asks[level]
+                rows.append(f"        |  {ask.price:8.2f}  |  {ask.volume:5}")
+        rows.append('-' * PANEL_WIDTH if book is not None else 'NO BOOK'.center(PANEL_WIDTH, '-'))
+        for level in range(BOOK_LEVELS):
+            if book is None or level >= len(book.bids):
+                rows.append('')
+            else:
+                bid = book.bids[level]
+                rows.append(f" {bid.volume:5}  |  {bid.price:8.2f}  |")
+        rows.append(f" trades last {TICK_MAX_AGE:.0f}s ".center(PANEL_WIDTH, '-'))
+        newest = self._ticks.newest(TICK_ROWS)
+        for i in range(TICK_ROWS):
+            if i >= len(newest):
+                rows.append('')
+            else:
+                tt = newest[i][1]
+                rows.append(f" {tt.timestamp.strftime('%H:%M:%S')} {tt.volume:5} @ {tt.price:8.2f}")
+        return [r[:PANEL_WIDTH].ljust(PANEL_WIDTH) for r in rows]
+
+    def draw(self, screen):
+        if not self._dirty:
+            return 0
+        rows = self._render()
+        nr_drawn = 0
+        for i, row in enumerate(rows):
+            if i < len(self._rows) and self._rows[i] == row:
+                continue
+            try:
+                screen.addstr(self._top + i, self._left, row)
+            except curses.error:
+                # Panel does not fit in the terminal, skip the row
+                pass
+            nr_drawn += 1
+        self._rows = rows
+        self._dirty = False
+        return nr_drawn
+
+    @staticmethod
+    def height():
+        return 1 + 2 * BOOK_LEVELS + 1 + 1 + TICK_ROWS
+
+
+def run(screen, info, instruments, hz):
+    curses.curs_set(0)
+    screen.nodelay(True)
+    rows, cols = screen.getmaxyx()
+    per_row = max(1, cols // (PANEL_WIDTH + 2))
+    panels = [Panel(instrument_id, (i // per_row) * (Panel.height() + 1), (i % per_row) * (PANEL_WIDTH + 2))
+              for i, instrument_id in enumerate(instruments)]
+
+    frame_time = 1.0 / hz
+    frames = 0
+    started = time.monotonic()
+    next_frame = started
+    while info.is_connected():
+        now = time.monotonic()
+        nr_drawn = 0
+        for panel in panels:
+            panel.update(info, now)
+            nr_drawn += panel.draw(screen)
+
+        frames += 1
+        status = f" {frames / max(now - started, 1e-9):6.1f} fps  q to quit "
+        try:
+            screen.addstr(rows - 1, 0, status[:cols - 1])
+        except curses.error:
+            pass
+        screen.refresh()
+
+        if screen.getch() == ord('q'):
+            break
+
+        next_frame += frame_time
+        sleep_for = next_frame - time.monotonic()
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+        else:
+            # Fell behind, don't try to catch up with a burst of frames
+            next_frame = time.monotonic()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Terminal order book visualizer')
+    parser.add_argument('instruments', nargs='*', default=DEFAULT_INSTRUMENTS)
+    parser.add_argument('--host', default='chi-tech-starters.optibook.net')
+    parser.add_argument('--hz', type=float, default=50.0, help='Maximum refresh rate')
+    args = parser.parse_args()
+
+    info = InfoOnly(host=args.host)
+    info.connect()
+    try:
+        curses.wrapper(run, info, args.instruments, args.hz)
+    finally:
+        info.disconnect()
@@ -7,5 +7,11 @@ from .exchange_client import InfoClient, ExecClient
 from .management_client import ManagementClient
 
 from .exchange_client import ORDER_TYPE_IOC, ORDER_TYPE_LIMIT, SIDE_ASK, SIDE_BID
+from .risk import RiskLimitBreached
+from .instruments import InstrumentNotTradable
+from .market_stats import MarketStats
+from .journal import FillJournal
+from .shared_risk import SharedRiskBook
+from .runtime import RuntimeProfile
 from .management_client import ACTION_BUY, ACTION_SELL
 from .greeks_calculator import *
@@ -3,6 +3,7 @@ import logging
 import typing
 import traceback
 import socket
+import time
 import capnp
 from .idl import common_capnp
 
@@ -13,8 +14,44 @@ logger = logging.getLogger('client')
 
 TIMEOUT_VAL = 2
 
+STATE_CONNECTING = 'connecting'
+STATE_CONNECTED = 'connected'
+# Only some of the connections of a client are up
+STATE_DEGRADED = 'degraded'
+STATE_CLOSED = 'closed'
+ALL_STATES = [STATE_CONNECTING, STATE_CONNECTED, STATE_DEGRADED, STATE_CLOSED]
 
-class Client:
+
+class ConnectionState:
+    """
+    Connection state kept up to date from the connect, disconnect and reader events, so that checking it is an
+    attribute read.
+    """
+    _state = STATE_CLOSED
+    _state_callback = None
+
+    def get_state(self):
+        return self._state
+
+    def is_connected(self):
+        return self._state == STATE_CONNECTED
+
+    def set_state_callback(self, f):
+        """
+        Sets f(client, state) to be called on the event loop whenever the state changes.
+        """
+        self._state_callback = f
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+        logger.debug(f"{type(self).__name__} {self._state} -> {state}")
+        self._state = state
+        if self._state_callback is not None:
+            self._state_callback(self, state)
+
+
+class Client(ConnectionState):
     def __init__(self, host, port):
         self._host = host
         self._port = port
@@ -24,7 +61,6 @@ class Client:
         self._task = None
         self._socket = None
         self._client = None
-        self._connected = False
         self._dcp = None
 
     async def connect(self, loop=None):
@@ -33,41 +69,49 @@ class Client:
         if self.is_connected():
             raise Exception("already connected")
         self.reset_data()
+        self._set_state(STATE_CONNECTING)
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((self._host, self._port))
-        self._client = capnp.TwoPartyClient(self._socket)
-        self._connected = True
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.connect((self._host, self._port))
+            self._client = capnp.TwoPartyClient(self._socket)
 
-        def on_dc(*args, **kwargs):
-            self._connected = False
+            def on_dc(*args, **kwargs):
+                self._set_state(STATE_CLOSED)
 
-        self._dcp = self._client.on_disconnect().then(on_dc)
+            self._dcp = self._client.on_disconnect().then(on_dc)
 
-        await self._on_connected()
+            await self._on_connected()
+        except:
+            self._set_state(STATE_CLOSED)
+            raise
 
+        self._set_state(STATE_CONNECTED)
         self._task = loop.create_task(self._run())
 
     async def _on_connected(self):
         pass
 
     async def _run(self):
-        while self.is_connected():
-            capnp.poll_once()
-            await asyncio.sleep(0.1)
-
-    def is_connected(self):
-        if self._socket is None:
-            return False
         try:
-            self._socket.getpeername()
-        except OSError:
-            return False
-        return self._connected
+            while self.is_connected():
+                capnp.poll_once()
+                await asyncio.sleep(0.1)
+        finally:
+            self._set_state(STATE_CLOSED)
+
+    async def wait_closed(self):
+        if self._task is not None:
+            await self._task
 
     async def disconnect(self):
-        if self.is_connected():
-            self._socket.shutdown(socket.SHUT_RDWR)
+        self._set_state(STATE_CLOSED)
+        if self._socket is not None and self._socket.fileno() != -1:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # already disconnected by the other side
+                pass
             self._socket.close()
 
         capnp.poll_once()
@@ -76,12 +120,13 @@ class Client:
             await self._task
 
 
-class RawClient:
+class RawClient(ConnectionState):
     def __init__(self, host, port):
         self._host = host
         self._port = port
         self._extra_callbacks_id = 0
         self._extra_callbacks = {}
+        self._last_receive_ns = 0
         self.reset_data()
 
     def reset_data(self):
@@ -95,7 +140,7 @@ class RawClient:
         c_id = self._extra_callbacks_id
         self._extra_callbacks[c_id] = f
         self._extra_callbacks_id += 1
-        return id
+        return c_id
 
     def remove_message_callback(self, c_id):
         del self._extra_callbacks[c_id]
@@ -105,6 +150,7 @@ class RawClient:
         try:
             while not self._writer.transport.is_closing():
                 nr_segments_b = await self._reader.readexactly(4)
+                self._last_receive_ns = time.monotonic_ns()
                 nr_segments = int.from_bytes(nr_segments_b, byteorder='little') + 1
                 bytes_to_read = nr_segments * 4
                 if nr_segments % 2 == 0:
@@ -134,17 +180,22 @@ class RawClient:
         finally:
             self._reader = None
             self._writer = None
+            self._set_state(STATE_CLOSED)
             logger.info('end of reader loop')
 
     async def _on_message(self, msg):
         pass
 
     async def send_request(self, request_id, request):
-        await self.write(request)
-
+        # Registered before writing, the reply can be read while the write is still draining
         f = asyncio.Future()
         self._waiters[request_id] = f
-        return await f
+        try:
+            await self.write(request)
+            return await f
+        finally:
+            # Also when the caller gave up waiting, a reply that never arrives must not keep the future
+            self._waiters.pop(request_id, None)
 
     async def _handle_message_reply(self, msg):
         request_id = msg.requestId
@@ -163,8 +214,13 @@ class RawClient:
         if self.is_connected():
             raise Exception("already connected")
         self.reset_data()
+        self._set_state(STATE_CONNECTING)
 
-        self._reader, self._writer = await asyncio.open_connection(self._host, self._port, loop=loop)
+        try:
+            self._reader, self._writer = await asyncio.open_connection(self._host, self._port, loop=loop)
+        except:
+            self._set_state(STATE_CLOSED)
+            raise
         logger.info(f'opened connection')
 
         async def try_run():
@@ -176,6 +232,9 @@ class RawClient:
         self._task = asyncio.ensure_future(try_run())
 
         await self._on_connected()
+        # The reader loop may have ended while waiting for the subscription
+        if self._writer is not None:
+            self._set_state(STATE_CONNECTED)
 
     async def write(self, msg):
         self._writer.write(msg.to_bytes())
@@ -184,11 +243,13 @@ class RawClient:
     async def _on_connected(self):
         pass
 
-    def is_connected(self):
-        return self._writer and not self._writer.transport.is_closing()
+    async def wait_closed(self):
+        if self._task is not None:
+            await self._task
 
     async def disconnect(self):
-        if self.is_connected():
+        self._set_state(STATE_CLOSED)
+        if self._writer is not None and not self._writer.transport.is_closing():
             self._writer.close()
             try:
                 await self._writer.wait_closed()
@@ -202,4 +263,6 @@ class RawClient:
 
     def _cleanup_on_exception(self, exc):
         for f in self._waiters.values():
-            f.set_exception(exc)
+            if not f.done():
+                f.set_exception(exc)
+        self._waiters.clear()
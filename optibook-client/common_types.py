@@ -42,6 +42,7 @@ class PriceBook:
         self.instrument_id: str = '' if not instrument_id else instrument_id
         self.bids: List[PriceVolume] = [] if not bids else bids
         self.asks: List[PriceVolume] = [] if not asks else asks
+        self.received_ns: int = 0
 
     def __eq__(self, other):
         if not isinstance(other, PriceBook):
@@ -73,3 +74,4 @@ class Instrument:
         self.tick_size: float = 0.0
         self.extra_info: dict = {}
         self.paused: bool = False
+        self.expired: bool = False
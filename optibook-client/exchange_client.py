@@ -1,5 +1,6 @@
 # Copyright (c) Optiver I.P. B.V. 2019
 
+import asyncio
 import logging
 import json
 import itertools
@@ -7,6 +8,14 @@ from datetime import datetime
 from collections import defaultdict, deque
 from .base_client import Client, RawClient
 from .common_types import PriceBook, PriceVolume, Trade, TradeTick, OrderStatus, Instrument
+from .market_stats import MarketStats
+from .instruments import InstrumentTable
+from .journal import FillJournal
+from .throttle import OrderThrottle
+from .risk import PreTradeRisk, RiskLimitBreached
+from .shared_risk import SharedRiskBook
+from .order_index import OrderIndex, OrderPlan
+from .tracing import tracer, current_trace, NO_TRACE, STAGE_ORDER_SENT, STAGE_ORDER_REPLY, STAGE_FILL
 
 import capnp
 from .idl import exec_capnp, info_capnp, common_capnp
@@ -31,11 +40,30 @@ ALL_ORDER_TYPES = [ORDER_TYPE_LIMIT, ORDER_TYPE_IOC]
 
 
 class InfoClient(RawClient):
-    def __init__(self, host, port, max_nr_trade_history=100, admin_password=None):
+    def __init__(self, host, port, max_nr_trade_history=100, admin_password=None, market_stats: MarketStats = None, instrument_ids=None):
+        self._market_stats = market_stats
         super(InfoClient, self).__init__(host, port)
 
         self._admin_password = admin_password
         self._max_trade_history = max_nr_trade_history
+        self._instrument_callbacks_id = 0
+        self._instrument_callbacks = {}
+        # Books and trade ticks of other instruments are dropped before they are decoded, None keeps everything
+        self._interest = frozenset(instrument_ids) if instrument_ids is not None else None
+        self._handlers = {
+            info_capnp.PriceBook.schema.node.id: (info_capnp.PriceBook.schema, self._on_price_book_message),
+            common_capnp.TradeTick.schema.node.id: (common_capnp.TradeTick.schema, self._on_trade_tick_message),
+            info_capnp.InstrumentCreated.schema.node.id: (info_capnp.InstrumentCreated.schema, self.onInstrumentCreated),
+            info_capnp.InstrumentExpired.schema.node.id: (info_capnp.InstrumentExpired.schema, self.onInstrumentExpired),
+            info_capnp.InstrumentPaused.schema.node.id: (info_capnp.InstrumentPaused.schema, self.onInstrumentPaused),
+            info_capnp.InstrumentResumed.schema.node.id: (info_capnp.InstrumentResumed.schema, self.onInstrumentResumed),
+        }
+
+    def set_instrument_interest(self, instrument_ids):
+        """
+        Only keeps books and trade ticks of these instruments from now on, None keeps all of them.
+        """
+        self._interest = frozenset(instrument_ids) if instrument_ids is not None else None
 
     def _new_request_id(self):
         req_id = self._request_id
@@ -48,7 +76,8 @@ class InfoClient(RawClient):
 
         self._trade_tick_history_last_polled_index = defaultdict(lambda: 0)
         self._trade_tick_history = defaultdict(deque)
-        self._instruments = {}
+        self._instrument_table = InstrumentTable()
+        self._book_waiters = {}
 
     async def _on_connected(self):
         msg = common_capnp.RawMessage.new_message()
@@ -63,42 +92,92 @@ class InfoClient(RawClient):
         logger.debug('logged in!')
 
     async def _on_message(self, msg):
-        if msg.type == info_capnp.PriceBook.schema.node.id:
-            self.onPriceBook(msg.msg.as_struct(info_capnp.PriceBook.schema))
-        elif msg.type == common_capnp.TradeTick.schema.node.id:
-            self.onTradeTick(msg.msg.as_struct(common_capnp.TradeTick.schema))
-        elif msg.type == info_capnp.InstrumentCreated.schema.node.id:
-            self.onInstrumentCreated(msg.msg.as_struct(info_capnp.InstrumentCreated.schema))
-        elif msg.type == info_capnp.InstrumentExpired.schema.node.id:
-            self.onInstrumentExpired(msg.msg.as_struct(info_capnp.InstrumentExpired.schema))
-        elif msg.type == info_capnp.InstrumentPaused.schema.node.id:
-            self.onInstrumentPaused(msg.msg.as_struct(info_capnp.InstrumentPaused.schema))
-        elif msg.type == info_capnp.InstrumentResumed.schema.node.id:
-            self.onInstrumentResumed(msg.msg.as_struct(info_capnp.InstrumentResumed.schema))
-        else:
+        handler = self._handlers.get(msg.type)
+        if handler is None:
             raise Exception(f"Unknown message from server {msg}")
+        schema, f = handler
+        f(msg.msg.as_struct(schema))
+
+    def _on_price_book_message(self, priceBook):
+        # Reading the instrument id of the struct doesn't touch the levels
+        if self._interest is None or priceBook.instrumentId in self._interest:
+            self.onPriceBook(priceBook)
+
+    def _on_trade_tick_message(self, trade):
+        if self._interest is None or trade.instrumentId in self._interest:
+            self.onTradeTick(trade)
+
+    def add_instrument_callback(self, f):
+        """
+        Registers f(instrument) to be called on the event loop whenever an instrument is created, paused, resumed or expires.
+        """
+        c_id = self._instrument_callbacks_id
+        self._instrument_callbacks[c_id] = f
+        self._instrument_callbacks_id += 1
+        return c_id
+
+    def remove_instrument_callback(self, c_id):
+        del self._instrument_callbacks[c_id]
+
+    def _notify_instrument(self, instrument):
+        if instrument is None:
+            return
+        for f in list(self._instrument_callbacks.values()):
+            f(instrument)
 
     def onInstrumentCreated(self, msg):
-        i = Instrument()
-        i.id = msg.instrumentId
-        i.tick_size = msg.tickSize
-        i.extra_info = json.loads(msg.extraInfo)
-        self._instruments[msg.instrumentId] = i
+        self._notify_instrument(self._instrument_table.on_created(msg.instrumentId, msg.tickSize, json.loads(msg.extraInfo)))
 
     def onInstrumentExpired(self, msg):
-        del self._instruments[msg.instrumentId]
+        self._notify_instrument(self._instrument_table.on_expired(msg.instrumentId))
 
     def onInstrumentPaused(self, msg):
-        self._instruments[msg.instrumentId].paused = True
+        logger.info(f"Instrument {msg.instrumentId} paused")
+        self._notify_instrument(self._instrument_table.set_paused(msg.instrumentId, True))
 
     def onInstrumentResumed(self, msg):
-        self._instruments[msg.instrumentId].paused = False
+        logger.info(f"Instrument {msg.instrumentId} resumed")
+        self._notify_instrument(self._instrument_table.set_paused(msg.instrumentId, False))
+
+    async def wait_for_price_books(self, instrument_ids):
+        """
+        Returns as soon as a price book was received for each of the instruments.
+        """
+        loop = asyncio.get_event_loop()
+        futures = []
+        for instrument_id in instrument_ids:
+            if instrument_id not in self._last_price_book_by_instrument_id:
+                fut = loop.create_future()
+                self._book_waiters.setdefault(instrument_id, []).append(fut)
+                futures.append((instrument_id, fut))
+        try:
+            if futures:
+                await asyncio.gather(*[fut for _, fut in futures])
+        finally:
+            # When cancelled, e.g. by a timeout, the books of some instruments may never come
+            for instrument_id, fut in futures:
+                waiters = self._book_waiters.get(instrument_id)
+                if waiters is not None and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters:
+                        del self._book_waiters[instrument_id]
+
+    def _notify_book_waiters(self, instrument_id):
+        for fut in self._book_waiters.pop(instrument_id, ()):
+            if not fut.done():
+                fut.set_result(None)
 
     def onPriceBook(self, priceBook):
+        if self._book_waiters:
+            # The waiters resume after this book is stored
+            self._notify_book_waiters(priceBook.instrumentId)
         pb = PriceBook(instrument_id=priceBook.instrumentId, bids=[PriceVolume(r.price, r.volume) for r in priceBook.bids],
                        asks=[PriceVolume(r.price, r.volume) for r in priceBook.asks])
         pb.timestamp = datetime.now()
+        pb.received_ns = self._last_receive_ns
         self._last_price_book_by_instrument_id[priceBook.instrumentId] = pb
+        if self._market_stats is not None:
+            self._market_stats.on_price_book(priceBook.instrumentId, pb)
 
     def onTradeTick(self, trade):
         t = TradeTick()
@@ -109,6 +188,8 @@ class InfoClient(RawClient):
         t.timestamp = datetime.fromtimestamp(trade.timestamp // 1000000000)
         t.buyer = trade.buyer
         t.seller = trade.seller
+        if self._market_stats is not None:
+            self._market_stats.on_trade_tick(t.instrument_id, trade.timestamp, t.price, t.volume)
         inst_hist = self._trade_tick_history[t.instrument_id]
         inst_hist.append(t)
         while len(inst_hist) > self._max_trade_history:
@@ -119,21 +200,33 @@ class InfoClient(RawClient):
     def get_last_price_book(self, instrument_id):
         return self._last_price_book_by_instrument_id.get(instrument_id, None)
 
+    def get_market_stats(self):
+        return self._market_stats
+
     def get_trade_tick_history(self, instrument_id):
         return list(self._trade_tick_history.get(instrument_id, []))
 
     def poll_new_trade_ticks(self, instrument_id):
-        new_trade_ticks = list(itertools.islice(self._trade_tick_history[instrument_id],
-                                                self._trade_tick_history_last_polled_index[instrument_id],
-                                                len(self._trade_tick_history[instrument_id])))
-        self._trade_tick_history_last_polled_index[instrument_id] = len(self._trade_tick_history[instrument_id])
+        # Polling an instrument without trade ticks must not add entries for it
+        history = self._trade_tick_history.get(instrument_id)
+        if not history:
+            return []
+        new_trade_ticks = list(itertools.islice(history, self._trade_tick_history_last_polled_index[instrument_id], len(history)))
+        self._trade_tick_history_last_polled_index[instrument_id] = len(history)
         return new_trade_ticks
 
     def clear_trade_tick_history(self):
         self._trade_tick_history = defaultdict(deque)
+        self._trade_tick_history_last_polled_index = defaultdict(lambda: 0)
 
     def get_instruments(self):
-        return self._instruments
+        return self._instrument_table.get_instruments()
+
+    def get_instrument(self, instrument_id):
+        return self._instrument_table.get_instrument(instrument_id)
+
+    def get_instrument_table(self):
+        return self._instrument_table
 
 
 class PositionAccountant:
@@ -180,9 +273,17 @@ class PositionAccountant:
     
 
 class ExecClient(Client):
-    def __init__(self, host, port, max_nr_trade_history=100):
+    def __init__(self, host, port, max_nr_trade_history=100, max_orders_per_second=None, max_orders_per_second_per_instrument=None,
+                 journal: FillJournal = None, shared_risk: SharedRiskBook = None):
         super().__init__(host=host, port=port)
         self._max_trade_history = max_nr_trade_history
+        self._journal = journal
+        self._shared_risk = shared_risk
+        self._risk = PreTradeRisk()
+        self._throttle = None
+        if max_orders_per_second or max_orders_per_second_per_instrument:
+            self._throttle = OrderThrottle(max_orders_per_second=max_orders_per_second,
+                                           max_orders_per_second_per_instrument=max_orders_per_second_per_instrument)
 
     def reset_data(self):
         super(ExecClient, self).reset_data()
@@ -191,7 +292,7 @@ class ExecClient(Client):
         self._position_accountant = PositionAccountant()
         self._trade_history_last_polled_index = defaultdict(lambda: 0)
         self._trade_history = defaultdict(deque)
-        self._order_status_by_order_id = defaultdict(dict)
+        self._order_index = OrderIndex()
 
     async def _on_connected(self):
         self._exec_portal = self._client.bootstrap().cast_as(exec_capnp.ExecPortal)
@@ -204,20 +305,104 @@ class ExecClient(Client):
             result = await self._exec_portal.adminLogin(username, password, admin_password, self.ExecSubscription(self)).a_wait()
         self._exec = result.exec
         self._position_accountant = PositionAccountant(positions=result.positions.positions)
+        if self._journal is not None:
+            self._journal.record_positions(result.positions.basedOnTradeId,
+                                           [(p.instrumentId, p.position, p.cash) for p in result.positions.positions])
+        self._risk.reset_counters()
+        for instrument_id, volume in self.get_positions().items():
+            self._risk.set_position(instrument_id, volume)
+            self._sync_shared_position(instrument_id)
+
+    def _sync_shared_position(self, instrument_id):
+        if self._shared_risk is not None:
+            index = self._shared_risk.get_index(instrument_id)
+            if index is not None:
+                self._shared_risk.set_position(index, self._risk.get_position(instrument_id))
+
+    def _sync_shared_outstanding(self, instrument_id):
+        if self._shared_risk is not None:
+            index = self._shared_risk.get_index(instrument_id)
+            if index is not None:
+                self._shared_risk.set_outstanding(index, *self._risk.get_outstanding(instrument_id))
+
+    def _reserve_shared(self, instrument_id, volume, side):
+        if self._shared_risk is not None:
+            index = self._shared_risk.get_index(instrument_id)
+            if index is not None:
+                self._shared_risk.reserve(index, volume, side)
 
     async def insert_order(self, *, instrument_id, price, volume, side, order_type):
         assert side in ALL_SIDES, f"side must be one of {ALL_SIDES}"
         assert order_type in ALL_ORDER_TYPES, f"order_type must be one of {ALL_ORDER_TYPES}"
-        return (await self._exec.insertOrder(instrument_id, price, volume, side, order_type).a_wait()).orderId
+        # Raises RiskLimitBreached before anything is sent. The volume counts as outstanding until the reply is in.
+        self._risk.reserve(instrument_id, price, volume, side)
+        try:
+            # The account limit over all processes sharing the risk book
+            self._reserve_shared(instrument_id, volume, side)
+        except RiskLimitBreached:
+            self._risk.release(instrument_id, price, volume, side)
+            raise
+        # Read the trace here, a throttled order is sent from another task with its own context
+        trace_id = current_trace.get() if tracer.enabled else NO_TRACE
+        try:
+            if self._throttle is not None:
+                return await self._throttle.submit(instrument_id, side, order_type,
+                                                   lambda: self._send_insert_order(instrument_id, price, volume, side, order_type, trace_id))
+            return await self._send_insert_order(instrument_id, price, volume, side, order_type, trace_id)
+        finally:
+            self._risk.release(instrument_id, price, volume, side)
+            self._sync_shared_outstanding(instrument_id)
+
+    async def _send_insert_order(self, instrument_id, price, volume, side, order_type, trace_id=NO_TRACE):
+        if trace_id != NO_TRACE:
+            tracer.record(STAGE_ORDER_SENT, trace_id)
+        order_id = (await self._exec.insertOrder(instrument_id, price, volume, side, order_type).a_wait()).orderId
+        if trace_id != NO_TRACE:
+            tracer.record(STAGE_ORDER_REPLY, trace_id, order_id=order_id)
+        return order_id
 
     async def amend_order(self, instrument_id, order_id, volume):
+        order = self._risk.get_order(order_id)
+        if order is not None and volume > order[2]:
+            self._risk.check(instrument_id, order[1], volume - order[2], order[3])
+            self._reserve_shared(instrument_id, volume - order[2], order[3])
+            try:
+                return await self._send_throttled(instrument_id, lambda: self._send_amend_order(instrument_id, order_id, volume))
+            finally:
+                self._sync_shared_outstanding(instrument_id)
+        return await self._send_throttled(instrument_id, lambda: self._send_amend_order(instrument_id, order_id, volume))
+
+    async def _send_amend_order(self, instrument_id, order_id, volume):
         return (await self._exec.amendOrder(instrument_id, order_id, volume).a_wait()).success
 
     async def delete_order(self, instrument_id, order_id):
+        return await self._send_throttled(instrument_id, lambda: self._send_delete_order(instrument_id, order_id))
+
+    async def _send_delete_order(self, instrument_id, order_id):
         return (await self._exec.deleteOrder(instrument_id, order_id).a_wait()).success
 
     async def delete_orders(self, instrument_id):
-        await self._exec.deleteOrders(instrument_id).a_wait()
+        await self._send_throttled(instrument_id, lambda: self._exec.deleteOrders(instrument_id).a_wait())
+
+    async def _send_throttled(self, instrument_id, send):
+        # Amends and deletes count toward the exchange's message rate like inserts, but are never superseded
+        if self._throttle is not None:
+            return await self._throttle.submit(instrument_id, None, None, send)
+        return await send()
+
+    async def requote(self, instrument_id, side, targets, order_type=ORDER_TYPE_LIMIT):
+        plan = self._order_index.plan(instrument_id, side, targets)
+        await self.execute_plan(plan, order_type)
+        return plan
+
+    async def execute_plan(self, plan, order_type=ORDER_TYPE_LIMIT):
+        # Amends and deletes go out first and concurrently, inserts only once the volume they replace is pulled
+        await asyncio.gather(*[self.amend_order(plan.instrument_id, order_id, volume) for order_id, volume in plan.amends],
+                             *[self.delete_order(plan.instrument_id, order_id) for order_id in plan.deletes])
+        plan.inserted_order_ids = await asyncio.gather(
+            *[self.insert_order(instrument_id=plan.instrument_id, price=price, volume=volume, side=plan.side, order_type=order_type)
+              for price, volume in plan.inserts])
+        return plan
 
     def get_positions(self):
         return { k : v['volume'] for k, v in self._position_accountant.get_positions().items() }
@@ -227,22 +412,57 @@ class ExecClient(Client):
 
     def get_cash(self):
         return self._position_accountant.get_cash()
+
+    def get_journal(self):
+        return self._journal
                 
+    def set_risk_limits(self, instrument_id=None, **limits):
+        self._risk.set_instrument_limits(instrument_id, **limits)
+
+    def set_portfolio_risk_limits(self, **limits):
+        self._risk.set_portfolio_limits(**limits)
+
+    def get_risk_metrics(self):
+        return self._risk.get_metrics()
+
+    def get_throttle_metrics(self):
+        if self._throttle is None:
+            return {}
+        return self._throttle.get_metrics()
+
     def get_outstanding_orders(self, instrument_id):
-        return self._order_status_by_order_id[instrument_id].copy()
+        return dict(self._order_index.get_orders(instrument_id))
+
+    def get_outstanding_orders_view(self, instrument_id):
+        return self._order_index.get_orders(instrument_id)
+
+    def get_outstanding_order(self, order_id):
+        return self._order_index.get_order(order_id)
+
+    def is_order_done(self, order_id):
+        return self._order_index.is_done(order_id)
+
+    def get_resting_volume(self, instrument_id, side):
+        return self._order_index.get_resting_volume(instrument_id, side)
+
+    def plan_orders(self, instrument_id, side, targets):
+        return self._order_index.plan(instrument_id, side, targets)
 
     def get_trade_history(self, instrument_id):
-        return list(self._trade_history[instrument_id])
+        return list(self._trade_history.get(instrument_id, []))
 
     def poll_new_trades(self, instrument_id):
-        new_trades = list(
-            itertools.islice(self._trade_history[instrument_id], self._trade_history_last_polled_index[instrument_id],
-                             len(self._trade_history[instrument_id])))
-        self._trade_history_last_polled_index[instrument_id] = len(self._trade_history[instrument_id])
+        # Polling an instrument without trades must not add entries for it
+        history = self._trade_history.get(instrument_id)
+        if not history:
+            return []
+        new_trades = list(itertools.islice(history, self._trade_history_last_polled_index[instrument_id], len(history)))
+        self._trade_history_last_polled_index[instrument_id] = len(history)
         return new_trades
 
     def clear_trade_history(self):
         self._trade_history = defaultdict(deque)
+        self._trade_history_last_polled_index = defaultdict(lambda: 0)
 
     class ExecSubscription(exec_capnp.ExecPortal.ExecFeed.Server):
         def __init__(self, exec_client):
@@ -259,12 +479,14 @@ class ExecClient(Client):
             o.volume = order.volume
             o.side = order.side
             o.price = order.price
-            self._exec._order_status_by_order_id[instrument_id][order_id] = o
-            if order.volume == 0:
-                self._exec._order_status_by_order_id[instrument_id].pop(order_id)
+            self._exec._order_index.update(o)
+            self._exec._risk.on_order_update(order_id, instrument_id, order.price, order.volume, o.side)
+            self._exec._sync_shared_outstanding(instrument_id)
             logger.debug('order end %s', order)
 
         def onTrade(self, trade, **kwargs):
+            if tracer.enabled:
+                tracer.record(STAGE_FILL, order_id=trade.orderId)
             tc = Trade()
             tc.price = trade.price
             tc.side = trade.side
@@ -279,10 +501,18 @@ class ExecClient(Client):
                     self._exec._trade_history_last_polled_index[tc.instrument_id] - 1, 0)
 
             self._exec._position_accountant.handle_trade(trade)
+            if self._exec._journal is not None:
+                self._exec._journal.record_trade(trade)
+            self._exec._risk.on_position_change(tc.instrument_id, tc.volume if tc.side == SIDE_BID else -tc.volume)
+            self._exec._sync_shared_position(tc.instrument_id)
             logger.debug('trade end %s', trade)
 
         def onSingleSidedBooking(self, ssb, **kwargs):
             self._exec._position_accountant.handle_single_sided_booking(ssb)
+            if self._exec._journal is not None:
+                self._exec._journal.record_single_sided_booking(ssb)
+            self._exec._risk.on_position_change(ssb.instrumentId, ssb.volume if ssb.action == ACTION_BUY else -ssb.volume)
+            self._exec._sync_shared_position(ssb.instrumentId)
 
         def onForcedDisconnect(self, reason, **kwargs):
             logger.error(f'Forcing a disconnect due to an error: {reason}.')
@@ -1,5 +1,30 @@
+import math
+from datetime import datetime
+
 from .common_types import PriceBook
 
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+try:
+	from scipy.special import ndtr as _ndtr
+except ImportError:
+	_ndtr = None
+
+__all__ = ['calculate_pnl', 'calculate_vwap', 'black_scholes', 'implied_volatility', 'OptionChain', 'GreeksEngine']
+
+SECONDS_PER_YEAR = 365.0 * 24 * 3600
+MIN_VOLATILITY = 1e-4
+MAX_VOLATILITY = 5.0
+
+# Keys of the option fields in Instrument.extra_info
+EXTRA_INFO_UNDERLYING = 'base_instrument_id'
+EXTRA_INFO_STRIKE = 'strike'
+EXTRA_INFO_EXPIRY = 'expiry'
+EXTRA_INFO_OPTION_KIND = 'option_kind'
+
 
 def calculate_pnl(current_valuation: float, position: int, cash_invested: float):
 	return cash_invested + (current_valuation * position)
@@ -20,3 +45,206 @@ def calculate_vwap(order_book: PriceBook):
 
 	return round(((best_bid_price * best_ask_volume) + (best_ask_price * best_bid_volume)) / max(1, best_bid_volume + best_ask_volume), 2)
 
+
+
+def _require_numpy():
+	if np is None:
+		raise Exception("numpy is required for option pricing, install it with 'pip install numpy'")
+
+
+if np is not None:
+	_erf = np.frompyfunc(math.erf, 1, 1)
+
+
+def _norm_cdf(x):
+	if _ndtr is not None:
+		return _ndtr(x)
+	# Without scipy fall back to math.erf per element, slower but exact. frompyfunc returns a plain float for 0-d input.
+	return 0.5 * (1 + np.asarray(_erf(x / math.sqrt(2)), dtype=float))
+
+
+def _norm_pdf(x):
+	return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+
+def black_scholes(spot, strike, time_to_expiry, volatility, rate, is_call):
+	"""
+	Prices European options and computes their greeks, vectorized over all arguments (NumPy broadcasting).
+	Time is in years, vega is per unit of volatility and theta per year. Expired options are valued at intrinsic value
+	with zero greeks.
+
+	Returns a dict of arrays with keys price, delta, gamma, vega and theta.
+	"""
+	_require_numpy()
+	spot, strike, time_to_expiry, volatility, is_call = np.broadcast_arrays(
+		np.asarray(spot, dtype=float), np.asarray(strike, dtype=float), np.asarray(time_to_expiry, dtype=float),
+		np.asarray(volatility, dtype=float), np.asarray(is_call, dtype=bool))
+	live = time_to_expiry > 0
+	t = np.where(live, time_to_expiry, 1.0)
+	sqrt_t = np.sqrt(t)
+	sigma_sqrt_t = volatility * sqrt_t
+	d1 = (np.log(spot / strike) + (rate + 0.5 * volatility * volatility) * t) / sigma_sqrt_t
+	d2 = d1 - sigma_sqrt_t
+	discount = np.exp(-rate * t)
+	sign = np.where(is_call, 1.0, -1.0)
+	nd1 = _norm_cdf(sign * d1)
+	nd2 = _norm_cdf(sign * d2)
+	pdf_d1 = _norm_pdf(d1)
+
+	price = sign * (spot * nd1 - strike * discount * nd2)
+	delta = sign * nd1
+	gamma = pdf_d1 / (spot * sigma_sqrt_t)
+	vega = spot * pdf_d1 * sqrt_t
+	theta = -spot * pdf_d1 * volatility / (2 * sqrt_t) - sign * rate * strike * discount * nd2
+
+	intrinsic = np.maximum(sign * (spot - strike), 0.0)
+	return {
+		'price': np.where(live, price, intrinsic),
+		'delta': np.where(live, delta, np.where(intrinsic > 0, sign, 0.0)),
+		'gamma': np.where(live, gamma, 0.0),
+		'vega': np.where(live, vega, 0.0),
+		'theta': np.where(live, theta, 0.0),
+	}
+
+
+def _price_and_vega(spot, strike, time_to_expiry, volatility, rate, sign):
+	# Just what the implied volatility iteration needs, for live options only
+	sqrt_t = np.sqrt(time_to_expiry)
+	sigma_sqrt_t = volatility * sqrt_t
+	d1 = (np.log(spot / strike) + (rate + 0.5 * volatility * volatility) * time_to_expiry) / sigma_sqrt_t
+	price = sign * (spot * _norm_cdf(sign * d1) - strike * np.exp(-rate * time_to_expiry) * _norm_cdf(sign * (d1 - sigma_sqrt_t)))
+	return price, spot * _norm_pdf(d1) * sqrt_t
+
+
+def implied_volatility(price, spot, strike, time_to_expiry, rate, is_call, tolerance=1e-8, max_iterations=50):
+	"""
+	Vectorized implied volatility. Starts from the Corrado-Miller approximation, then every option takes Newton steps
+	on its own bracket [lo, hi]; a step that leaves the bracket or has next to no vega is replaced by bisection, so
+	every option converges. Prices outside the no-arbitrage bounds, and expired options, get NaN.
+	"""
+	_require_numpy()
+	price, spot, strike, time_to_expiry, is_call = np.broadcast_arrays(
+		np.asarray(price, dtype=float), np.asarray(spot, dtype=float), np.asarray(strike, dtype=float),
+		np.asarray(time_to_expiry, dtype=float), np.asarray(is_call, dtype=bool))
+	sign = np.where(is_call, 1.0, -1.0)
+	t = np.where(time_to_expiry > 0, time_to_expiry, 1.0)
+	discounted_strike = strike * np.exp(-rate * t)
+	lower_bound = np.maximum(sign * (spot - discounted_strike), 0.0)
+	upper_bound = np.where(is_call, spot, discounted_strike)
+	valid = (time_to_expiry > 0) & (price > lower_bound) & (price < upper_bound)
+
+	# Corrado-Miller works on the call price, convert puts with put-call parity
+	call_price = np.where(is_call, price, price + spot - discounted_strike)
+	half_gap = (spot - discounted_strike) / 2
+	a = call_price - half_gap
+	with np.errstate(invalid='ignore'):
+		guess = math.sqrt(2 * math.pi) / (spot + discounted_strike) * (a + np.sqrt(np.maximum(a * a - half_gap * half_gap * 4 / math.pi, 0.0))) / np.sqrt(t)
+	sigma = np.clip(np.where(np.isfinite(guess) & (guess > 0), guess, 0.3), MIN_VOLATILITY, MAX_VOLATILITY)
+
+	lo = np.full(price.shape, MIN_VOLATILITY)
+	hi = np.full(price.shape, MAX_VOLATILITY)
+	index = np.flatnonzero(valid)
+	for _ in range(max_iterations):
+		if not len(index):
+			break
+		s, l, h = sigma[index], lo[index], hi[index]
+		model, vega = _price_and_vega(spot[index], strike[index], t[index], s, rate, sign[index])
+		diff = model - price[index]
+		l = np.where(diff < 0, s, l)
+		h = np.where(diff > 0, s, h)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			newton = s - diff / vega
+		s = np.where((newton > l) & (newton < h), newton, 0.5 * (l + h))
+		sigma[index], lo[index], hi[index] = s, l, h
+		index = index[np.abs(diff) >= tolerance]
+	return np.where(valid, sigma, np.nan)
+
+
+class OptionChain:
+	"""
+	The options on one underlying as arrays, in the order of instrument_ids.
+	"""
+	def __init__(self, instrument_ids, strikes, expiries, is_call):
+		_require_numpy()
+		self.instrument_ids = list(instrument_ids)
+		self.strikes = np.asarray(strikes, dtype=float)
+		self.expiries = np.asarray(expiries, dtype=float) # unix timestamps in seconds
+		self.is_call = np.asarray(is_call, dtype=bool)
+
+	def __len__(self):
+		return len(self.instrument_ids)
+
+	@staticmethod
+	def from_instruments(instruments, underlying_id):
+		"""
+		Builds the chain of an underlying from the instruments of the InfoClient, using the strike, expiry and option
+		kind in their extra_info.
+		"""
+		options = sorted((i for i in instruments.values() if i.extra_info.get(EXTRA_INFO_UNDERLYING) == underlying_id and EXTRA_INFO_STRIKE in i.extra_info),
+						 key=lambda i: i.id)
+		return OptionChain(
+			[i.id for i in options],
+			[float(i.extra_info[EXTRA_INFO_STRIKE]) for i in options],
+			[_parse_expiry(i.extra_info[EXTRA_INFO_EXPIRY]) for i in options],
+			[str(i.extra_info[EXTRA_INFO_OPTION_KIND]).lower() == 'call' for i in options])
+
+
+def _parse_expiry(expiry):
+	if isinstance(expiry, (int, float)):
+		return float(expiry)
+	return datetime.fromisoformat(expiry).timestamp()
+
+
+class GreeksEngine:
+	"""
+	Prices a whole option chain in one go and caches the result per underlying price and time bucket. Within a bucket
+	the time to expiry is taken at the start of the bucket, so a repeated underlying price is a dict lookup. The cache is
+	dropped when the bucket rolls over or the volatilities change.
+	"""
+	def __init__(self, chain: OptionChain, volatilities=0.3, rate: float = 0.0, time_bucket: float = 1.0, max_cache_size: int = 4096):
+		_require_numpy()
+		self.chain = chain
+		self._rate = rate
+		self._time_bucket = time_bucket
+		self._max_cache_size = max_cache_size
+		self._volatilities = np.broadcast_to(np.asarray(volatilities, dtype=float), (len(chain),))
+		self._cache = {}
+		self._bucket = None
+
+	def set_volatilities(self, volatilities):
+		self._volatilities = np.broadcast_to(np.asarray(volatilities, dtype=float), (len(self.chain),))
+		self._cache = {}
+
+	def calibrate(self, spot: float, prices, now: float = None):
+		"""
+		Sets the volatilities to the implied volatilities of the given option prices (e.g. mids). Options without an
+		implied volatility keep their current one.
+		"""
+		time_to_expiry = self._time_to_expiry(self._bucket_start(now))
+		iv = implied_volatility(prices, spot, self.chain.strikes, time_to_expiry, self._rate, self.chain.is_call)
+		self.set_volatilities(np.where(np.isnan(iv), self._volatilities, iv))
+		return iv
+
+	def greeks(self, spot: float, now: float = None):
+		"""
+		Returns the dict of price, delta, gamma, vega and theta arrays of the chain. The arrays are shared with the cache,
+		don't modify them.
+		"""
+		bucket = self._bucket_start(now)
+		if bucket != self._bucket:
+			self._bucket = bucket
+			self._cache = {}
+		result = self._cache.get(spot)
+		if result is None:
+			if len(self._cache) >= self._max_cache_size:
+				self._cache = {}
+			result = black_scholes(spot, self.chain.strikes, self._time_to_expiry(bucket), self._volatilities, self._rate, self.chain.is_call)
+			self._cache[spot] = result
+		return result
+
+	def _bucket_start(self, now):
+		now = datetime.now().timestamp() if now is None else now
+		return now - now % self._time_bucket
+
+	def _time_to_expiry(self, bucket):
+		return (self.chain.expiries - bucket) / SECONDS_PER_YEAR
@@ -0,0 +1,93 @@
+import logging
+import math
+
+from .common_types import Instrument
+
+logger = logging.getLogger('client')
+
+SIDE_BID = 'bid'
+
+
+class InstrumentNotTradable(Exception):
+    pass
+
+
+def _nr_decimals(tick_size):
+    # Number of decimals needed to print a multiple of tick_size exactly, e.g. 2 for 0.05
+    decimals = 0
+    while decimals < 10 and abs(round(tick_size, decimals) - tick_size) > 1e-12:
+        decimals += 1
+    return decimals
+
+
+class InstrumentTable:
+    """
+    The instruments known to the InfoClient with their paused and expired state. The tick size and the number of
+    decimals of every instrument are computed once when it is created, so normalizing a price is a couple of float
+    operations.
+    """
+    def __init__(self):
+        self._instruments = {}
+        self._expired = {}
+        self._ticks = {}
+
+    def on_created(self, instrument_id, tick_size, extra_info):
+        i = Instrument()
+        i.id = instrument_id
+        i.tick_size = tick_size
+        i.extra_info = extra_info
+        self._instruments[instrument_id] = i
+        self._expired.pop(instrument_id, None)
+        if tick_size > 0:
+            self._ticks[instrument_id] = (tick_size, _nr_decimals(tick_size))
+        return i
+
+    def on_expired(self, instrument_id):
+        i = self._instruments.pop(instrument_id, None)
+        if i is not None:
+            i.expired = True
+            self._expired[instrument_id] = i
+        return i
+
+    def set_paused(self, instrument_id, paused):
+        i = self._instruments.get(instrument_id)
+        if i is not None:
+            i.paused = paused
+        return i
+
+    def get_instruments(self):
+        """
+        The instruments that have not expired, by instrument_id.
+        """
+        return self._instruments
+
+    def get_instrument(self, instrument_id):
+        i = self._instruments.get(instrument_id)
+        return i if i is not None else self._expired.get(instrument_id)
+
+    def check_tradable(self, instrument_id):
+        """
+        Raises InstrumentNotTradable if the instrument is paused or expired. Unknown instruments are left to the exchange.
+        """
+        i = self._instruments.get(instrument_id)
+        if i is None:
+            if instrument_id in self._expired:
+                raise InstrumentNotTradable(f"Instrument {instrument_id} has expired")
+            return
+        if i.paused:
+            raise InstrumentNotTradable(f"Instrument {instrument_id} is paused")
+
+    def normalize_price(self, instrument_id, price, side):
+        """
+        Rounds price onto the tick grid of the instrument, away from the other side of the book: bids are rounded down
+        and asks up, so an order never becomes more aggressive than requested. Prices of unknown instruments are
+        returned as is.
+        """
+        ticks = self._ticks.get(instrument_id)
+        if ticks is None:
+            return price
+        tick_size, decimals = ticks
+        nr_ticks = price / tick_size
+        # Allow for float noise, 10.1 / 0.1 is 100.99999999999999
+        nr_ticks = math.floor(nr_ticks + 1e-9) if side == SIDE_BID else math.ceil(nr_ticks - 1e-9)
+        return round(nr_ticks * tick_size, decimals)
@@ -0,0 +1,185 @@
+import logging
+import queue
+import sqlite3
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger('client')
+
+ACTION_BUY = 'buy'
+
+KIND_TRADE = 'trade'
+KIND_SINGLE_SIDED_BOOKING = 'single_sided_booking'
+
+DEFAULT_BATCH_SIZE = 1000
+
+Fill = namedtuple('Fill', ['kind', 'trade_id', 'timestamp', 'instrument_id', 'order_id', 'price', 'volume', 'side'])
+
+# Shaped like the capnp structs PositionAccountant reads
+_SnapshotPosition = namedtuple('_SnapshotPosition', ['instrumentId', 'position', 'cash'])
+_ReplayedTrade = namedtuple('_ReplayedTrade', ['instrumentId', 'side', 'volume', 'price'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fills (
+    kind TEXT NOT NULL,
+    trade_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    instrument_id TEXT NOT NULL,
+    order_id INTEGER,
+    price REAL NOT NULL,
+    volume INTEGER NOT NULL,
+    side TEXT NOT NULL,
+    PRIMARY KEY (kind, trade_id)
+);
+CREATE INDEX IF NOT EXISTS fills_instrument_time ON fills (instrument_id, timestamp);
+CREATE INDEX IF NOT EXISTS fills_time ON fills (timestamp);
+CREATE INDEX IF NOT EXISTS fills_order ON fills (order_id);
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot_id INTEGER PRIMARY KEY,
+    based_on_trade_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshot_positions (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots,
+    instrument_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    cash REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshot_positions_id ON snapshot_positions (snapshot_id);
+"""
+
+_STOP = object()
+
+
+class FillJournal:
+    """
+    Durable journal of the private trades and single sided bookings of the client, in SQLite in WAL mode.
+
+    Recording a fill only puts a tuple on a queue, the exec callbacks never wait for the disk. A background thread writes
+    whatever is queued in one transaction, at most batch_size fills at a time, so a burst of fills costs one commit.
+    Replayed fills are ignored by their (kind, trade_id) key.
+
+    The positions the exchange reports at login are journaled as snapshots, so rebuild_accountant() gives the right
+    positions also for a journal that was started on an account that already traded.
+    """
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self._path = path
+        self._batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._local = threading.local()
+        self._connect().executescript(_SCHEMA)
+        self._thread = threading.Thread(target=self._write_loop, name='optibook-journal', daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        # One connection per thread, WAL lets readers run next to the writer
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def record_trade(self, trade):
+        self._queue.put((KIND_TRADE, trade.tradeId, trade.timestamp, trade.instrumentId, trade.orderId, trade.price, trade.volume, str(trade.side)))
+
+    def record_single_sided_booking(self, ssb):
+        side = 'bid' if str(ssb.action) == ACTION_BUY else 'ask'
+        self._queue.put((KIND_SINGLE_SIDED_BOOKING, ssb.tradeId, ssb.timestamp, ssb.instrumentId, None, ssb.price, ssb.volume, side))
+
+    def record_positions(self, based_on_trade_id, positions):
+        """
+        Journals the positions reported by the exchange, as (instrument_id, position, cash) tuples.
+        """
+        self._queue.put(('snapshot', based_on_trade_id, list(positions)))
+
+    def _write_loop(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch = [item]
+            # Whatever queued up during the previous commit goes in the same transaction
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                stopping = self._write(conn, batch)
+            except Exception:
+                logger.exception(f"Failed to write {len(batch)} entries to the fill journal")
+
+    def _write(self, conn, batch):
+        stopping = False
+        fills = []
+        with conn:
+            for item in batch:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    # flush() marker, everything queued before it is in this transaction
+                    continue
+                elif item[0] == 'snapshot':
+                    snapshot_id = conn.execute('INSERT INTO snapshots (based_on_trade_id) VALUES (?)', (item[1],)).lastrowid
+                    conn.executemany('INSERT INTO snapshot_positions VALUES (?, ?, ?, ?)',
+                                     [(snapshot_id, instrument_id, position, cash) for instrument_id, position, cash in item[2]])
+                else:
+                    fills.append(item)
+            conn.executemany('INSERT OR IGNORE INTO fills VALUES (?, ?, ?, ?, ?, ?, ?, ?)', fills)
+        for item in batch:
+            if isinstance(item, threading.Event):
+                item.set()
+        return stopping
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything recorded so far is committed.
+        """
+        if not self._thread.is_alive():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def get_fills(self, instrument_id=None, start=None, end=None, order_id=None):
+        """
+        Returns the journaled fills, oldest first, optionally filtered by instrument, by timestamp in ns since the epoch
+        (start inclusive, end exclusive) and by order_id. Fills recorded before the call are included.
+        """
+        self.flush()
+        conditions = []
+        args = []
+        for column, op, value in (('instrument_id', '=', instrument_id), ('timestamp', '>=', start), ('timestamp', '<', end), ('order_id', '=', order_id)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                args.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = self._connect().execute(f"SELECT {', '.join(Fill._fields)} FROM fills{where} ORDER BY timestamp, trade_id", args)
+        return [Fill(*row) for row in rows]
+
+    def rebuild_accountant(self):
+        """
+        Returns a PositionAccountant with the positions and cash of the latest snapshot plus all fills after it.
+        """
+        from .exchange_client import PositionAccountant
+        self.flush()
+        conn = self._connect()
+        based_on_trade_id = -1
+        positions = []
+        snapshot = conn.execute('SELECT snapshot_id, based_on_trade_id FROM snapshots ORDER BY snapshot_id DESC LIMIT 1').fetchone()
+        if snapshot is not None:
+            snapshot_id, based_on_trade_id = snapshot
+            positions = [_SnapshotPosition(*row) for row in conn.execute(
+                'SELECT instrument_id, position, cash FROM snapshot_positions WHERE snapshot_id = ?', (snapshot_id,))]
+        accountant = PositionAccountant(positions=positions)
+        # Single sided bookings are replayed as trades, bid for buy and ask for sell
+        for row in conn.execute('SELECT instrument_id, side, volume, price FROM fills WHERE trade_id > ? ORDER BY timestamp, trade_id',
+                                (based_on_trade_id,)):
+            accountant.handle_trade(_ReplayedTrade(*row))
+        return accountant
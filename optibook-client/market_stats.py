@@ -0,0 +1,241 @@
+import copy
+import logging
+import time
+from array import array
+from collections import namedtuple
+
+logger = logging.getLogger('client')
+
+DEFAULT_BAR_INTERVAL = 60.0
+DEFAULT_NR_BARS = 1440
+DEFAULT_WINDOW = 1000
+DEFAULT_EWMA_ALPHA = 0.05
+
+BAR_FIELDS = ['start_ns', 'open', 'high', 'low', 'close', 'volume', 'vwap', 'count']
+Bar = namedtuple('Bar', BAR_FIELDS)
+
+_TYPECODES = {'q': 'int64', 'd': 'float64'}
+
+
+class _Ring:
+    """
+    Fixed size history of numbers in a typed array. Every value is written twice, capacity apart, so the last capacity
+    values are always one contiguous slice and can be handed out without copying.
+    """
+    def __init__(self, typecode, capacity):
+        assert capacity > 0
+        self._typecode = typecode
+        self._capacity = capacity
+        self._buffer = array(typecode, bytes(array(typecode).itemsize * 2 * capacity))
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self._capacity)
+
+    def oldest(self):
+        # The value that the next append overwrites once the ring is full
+        return self._buffer[self._count % self._capacity]
+
+    def append(self, value):
+        i = self._count % self._capacity
+        self._buffer[i] = value
+        self._buffer[i + self._capacity] = value
+        self._count += 1
+
+    def copy(self):
+        ring = copy.copy(self)
+        ring._buffer = array(self._typecode, self._buffer)
+        return ring
+
+    def view(self):
+        start = self._count % self._capacity if self._count >= self._capacity else 0
+        return memoryview(self._buffer)[start:start + len(self)]
+
+    def as_numpy(self):
+        import numpy
+        return numpy.frombuffer(self.view(), dtype=_TYPECODES[self._typecode])
+
+
+class BarSeries:
+    """
+    Time bars of the trade ticks of one instrument. Intervals without trades don't get a bar.
+    """
+    def __init__(self, interval_ns, capacity):
+        self._interval_ns = interval_ns
+        self._columns = {name: _Ring('q' if name in ('start_ns', 'volume', 'count') else 'd', capacity) for name in BAR_FIELDS}
+        self._start_ns = None
+
+    def on_trade(self, timestamp_ns, price, volume):
+        start_ns = timestamp_ns - timestamp_ns % self._interval_ns
+        if self._start_ns is None or start_ns > self._start_ns:
+            if self._start_ns is not None:
+                self._close_bar()
+            self._start_ns = start_ns
+            self._open = self._high = self._low = price
+            self._volume = 0
+            self._notional = 0.0
+            self._count = 0
+        # A tick that arrives late for an already closed bar is counted in the current one
+        if price > self._high:
+            self._high = price
+        elif price < self._low:
+            self._low = price
+        self._close = price
+        self._volume += volume
+        self._notional += price * volume
+        self._count += 1
+
+    def _close_bar(self):
+        for name, value in zip(BAR_FIELDS, self.current()):
+            self._columns[name].append(value)
+
+    def current(self):
+        """
+        The bar that is still being built, or None before the first trade.
+        """
+        if self._start_ns is None:
+            return None
+        vwap = self._notional / self._volume if self._volume else self._close
+        return Bar(self._start_ns, self._open, self._high, self._low, self._close, self._volume, vwap, self._count)
+
+    def __len__(self):
+        return len(self._columns['start_ns'])
+
+    def copy(self):
+        bars = copy.copy(self)
+        bars._columns = {name: column.copy() for name, column in self._columns.items()}
+        return bars
+
+    def as_numpy(self):
+        """
+        The completed bars as a dict of NumPy arrays, one per field, oldest first.
+        """
+        return {name: column.as_numpy() for name, column in self._columns.items()}
+
+
+class RollingStats:
+    """
+    Mean and variance over the last window samples and an exponentially weighted mean and variance, all updated in O(1)
+    per sample. The samples themselves are kept as well.
+    """
+    def __init__(self, window, alpha):
+        assert 0 < alpha <= 1
+        self._alpha = alpha
+        self._values = _Ring('d', window)
+        self._timestamps = _Ring('q', window)
+        self._window = window
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._ewma = None
+        self._ewm_variance = 0.0
+
+    def add(self, timestamp_ns, value):
+        if self._n < self._window:
+            self._n += 1
+            delta = value - self._mean
+            self._mean += delta / self._n
+            self._m2 += delta * (value - self._mean)
+        else:
+            old = self._values.oldest()
+            mean = self._mean + (value - old) / self._n
+            self._m2 += (value - old) * (value - mean + old - self._mean)
+            self._mean = mean
+            if self._m2 < 0:
+                # rounding can push an all equal window just below zero
+                self._m2 = 0.0
+        self._values.append(value)
+        self._timestamps.append(timestamp_ns)
+
+        if self._ewma is None:
+            self._ewma = value
+        else:
+            diff = value - self._ewma
+            increment = self._alpha * diff
+            self._ewma += increment
+            self._ewm_variance = (1 - self._alpha) * (self._ewm_variance + diff * increment)
+
+    def copy(self):
+        stats = copy.copy(self)
+        stats._values = self._values.copy()
+        stats._timestamps = self._timestamps.copy()
+        return stats
+
+    @property
+    def count(self):
+        return self._n
+
+    @property
+    def mean(self):
+        return self._mean if self._n else None
+
+    @property
+    def variance(self):
+        return self._m2 / (self._n - 1) if self._n > 1 else None
+
+    @property
+    def ewma(self):
+        return self._ewma
+
+    @property
+    def ewm_variance(self):
+        return self._ewm_variance if self._ewma is not None else None
+
+    def values(self):
+        return self._values.as_numpy()
+
+    def timestamps(self):
+        return self._timestamps.as_numpy()
+
+
+class MarketStats:
+    """
+    Incremental per instrument statistics, fed by the InfoClient: time bars (OHLCV, VWAP, trade count) of the trade
+    ticks and rolling statistics of the mid and spread of the price books. Book statistics get a sample whenever the
+    best bid or ask changes.
+
+    Arrays are returned as NumPy views on the internal buffers, nothing is copied. Updates happen on the event loop
+    thread, so the views of the series and statistics returned here may only be read on that thread, and only until the
+    next update of that instrument. Other threads read a copy() made on the event loop, which is what the Exchange
+    getters return. NumPy is only needed to read arrays.
+    """
+    def __init__(self, bar_interval=DEFAULT_BAR_INTERVAL, nr_bars=DEFAULT_NR_BARS, window=DEFAULT_WINDOW, ewma_alpha=DEFAULT_EWMA_ALPHA):
+        self._bar_interval_ns = int(bar_interval * 1e9)
+        self._nr_bars = nr_bars
+        self._window = window
+        self._ewma_alpha = ewma_alpha
+        self._bars = {}
+        self._mids = {}
+        self._spreads = {}
+        self._last_top = {}
+
+    def on_trade_tick(self, instrument_id, timestamp_ns, price, volume):
+        bars = self._bars.get(instrument_id)
+        if bars is None:
+            bars = self._bars[instrument_id] = BarSeries(self._bar_interval_ns, self._nr_bars)
+        bars.on_trade(timestamp_ns, price, volume)
+
+    def on_price_book(self, instrument_id, price_book):
+        if not price_book.bids or not price_book.asks:
+            return
+        bid = price_book.bids[0].price
+        ask = price_book.asks[0].price
+        if self._last_top.get(instrument_id) == (bid, ask):
+            return
+        self._last_top[instrument_id] = (bid, ask)
+        mids = self._mids.get(instrument_id)
+        if mids is None:
+            mids = self._mids[instrument_id] = RollingStats(self._window, self._ewma_alpha)
+            self._spreads[instrument_id] = RollingStats(self._window, self._ewma_alpha)
+        now_ns = time.time_ns()
+        mids.add(now_ns, (bid + ask) / 2)
+        self._spreads[instrument_id].add(now_ns, ask - bid)
+
+    def get_bars(self, instrument_id):
+        return self._bars.get(instrument_id)
+
+    def get_mid_stats(self, instrument_id):
+        return self._mids.get(instrument_id)
+
+    def get_spread_stats(self, instrument_id):
+        return self._spreads.get(instrument_id)
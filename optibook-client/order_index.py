@@ -0,0 +1,161 @@
+import types
+from collections import OrderedDict
+
+# Orders that went to volume 0 are remembered for this many order updates, long enough for a strategy to notice
+MAX_DONE_ORDERS = 4096
+# Returned for instruments without orders, looking one up must not add entries for it
+_NO_ORDERS = types.MappingProxyType({})
+
+
+class OrderPlan:
+    """
+    Order requests needed to move the resting orders on one side of an instrument to a target.
+
+    amends: list of (order_id, new_volume), deletes: list of order_id, inserts: list of (price, volume).
+    After the plan is executed, inserted_order_ids holds the order ids of the inserts in the same order.
+    """
+    def __init__(self, instrument_id, side):
+        self.instrument_id = instrument_id
+        self.side = side
+        self.amends = []
+        self.deletes = []
+        self.inserts = []
+        self.inserted_order_ids = []
+
+    def is_empty(self):
+        return not self.amends and not self.deletes and not self.inserts
+
+    def nr_requests(self):
+        return len(self.amends) + len(self.deletes) + len(self.inserts)
+
+    def __repr__(self):
+        return f"[order_plan] instrument_id={self.instrument_id}, side={self.side}, amends={self.amends}, deletes={self.deletes}, inserts={self.inserts}"
+
+
+class OrderIndex:
+    """
+    Resting orders indexed by order_id, by instrument and by (instrument, side, price).
+
+    Views returned by get_orders() are read-only and live: they are not copied and always reflect the latest order
+    updates, except the shared empty view returned for an instrument that never had an order. Resting volume per side
+    and per price level is maintained on every update, so lookups are O(1).
+
+    An order that is not in the index was either never seen or is done. is_done() tells the two apart for the most
+    recent MAX_DONE_ORDERS orders that went to volume 0.
+    """
+    def __init__(self):
+        self._done = OrderedDict()
+        self._by_id = {}
+        self._by_instrument = {}
+        self._views = {}
+        self._levels = {}
+        self._volume = {}
+
+    def _instrument_orders(self, instrument_id):
+        orders = self._by_instrument.get(instrument_id)
+        if orders is None:
+            orders = {}
+            self._by_instrument[instrument_id] = orders
+            self._views[instrument_id] = types.MappingProxyType(orders)
+        return orders
+
+    def update(self, order_status):
+        """
+        Applies an order update. An order with volume 0 is removed from the index.
+        """
+        previous = self._by_id.get(order_status.order_id)
+        if previous is not None:
+            self._remove(previous)
+        if order_status.volume > 0:
+            self._add(order_status)
+        else:
+            self._done[order_status.order_id] = None
+            if len(self._done) > MAX_DONE_ORDERS:
+                self._done.popitem(last=False)
+
+    def _add(self, o):
+        side = str(o.side)
+        self._by_id[o.order_id] = o
+        self._instrument_orders(o.instrument_id)[o.order_id] = o
+        levels = self._levels.setdefault((o.instrument_id, side), {})
+        levels.setdefault(o.price, {})[o.order_id] = o
+        key = (o.instrument_id, side)
+        self._volume[key] = self._volume.get(key, 0) + o.volume
+
+    def _remove(self, o):
+        side = str(o.side)
+        del self._by_id[o.order_id]
+        del self._by_instrument[o.instrument_id][o.order_id]
+        levels = self._levels[(o.instrument_id, side)]
+        level = levels[o.price]
+        del level[o.order_id]
+        if not level:
+            del levels[o.price]
+        self._volume[(o.instrument_id, side)] -= o.volume
+
+    def clear(self):
+        for orders in self._by_instrument.values():
+            orders.clear()
+        self._by_id.clear()
+        self._done.clear()
+        self._levels.clear()
+        self._volume.clear()
+
+    def get_order(self, order_id):
+        return self._by_id.get(order_id)
+
+    def is_done(self, order_id):
+        return order_id in self._done
+
+    def get_orders(self, instrument_id):
+        return self._views.get(instrument_id, _NO_ORDERS)
+
+    def get_resting_volume(self, instrument_id, side):
+        return self._volume.get((instrument_id, side), 0)
+
+    def get_level_volume(self, instrument_id, side, price):
+        level = self._levels.get((instrument_id, side), {}).get(price)
+        if not level:
+            return 0
+        return sum(o.volume for o in level.values())
+
+    def get_level_prices(self, instrument_id, side):
+        return list(self._levels.get((instrument_id, side), {}).keys())
+
+    def plan(self, instrument_id, side, targets):
+        """
+        Plans the requests that change the resting orders on one side of an instrument into the target volume per price.
+
+        Levels that already hold the target volume are left alone. Levels with too much volume are reduced by amending
+        the most recent orders down, which keeps queue priority of the older orders. Missing volume is inserted as a new
+        order. Orders on prices that are not in targets are deleted.
+
+        :param targets: dictionary mapping price to the desired total resting volume at that price.
+        """
+        plan = OrderPlan(instrument_id, side)
+        levels = self._levels.get((instrument_id, side), {})
+
+        for price, level in levels.items():
+            target = targets.get(price, 0)
+            resting = sum(o.volume for o in level.values())
+            if target >= resting:
+                continue
+            excess = resting - target
+            # dicts keep insertion order, so the newest orders are at the end
+            for o in reversed(list(level.values())):
+                if excess == 0:
+                    break
+                if o.volume <= excess:
+                    plan.deletes.append(o.order_id)
+                    excess -= o.volume
+                else:
+                    plan.amends.append((o.order_id, o.volume - excess))
+                    excess = 0
+
+        for price, target in targets.items():
+            level = levels.get(price)
+            resting = sum(o.volume for o in level.values()) if level else 0
+            if target > resting:
+                plan.inserts.append((price, target - resting))
+
+        return plan
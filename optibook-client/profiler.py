@@ -0,0 +1,175 @@
+"""
+On-demand sampling profiler.
+
+While running, a background thread takes the stack of each profiled thread at a fixed interval with
+sys._current_frames() and counts identical stacks. On stop the counts are written as collapsed stacks, one
+"thread;outer;...;inner count" line per stack, the input format of flamegraph.pl and speedscope. When the profiler is
+not running there is no thread and no hook, so it costs nothing.
+
+Toggle it in a running process with a signal or through a control socket:
+
+    kill -USR2 <pid>
+    echo start | nc -U profiler.sock        # start, stop or status
+
+To print the functions with the most samples in a profile:
+
+    python -m optibook.profiler profile-1234-20200818-120000.folded
+"""
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger('client')
+
+DEFAULT_INTERVAL = 0.005
+LOOP_THREAD_NAME = 'optibook-loop'
+DEFAULT_THREAD_NAMES = ('MainThread', LOOP_THREAD_NAME)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_names=DEFAULT_THREAD_NAMES, output_dir='.'):
+        self._interval = interval
+        self._thread_names = thread_names
+        self._output_dir = output_dir
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+        self._counts = Counter()
+        self._labels = {}
+        self._nr_samples = 0
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._counts = Counter()
+            self._nr_samples = 0
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stop,), name='optibook-profiler', daemon=True)
+            self._thread.start()
+        logger.info(f"Profiler started, sampling {', '.join(self._thread_names)} every {self._interval * 1000:.1f}ms")
+
+    def stop(self):
+        """
+        Stops sampling and writes the collapsed stacks. Returns the path of the written file, None if not running.
+        """
+        with self._lock:
+            if self._thread is None:
+                return None
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        path = os.path.join(self._output_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        self.write(path)
+        logger.info(f"Profiler stopped after {self._nr_samples} samples, stacks written to {path}")
+        return path
+
+    def toggle(self):
+        if self.is_running():
+            return self.stop()
+        self.start()
+        return None
+
+    def _run(self, stop):
+        while not stop.wait(self._interval):
+            self._sample()
+
+    def _sample(self):
+        # Threads can come and go (e.g. on reconnect), so look them up by name on every sample
+        names = {t.ident: t.name for t in threading.enumerate() if t.name in self._thread_names}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident)
+            if name is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(name)
+            self._counts[';'.join(reversed(stack))] += 1
+        self._nr_samples += 1
+
+    def _label(self, code):
+        # Formatting is the bulk of the cost of a sample, do it once per code object
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self._counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def install_signal_handler(self, signum=getattr(signal, 'SIGUSR2', None)):
+        """
+        Toggles the profiler on the given signal. Has to be called from the main thread.
+        """
+        if signum is None:
+            logger.warning("Signals are not available on this platform, use serve_control_socket instead")
+            return
+        signal.signal(signum, lambda signum, frame: self.toggle())
+
+    def serve_control_socket(self, path):
+        """
+        Listens on a unix socket for the commands start, stop and status, one per connection.
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        threading.Thread(target=self._serve, args=(server,), name='optibook-profiler-control', daemon=True).start()
+        return server
+
+    def _serve(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                # socket closed
+                return
+            with conn:
+                command = conn.recv(64).decode(errors='replace').strip()
+                if command == 'start':
+                    self.start()
+                    reply = 'started'
+                elif command == 'stop':
+                    reply = f"written to {self.stop()}"
+                elif command == 'status':
+                    reply = f"running, {self._nr_samples} samples" if self.is_running() else 'stopped'
+                else:
+                    reply = f"unknown command {command!r}, use start, stop or status"
+                conn.sendall((reply + '\n').encode())
+
+
+def self_time(lines):
+    """
+    Number of samples per function at the top of the stack, from collapsed stack lines.
+    """
+    counts = Counter()
+    for line in lines:
+        stack, _, count = line.rstrip('\n').rpartition(' ')
+        if stack:
+            counts[stack.rsplit(';', 1)[-1]] += int(count)
+    return counts
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python -m optibook.profiler <profile.folded> [nr_functions]")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        counts = self_time(f)
+    total = sum(counts.values()) or 1
+    for function, count in counts.most_common(int(sys.argv[2]) if len(sys.argv) > 2 else 25):
+        print(f"{count / total:7.1%} {count:8} {function}")
@@ -0,0 +1,161 @@
+import logging
+
+logger = logging.getLogger('client')
+
+INSTRUMENT_LIMITS = ['max_position', 'max_order_volume', 'max_outstanding_volume']
+PORTFOLIO_LIMITS = ['max_gross_position', 'max_outstanding_volume', 'max_outstanding_notional']
+
+
+class RiskLimitBreached(Exception):
+    pass
+
+
+class PreTradeRisk:
+    """
+    Pre-trade risk checks on incrementally maintained counters.
+
+    Positions are fed from trades and single sided bookings, outstanding volume and notional from order updates
+    and from orders that are in flight to the exchange. Every check is a handful of dict lookups and comparisons.
+
+    Worst case positions are checked: a bid may only be sent if position plus all outstanding bid volume plus the new
+    volume stays within max_position, and likewise for asks.
+
+    Limits can be changed at any time. A limit of None disables that check.
+    """
+    def __init__(self):
+        self._default_limits = dict.fromkeys(INSTRUMENT_LIMITS)
+        self._instrument_limits = {}
+        self._portfolio_limits = dict.fromkeys(PORTFOLIO_LIMITS)
+        self.reset_counters()
+
+    def reset_counters(self):
+        self._position = {}
+        self._gross_position = 0
+        self._outstanding_bid = {}
+        self._outstanding_ask = {}
+        self._outstanding_volume = 0
+        self._outstanding_notional = 0.0
+        self._orders = {}
+        self._nr_rejected = 0
+
+    def set_instrument_limits(self, instrument_id=None, **limits):
+        """
+        Sets limits for one instrument, or the defaults for all instruments without own limits if instrument_id is None.
+        """
+        for name in limits:
+            assert name in INSTRUMENT_LIMITS, f"Unknown instrument limit '{name}', use one of {INSTRUMENT_LIMITS}"
+        if instrument_id is None:
+            self._default_limits.update(limits)
+        else:
+            current = self._instrument_limits.get(instrument_id, dict.fromkeys(INSTRUMENT_LIMITS))
+            current.update(limits)
+            self._instrument_limits[instrument_id] = current
+
+    def set_portfolio_limits(self, **limits):
+        for name in limits:
+            assert name in PORTFOLIO_LIMITS, f"Unknown portfolio limit '{name}', use one of {PORTFOLIO_LIMITS}"
+        self._portfolio_limits.update(limits)
+
+    def get_limits(self, instrument_id):
+        limits = self._instrument_limits.get(instrument_id)
+        if limits is None:
+            return dict(self._default_limits)
+        return {k: v if v is not None else self._default_limits[k] for k, v in limits.items()}
+
+    def _limit(self, instrument_id, name):
+        limits = self._instrument_limits.get(instrument_id)
+        if limits is not None and limits[name] is not None:
+            return limits[name]
+        return self._default_limits[name]
+
+    def _reject(self, reason):
+        self._nr_rejected += 1
+        raise RiskLimitBreached(reason)
+
+    def check(self, instrument_id, price, volume, side):
+        if volume <= 0:
+            self._reject(f"Order volume must be positive, got {volume}")
+        if price <= 0:
+            self._reject(f"Order price must be positive, got {price}")
+
+        max_order_volume = self._limit(instrument_id, 'max_order_volume')
+        if max_order_volume is not None and volume > max_order_volume:
+            self._reject(f"Order volume {volume} on '{instrument_id}' exceeds max_order_volume {max_order_volume}")
+
+        position = self._position.get(instrument_id, 0)
+        if side == 'bid':
+            outstanding = self._outstanding_bid.get(instrument_id, 0)
+            worst_position = position + outstanding + volume
+        else:
+            outstanding = self._outstanding_ask.get(instrument_id, 0)
+            worst_position = position - outstanding - volume
+
+        max_position = self._limit(instrument_id, 'max_position')
+        if max_position is not None and abs(worst_position) > max_position and abs(worst_position) > abs(position):
+            self._reject(f"Worst case position {worst_position} on '{instrument_id}' would exceed max_position {max_position}")
+
+        max_outstanding = self._limit(instrument_id, 'max_outstanding_volume')
+        if max_outstanding is not None and outstanding + volume > max_outstanding:
+            self._reject(f"Outstanding {side} volume on '{instrument_id}' would exceed max_outstanding_volume {max_outstanding}")
+
+        portfolio = self._portfolio_limits
+        if portfolio['max_gross_position'] is not None:
+            gross = self._gross_position - abs(position) + abs(worst_position)
+            if gross > portfolio['max_gross_position'] and gross > self._gross_position:
+                self._reject(f"Gross position {gross} would exceed max_gross_position {portfolio['max_gross_position']}")
+        if portfolio['max_outstanding_volume'] is not None and self._outstanding_volume + volume > portfolio['max_outstanding_volume']:
+            self._reject(f"Total outstanding volume would exceed max_outstanding_volume {portfolio['max_outstanding_volume']}")
+        if portfolio['max_outstanding_notional'] is not None and self._outstanding_notional + price * volume > portfolio['max_outstanding_notional']:
+            self._reject(f"Total outstanding notional would exceed max_outstanding_notional {portfolio['max_outstanding_notional']}")
+
+    def _add_outstanding(self, instrument_id, price, volume, side):
+        outstanding = self._outstanding_bid if side == 'bid' else self._outstanding_ask
+        outstanding[instrument_id] = outstanding.get(instrument_id, 0) + volume
+        self._outstanding_volume += volume
+        self._outstanding_notional += price * volume
+
+    def reserve(self, instrument_id, price, volume, side):
+        """
+        Checks an order and counts its volume as outstanding until release() is called.
+        """
+        self.check(instrument_id, price, volume, side)
+        self._add_outstanding(instrument_id, price, volume, side)
+
+    def release(self, instrument_id, price, volume, side):
+        self._add_outstanding(instrument_id, price, -volume, side)
+
+    def on_order_update(self, order_id, instrument_id, price, volume, side):
+        previous = self._orders.get(order_id)
+        if previous is not None:
+            self._add_outstanding(previous[0], previous[1], -previous[2], previous[3])
+        if volume == 0:
+            self._orders.pop(order_id, None)
+        else:
+            self._orders[order_id] = (instrument_id, price, volume, side)
+            self._add_outstanding(instrument_id, price, volume, side)
+
+    def get_outstanding(self, instrument_id):
+        return self._outstanding_bid.get(instrument_id, 0), self._outstanding_ask.get(instrument_id, 0)
+
+    def get_order(self, order_id):
+        return self._orders.get(order_id)
+
+    def on_position_change(self, instrument_id, delta):
+        position = self._position.get(instrument_id, 0)
+        new_position = position + delta
+        self._position[instrument_id] = new_position
+        self._gross_position += abs(new_position) - abs(position)
+
+    def set_position(self, instrument_id, position):
+        self.on_position_change(instrument_id, position - self._position.get(instrument_id, 0))
+
+    def get_position(self, instrument_id):
+        return self._position.get(instrument_id, 0)
+
+    def get_metrics(self):
+        return {
+            'gross_position': self._gross_position,
+            'outstanding_volume': self._outstanding_volume,
+            'outstanding_notional': self._outstanding_notional,
+            'rejected': self._nr_rejected,
+        }
@@ -0,0 +1,285 @@
+"""
+Account wide risk shared by several trading processes.
+
+The exchange limits the position of the whole account, but every process only sees its own orders. A SharedRiskBook
+keeps the account position and the outstanding volume of all processes per instrument in shared memory. A process
+reserves its worst case position in the book before it sends an order, so the processes together never exceed
+max_position.
+
+Create the book once, then pass its name to every process:
+
+    python -m optibook.shared_risk create optibook-risk --max-position 500 SAP ASML ...
+    python -m optibook.shared_risk status optibook-risk
+    python -m optibook.shared_risk remove optibook-risk
+
+Needs byte range locks from fcntl, which are not available on Windows. The module still imports there, create() and
+attach() raise.
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+from .risk import RiskLimitBreached
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('client')
+
+DEFAULT_MAX_PROCESSES = 64
+INSTRUMENT_ID_SIZE = 32
+
+_MAGIC = 0x6f70746972736b31
+_HEADER_SIZE = 3
+# Per instrument: account position, outstanding bid and ask of all processes, max position
+_ROW_SIZE = 4
+_POSITION, _BID, _ASK, _MAX_POSITION = range(_ROW_SIZE)
+
+
+def _lock_path(name):
+    return os.path.join(tempfile.gettempdir(), f"{name}.lock")
+
+
+class SharedRiskBook:
+    """
+    Create the book once with create(), every trading process then uses its own attach().
+
+    Every instrument has its own lock, a byte range lock on a file next to the shared memory, so processes trading
+    different instruments don't wait for each other. A reservation takes one lock and one unlock system call.
+
+    Positions are absolute and can be set by any process: every process of the account receives the account's trades,
+    so they all agree on them. Outstanding volume is added up, each process keeps its own share in a slot. Slots of
+    processes that died are freed by the next process that attaches.
+    """
+    def __init__(self, name, shm):
+        self.name = name
+        self._shm = shm
+        self._words = shm.buf.cast('q')
+        magic, nr_instruments, self._max_processes = self._words[:_HEADER_SIZE]
+        assert magic == _MAGIC, f"Shared memory '{name}' is not a risk book"
+        names_offset = _HEADER_SIZE * 8
+        self._instruments = {}
+        for index in range(nr_instruments):
+            raw = bytes(shm.buf[names_offset + index * INSTRUMENT_ID_SIZE:names_offset + (index + 1) * INSTRUMENT_ID_SIZE])
+            self._instruments[raw.rstrip(b'\0').decode()] = index
+        self._nr_instruments = nr_instruments
+        self._rows = _HEADER_SIZE + nr_instruments * INSTRUMENT_ID_SIZE // 8
+        self._slots = self._rows + nr_instruments * _ROW_SIZE
+        self._slot_size = 1 + 2 * nr_instruments
+        self._lock_fd = os.open(_lock_path(name), os.O_RDWR | os.O_CREAT, 0o600)
+        # Byte range locks belong to the process, threads of this process are kept apart by this lock
+        self._thread_lock = threading.RLock()
+        self._slot = None
+
+    @classmethod
+    def create(cls, name, instrument_ids, max_position, max_processes=DEFAULT_MAX_PROCESSES):
+        _check_platform()
+        instrument_ids = list(instrument_ids)
+        for instrument_id in instrument_ids:
+            assert len(instrument_id.encode()) <= INSTRUMENT_ID_SIZE, f"Instrument id '{instrument_id}' is too long"
+        nr_words = _HEADER_SIZE + len(instrument_ids) * (INSTRUMENT_ID_SIZE // 8 + _ROW_SIZE) + max_processes * (1 + 2 * len(instrument_ids))
+        shm = shared_memory.SharedMemory(name=name, create=True, size=nr_words * 8)
+        words = shm.buf.cast('q')
+        names_offset = _HEADER_SIZE * 8
+        for index, instrument_id in enumerate(instrument_ids):
+            encoded = instrument_id.encode()
+            shm.buf[names_offset + index * INSTRUMENT_ID_SIZE:names_offset + index * INSTRUMENT_ID_SIZE + len(encoded)] = encoded
+            words[_HEADER_SIZE + len(instrument_ids) * INSTRUMENT_ID_SIZE // 8 + index * _ROW_SIZE + _MAX_POSITION] = max_position
+        words[1] = len(instrument_ids)
+        words[2] = max_processes
+        # Written last, attach() checks it
+        words[0] = _MAGIC
+        words.release()
+        _untrack(shm)
+        return cls(name, shm)
+
+    @classmethod
+    def attach(cls, name):
+        _check_platform()
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        book = cls(name, shm)
+        book._claim_slot()
+        return book
+
+    def close(self):
+        """
+        Gives back the outstanding volume of this process and detaches.
+        """
+        if self._slot is not None:
+            for index in range(self._nr_instruments):
+                self._set_outstanding(index, 0, 0)
+            with self._locked(self._nr_instruments):
+                self._words[self._slot] = 0
+            self._slot = None
+        self._words.release()
+        self._shm.close()
+        os.close(self._lock_fd)
+
+    def remove(self):
+        self.close()
+        # unlink() unregisters from the resource tracker again
+        resource_tracker.register(self._shm._name, 'shared_memory')
+        self._shm.unlink()
+        if os.path.exists(_lock_path(self.name)):
+            os.unlink(_lock_path(self.name))
+
+    def _locked(self, index):
+        return _RangeLock(self._lock_fd, self._thread_lock, index)
+
+    def _claim_slot(self):
+        # The range after the instruments locks the slot table
+        with self._locked(self._nr_instruments):
+            free = None
+            for slot in range(self._max_processes):
+                offset = self._slots + slot * self._slot_size
+                pid = self._words[offset]
+                if pid != 0 and not _is_alive(pid):
+                    logger.warning(f"Freeing the risk book slot of process {pid}, it is no longer running")
+                    self._words[offset] = 0
+                    self._free_slot(offset)
+                    pid = 0
+                if pid == 0 and free is None:
+                    free = offset
+            if free is None:
+                raise Exception(f"Risk book '{self.name}' is full, it was created for {self._max_processes} processes")
+            self._words[free] = os.getpid()
+            self._slot = free
+
+    def _free_slot(self, offset):
+        for index in range(self._nr_instruments):
+            with self._locked(index):
+                row = self._rows + index * _ROW_SIZE
+                self._words[row + _BID] -= self._words[offset + 1 + 2 * index]
+                self._words[row + _ASK] -= self._words[offset + 2 + 2 * index]
+                self._words[offset + 1 + 2 * index] = 0
+                self._words[offset + 2 + 2 * index] = 0
+
+    def get_index(self, instrument_id):
+        """
+        The index of an instrument, None if the book doesn't limit it.
+        """
+        return self._instruments.get(instrument_id)
+
+    def reserve(self, index, volume, side):
+        """
+        Adds volume to the outstanding volume of this process if the worst case account position stays within
+        max_position, raises RiskLimitBreached otherwise.
+        """
+        words = self._words
+        row = self._rows + index * _ROW_SIZE
+        own = self._slot + 1 + 2 * index + (0 if side == 'bid' else 1)
+        with self._locked(index):
+            position = words[row + _POSITION]
+            if side == 'bid':
+                worst_position = position + words[row + _BID] + volume
+            else:
+                worst_position = position - words[row + _ASK] - volume
+            max_position = words[row + _MAX_POSITION]
+            if abs(worst_position) > max_position and abs(worst_position) > abs(position):
+                raise RiskLimitBreached(f"Worst case account position {worst_position} would exceed max_position {max_position}")
+            words[row + (_BID if side == 'bid' else _ASK)] += volume
+            words[own] += volume
+
+    def set_outstanding(self, index, bid, ask):
+        """
+        Sets the outstanding volume of this process to what it has reserved and resting at the exchange.
+        """
+        offset = self._slot + 1 + 2 * index
+        if self._words[offset] != bid or self._words[offset + 1] != ask:
+            self._set_outstanding(index, bid, ask)
+
+    def _set_outstanding(self, index, bid, ask):
+        words = self._words
+        row = self._rows + index * _ROW_SIZE
+        offset = self._slot + 1 + 2 * index
+        with self._locked(index):
+            words[row + _BID] += bid - words[offset]
+            words[row + _ASK] += ask - words[offset + 1]
+            words[offset] = bid
+            words[offset + 1] = ask
+
+    def set_position(self, index, position):
+        self._words[self._rows + index * _ROW_SIZE + _POSITION] = position
+
+    def set_max_position(self, index, max_position):
+        self._words[self._rows + index * _ROW_SIZE + _MAX_POSITION] = max_position
+
+    def get_state(self):
+        """
+        Per instrument the account position, the outstanding bid and ask volume of all processes and max_position.
+        """
+        return {instrument_id: tuple(self._words[self._rows + index * _ROW_SIZE:self._rows + (index + 1) * _ROW_SIZE])
+                for instrument_id, index in self._instruments.items()}
+
+    def get_processes(self):
+        return [self._words[self._slots + slot * self._slot_size] for slot in range(self._max_processes)
+                if self._words[self._slots + slot * self._slot_size] != 0]
+
+
+class _RangeLock:
+    __slots__ = ('_fd', '_thread_lock', '_index')
+
+    def __init__(self, fd, thread_lock, index):
+        self._fd = fd
+        self._thread_lock = thread_lock
+        self._index = index
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._index)
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._index)
+        self._thread_lock.release()
+
+
+def _check_platform():
+    if fcntl is None:
+        raise Exception("A shared risk book needs fcntl byte range locks, which are not available on this platform")
+
+
+def _untrack(shm):
+    # The book outlives the processes that use it, only remove() unlinks it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+if __name__ == '__main__':
+    usage = "usage: python -m optibook.shared_risk create <name> --max-position <n> <instrument_id>... | status <name> | remove <name>"
+    if len(sys.argv) < 3:
+        print(usage)
+        sys.exit(1)
+    command, name, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if command == 'create' and len(args) >= 3 and args[0] == '--max-position':
+        SharedRiskBook.create(name, args[2:], int(args[1])).close()
+        print(f"Created risk book '{name}' for {len(args) - 2} instruments")
+    elif command == 'status':
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        book = SharedRiskBook(name, shm)
+        print(f"processes {book.get_processes()}")
+        for instrument_id, (position, bid, ask, max_position) in book.get_state().items():
+            print(f"{instrument_id:{INSTRUMENT_ID_SIZE}} position {position:6}  outstanding bid {bid:6}  ask {ask:6}  max {max_position}")
+    elif command == 'remove':
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        SharedRiskBook(name, shm).remove()
+        print(f"Removed risk book '{name}'")
+    else:
+        print(usage)
+        sys.exit(1)
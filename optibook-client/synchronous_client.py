@@ -1,16 +1,23 @@
+import asyncio
 import logging
 import typing
 
 from . import exchange_client
 from .exchange_client import InfoClient, ExecClient
 from .synchronous_wrapper import SynchronousWrapper
-from .common_types import PriceBook, PriceVolume, Trade, TradeTick, OrderStatus
+from .common_types import PriceBook, PriceVolume, Trade, TradeTick, OrderStatus, Instrument
+from .order_index import OrderPlan
+from .market_stats import MarketStats, BarSeries, RollingStats
+from .journal import FillJournal, Fill
+from .shared_risk import SharedRiskBook
+from .runtime import RuntimeProfile
 
 logger = logging.getLogger('client')
 
 DEFAULT_HOST = 'opamux0674'
 DEFAULT_INFO_PORT = 7001
 DEFAULT_EXEC_PORT = 8001
+BOOKS_TIMEOUT = 5
 
 
 class Exchange:
@@ -19,7 +26,14 @@ class Exchange:
                  info_port: int = DEFAULT_INFO_PORT,
                  exec_port: int = DEFAULT_EXEC_PORT,
                  full_message_logging: bool = False,
-                 max_nr_trade_history: int = 100):
+                 max_nr_trade_history: int = 100,
+                 max_orders_per_second: float = None,
+                 max_orders_per_second_per_instrument: float = None,
+                 market_stats: MarketStats = None,
+                 runtime: RuntimeProfile = None,
+                 journal: FillJournal = None,
+                 shared_risk: SharedRiskBook = None,
+                 instrument_ids: typing.List[str] = None):
         """
         Initiate an Exchange Client instance.
 
@@ -29,14 +43,31 @@ class Exchange:
         :param full_message_logging: If set to to True enables logging on VERBOSE level, displaying among others all messages sent to and received from the
                                      exchange.
         :param max_nr_trade_history: Keep at most this number of trades per instrument in history. Older trades will be removed automatically
+        :param max_orders_per_second: Optional, maximum number of order requests (inserts, amends and deletes) per second over all instruments.
+                                      Requests above the limit are queued.
+        :param max_orders_per_second_per_instrument: Optional, maximum number of order requests per second on a single instrument.
+        :param market_stats: Optional, a MarketStats instance that keeps time bars of the trade ticks and rolling mid and spread statistics
+                             of every instrument. See get_bars(), get_mid_stats() and get_spread_stats().
+        :param runtime: Optional, a RuntimeProfile with low latency settings (uvloop, GC tuning, CPU pinning, busy polling) for the
+                        thread that talks to the exchange. Call its on_strategy_ready() from the trading thread once it is set up.
+        :param journal: Optional, a FillJournal that durably stores every private trade and single sided booking, and the positions at login.
+                        See get_fills().
+        :param shared_risk: Optional, a SharedRiskBook attached to by every process trading on this account. Orders are only sent if the worst
+                            case position of the whole account stays within its max_position, otherwise RiskLimitBreached is raised.
+        :param instrument_ids: Optional, only keep price books and trade ticks of these instruments, the ones of all other instruments
+                               are dropped as they arrive. Positions, trades and instrument updates are kept for all instruments.
         """
 
         if full_message_logging:
             exchange_client.logger.setLevel('VERBOSE')
 
-        self._i = InfoClient(host=host, port=info_port, max_nr_trade_history=max_nr_trade_history)
-        self._e = ExecClient(host=host, port=exec_port, max_nr_trade_history=max_nr_trade_history)
-        self._wrapper = SynchronousWrapper([self._i, self._e])
+        self._i = InfoClient(host=host, port=info_port, max_nr_trade_history=max_nr_trade_history, market_stats=market_stats, instrument_ids=instrument_ids)
+        self._e = ExecClient(host=host, port=exec_port, max_nr_trade_history=max_nr_trade_history,
+                             max_orders_per_second=max_orders_per_second,
+                             max_orders_per_second_per_instrument=max_orders_per_second_per_instrument,
+                             journal=journal,
+                             shared_risk=shared_risk)
+        self._wrapper = SynchronousWrapper([self._i, self._e], runtime=runtime)
 
     def is_connected(self) -> bool:
         """
@@ -44,18 +75,54 @@ class Exchange:
         """
         return self._wrapper.is_connected()
 
-    def connect(self, username, password, admin_password=None) -> None:
+    def get_connection_state(self) -> str:
+        """
+        Returns 'connecting', 'connected', 'degraded' (only some of the connections to the exchange are up) or 'closed'.
+        """
+        return self._wrapper.get_state()
+
+    def add_connection_state_callback(self, f) -> int:
+        """
+        Registers f(state) to be called whenever the connection state changes. f is called from the thread that talks to the
+        exchange and should return quickly. Returns an id for remove_connection_state_callback().
+
+        :param f: Function taking the new state.
+        """
+        return self._wrapper.add_state_callback(f)
+
+    def remove_connection_state_callback(self, c_id: int) -> None:
+        """
+        :param c_id: The id returned by add_connection_state_callback().
+        """
+        self._wrapper.remove_state_callback(c_id)
+
+    def connect(self, username, password, admin_password=None, instrument_ids: typing.List[str] = None,
+                timeout: float = BOOKS_TIMEOUT) -> None:
         """
         Attempt to connect to the exchange with specified username and password. Only a single connection can be made on a single username.
 
         The admin_password field is reserved for dedicated clients only and can be left empty.
+
+        :param instrument_ids: Optional, also wait until a price book was received for each of these instruments, at most timeout seconds.
+                               The login and the books are waited for at the same time.
+        :param timeout: How long to wait for the price books of instrument_ids.
         """
         self._wrapper.connect()
 
+        async def wait_for_books():
+            try:
+                await asyncio.wait_for(self._i.wait_for_price_books(instrument_ids), timeout)
+            except asyncio.TimeoutError:
+                missing = [i for i in instrument_ids if self._i.get_last_price_book(i) is None]
+                logger.warning(f"No price book received within {timeout}s for {missing}")
+
+        async def login():
+            if instrument_ids:
+                return (await asyncio.gather(self._e.authenticate(username, password, admin_password), wait_for_books()))[0]
+            return await self._e.authenticate(username, password, admin_password)
+
         try:
-            return self._wrapper.run_on_loop(
-                self._e.authenticate(username, password, admin_password)
-            )
+            return self._wrapper.run_on_loop(login())
         except:
             logger.error('''
 Unable to authenticate with the server. Please double-check that your username and password are correct
@@ -78,12 +145,19 @@ Unable to authenticate with the server. Please double-check that your username a
         :param side: 'bid' or 'ask', a bid order is an order to buy while an ask order is an order to sell.
         :param order_type: 'limit' or 'ioc', limit orders stay in the book while any remaining volume of an IOC that is not immediately matched is cancelled.
 
+        :raises RiskLimitBreached: if the order breaches a pre-trade risk limit, see set_risk_limits.
+        :raises InstrumentNotTradable: if the instrument is paused or has expired, the order is then not sent.
         :return: an InsertOrderReply containing a request_id as well as an order_id, the order_id can be used to e.g. delete or amend the limit order later.
+                 When order throttling is enabled, None is returned for a queued IOC that was superseded by a newer IOC on the same side.
         """
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         assert(side in exchange_client.ALL_SIDES), f"Invalid value ({side}) for parameter 'side'. Use synchronous_client.BID or synchronous_client.ASK"
         assert order_type in exchange_client.ALL_ORDER_TYPES, f"order_type must be one of {exchange_client.ALL_ORDER_TYPES}"
 
+        instruments = self._i.get_instrument_table()
+        instruments.check_tradable(instrument_id)
+        # Off-tick prices are rounded onto the tick grid, bids down and asks up
+        price = instruments.normalize_price(instrument_id, price, side)
         return self._wrapper.run_on_loop(
             self._e.insert_order(instrument_id=instrument_id, price=price, volume=volume, side=side, order_type=order_type)
         )
@@ -127,6 +201,30 @@ Unable to authenticate with the server. Please double-check that your username a
             self._e.delete_orders(instrument_id)
         )
 
+    def requote(self, instrument_id: str, *, side: str, targets: typing.Dict[float, int], order_type: str = exchange_client.ORDER_TYPE_LIMIT) -> OrderPlan:
+        """
+        Change the outstanding orders on one side of an instrument into the target volume per price, sending only the requests needed for that.
+
+        Levels that already hold the target volume are left alone, levels with too much volume are amended down (newest orders first) and missing
+        volume is inserted. Orders on prices not in targets are deleted, so passing an empty targets dictionary deletes all outstanding orders
+        on that side without sending anything if there are none.
+
+        :param instrument_id: the instrument_id of the instrument to requote.
+        :param side: 'bid' or 'ask'.
+        :param targets: dictionary mapping price to the desired total outstanding volume at that price.
+        :param order_type: order type used for the inserts.
+        :raises InstrumentNotTradable: if targets is not empty and the instrument is paused or has expired.
+        :return: the executed OrderPlan, with the order_ids of the inserted orders in inserted_order_ids.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        assert(side in exchange_client.ALL_SIDES), f"Invalid value ({side}) for parameter 'side'. Use synchronous_client.BID or synchronous_client.ASK"
+        if targets:
+            self._i.get_instrument_table().check_tradable(instrument_id)
+
+        return self._wrapper.run_on_loop(
+            self._e.requote(instrument_id, side, targets, order_type)
+        )
+
     def poll_new_trades(self, instrument_id: str) -> typing.List[Trade]:
         """
         Returns the private trades received for an instrument since the last time this function was called for that instrument.
@@ -146,6 +244,18 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._e.get_trade_history(instrument_id=instrument_id)
 
+    def get_fills(self, instrument_id: str = None, start: int = None, end: int = None, order_id: int = None) -> typing.List[Fill]:
+        """
+        Returns the private trades and single sided bookings in the journal, oldest first, including those of earlier sessions. Requires journal.
+
+        :param instrument_id: Optional, only return fills in this instrument.
+        :param start: Optional, only return fills at or after this timestamp, in nanoseconds since the epoch.
+        :param end: Optional, only return fills before this timestamp, in nanoseconds since the epoch.
+        :param order_id: Optional, only return the trades of this order.
+        """
+        assert self._e.get_journal() is not None, "Pass journal to the Exchange to keep a fill journal"
+        return self._e.get_journal().get_fills(instrument_id=instrument_id, start=start, end=end, order_id=order_id)
+
     def poll_new_trade_ticks(self, instrument_id: str) -> typing.List[TradeTick]:
         """
         Returns the public tradeticks received for an instrument since the last time this function was called for that instrument.
@@ -165,6 +275,46 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._i.get_trade_tick_history(instrument_id)
 
+    def get_bars(self, instrument_id: str) -> BarSeries:
+        """
+        Returns the time bars of the public tradeticks of an instrument, or None if there were no tradeticks yet. Requires market_stats.
+        bars.as_numpy() returns the completed bars as NumPy arrays per field, bars.current() the bar still in progress. The bars are a
+        copy taken on the event loop, later tradeticks don't change them.
+
+        :param instrument_id: The instrument_id of the instrument to obtain the bars for.
+        """
+        assert self._i.get_market_stats() is not None, "Pass market_stats to the Exchange to keep bars"
+        return self._copy_market_stats(self._i.get_market_stats().get_bars, instrument_id)
+
+    def get_mid_stats(self, instrument_id: str) -> RollingStats:
+        """
+        Returns the rolling statistics (mean, variance, ewma, ewm_variance and the samples themselves) of the mid price of an instrument,
+        or None if no price book was received yet. Requires market_stats. The statistics are a copy taken on the event loop.
+
+        :param instrument_id: The instrument_id of the instrument to obtain the statistics for.
+        """
+        assert self._i.get_market_stats() is not None, "Pass market_stats to the Exchange to keep statistics"
+        return self._copy_market_stats(self._i.get_market_stats().get_mid_stats, instrument_id)
+
+    def get_spread_stats(self, instrument_id: str) -> RollingStats:
+        """
+        Returns the rolling statistics of the spread of an instrument, or None if no price book was received yet. Requires market_stats.
+        The statistics are a copy taken on the event loop.
+
+        :param instrument_id: The instrument_id of the instrument to obtain the statistics for.
+        """
+        assert self._i.get_market_stats() is not None, "Pass market_stats to the Exchange to keep statistics"
+        return self._copy_market_stats(self._i.get_market_stats().get_spread_stats, instrument_id)
+
+    def _copy_market_stats(self, get, instrument_id):
+        # Updated on the event loop thread, a copy made anywhere else could be half way through an update
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+
+        async def copy():
+            stats = get(instrument_id)
+            return stats.copy() if stats is not None else None
+        return self._wrapper.run_on_loop(copy())
+
     def get_outstanding_orders(self, instrument_id: str) -> typing.List[OrderStatus]:
         """
         Returns the client's currently outstanding limit orders on an instrument.
@@ -174,6 +324,68 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._e.get_outstanding_orders(instrument_id)
 
+    def get_outstanding_order(self, order_id: int) -> OrderStatus:
+        """
+        Returns the current state of one of the client's outstanding limit orders, or None if the order is no longer outstanding.
+
+        :param order_id: The order_id of the order.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        return self._e.get_outstanding_order(order_id)
+
+    def is_order_done(self, order_id: int) -> bool:
+        """
+        Returns whether an order update showed that the order is no longer outstanding, because it traded fully or was deleted.
+        An order that get_outstanding_order() doesn't return may also not have had its first order update yet, this tells the two apart.
+        Only the most recent orders that went to volume 0 are remembered.
+
+        :param order_id: The order_id of the order.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        return self._e.is_order_done(order_id)
+
+    def get_resting_volume(self, instrument_id: str, side: str) -> int:
+        """
+        Returns the total volume of the client's currently outstanding limit orders on one side of an instrument.
+
+        :param instrument_id: The instrument_id of the instrument to obtain the outstanding volume for.
+        :param side: 'bid' or 'ask'.
+        """
+        assert self.is_connected(), "Cannot call function until connected. Call connect() first"
+        return self._e.get_resting_volume(instrument_id, side)
+
+    def get_instruments(self) -> typing.Dict[str, Instrument]:
+        """
+        Returns all instruments that have not expired, by instrument_id, with their tick size, extra info and whether they are paused.
+        """
+        return self._i.get_instruments()
+
+    def get_instrument(self, instrument_id: str) -> Instrument:
+        """
+        Returns an instrument, also if it has expired, or None if it is unknown.
+
+        :param instrument_id: The instrument_id of the instrument.
+        """
+        return self._i.get_instrument(instrument_id)
+
+    def add_instrument_callback(self, f: typing.Callable[[Instrument], None]) -> int:
+        """
+        Registers a function that is called with the Instrument whenever an instrument is created, paused, resumed or expires. The function
+        is called from the thread that runs the event loop, so it should only do little work, e.g. set a flag.
+
+        :param f: The function to call.
+        :return: an id that can be passed to remove_instrument_callback.
+        """
+        return self._i.add_instrument_callback(f)
+
+    def remove_instrument_callback(self, c_id: int) -> None:
+        """
+        Unregisters a function registered with add_instrument_callback.
+
+        :param c_id: The id returned by add_instrument_callback.
+        """
+        self._i.remove_instrument_callback(c_id)
+
     def get_last_price_book(self, instrument_id: str) -> typing.List[PriceBook]:
         """
         Returns the last received limit order book state for an instrument.
@@ -183,6 +395,37 @@ Unable to authenticate with the server. Please double-check that your username a
         assert self.is_connected(), "Cannot call function until connected. Call connect() first"
         return self._i.get_last_price_book(instrument_id)
 
+    def set_risk_limits(self, instrument_id: str = None, **limits) -> None:
+        """
+        Set pre-trade risk limits for an instrument. Orders breaching a limit are rejected locally with a RiskLimitBreached exception,
+        without being sent to the exchange. Limits can be changed at any time, a limit of None disables the check.
+
+        :param instrument_id: The instrument_id to set limits for. If not provided, sets the default limits for all instruments without own limits.
+        :param limits: Any of max_position (worst case position including outstanding orders), max_order_volume and max_outstanding_volume.
+        """
+        self._e.set_risk_limits(instrument_id, **limits)
+
+    def set_portfolio_risk_limits(self, **limits) -> None:
+        """
+        Set pre-trade risk limits over all instruments.
+
+        :param limits: Any of max_gross_position (sum of absolute worst case positions), max_outstanding_volume and max_outstanding_notional.
+        """
+        self._e.set_portfolio_risk_limits(**limits)
+
+    def get_risk_metrics(self) -> typing.Dict[str, float]:
+        """
+        Returns the pre-trade risk counters: gross position, outstanding order volume and notional, and the number of rejected orders.
+        """
+        return self._e.get_risk_metrics()
+
+    def get_throttle_metrics(self) -> typing.Dict[str, float]:
+        """
+        Returns order throttle metrics: current and maximum queue depth, number of orders sent, throttled and superseded, and total
+        and maximum time in seconds that orders spent waiting in the queue. Empty if throttling is not enabled.
+        """
+        return self._e.get_throttle_metrics()
+
     def get_positions(self) -> typing.Dict[str, int]:
         """
         Returns a dictionary mapping instrument_id to the current position in the instrument, expressed in amount of lots held.
@@ -256,9 +499,12 @@ Unable to authenticate with the server. Please double-check that your username a
 class InfoOnly:
     def __init__(self,
                  host: str = DEFAULT_HOST,
-                 info_port: int = DEFAULT_INFO_PORT):
+                 info_port: int = DEFAULT_INFO_PORT,
+                 market_stats: MarketStats = None,
+                 instrument_ids: typing.List[str] = None):
 
-        self._i = InfoClient(host=host, port=info_port)
+        self._i = InfoClient(host=host, port=info_port, market_stats=market_stats,
+                             instrument_ids=instrument_ids)
         self._wrapper = SynchronousWrapper([self._i])
 
     def is_connected(self) -> bool:
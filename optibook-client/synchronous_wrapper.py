@@ -1,40 +1,88 @@
 import concurrent
 import threading
-import time
 import logging
 import asyncio
 import datetime
 
+from .base_client import STATE_CONNECTING, STATE_CONNECTED, STATE_DEGRADED, STATE_CLOSED
+from .runtime import RuntimeProfile
+
 logger = logging.getLogger('client')
 
+CONNECT_TIMEOUT = 5
+
 
 class SynchronousWrapper:
-    def __init__(self, clients):
+    def __init__(self, clients, runtime: RuntimeProfile = None):
 
         self._clients = clients
+        self._runtime = runtime
 
         self._thread = None
-        self._loop = asyncio.new_event_loop()
+        self._loop = asyncio.new_event_loop() if runtime is None else runtime.new_event_loop()
+        # Set by the loop thread once every client connected (or failed to)
+        self._ready = threading.Event()
+        self._connect_error = None
+        # Written on the loop thread only, read from any thread
+        self._state = STATE_CLOSED
+        self._state_callbacks_id = 0
+        self._state_callbacks = {}
+        for cl in clients:
+            cl.set_state_callback(self._on_client_state)
 
     def get_loop(self):
         return self._loop
 
     def is_connected(self) -> bool:
-        return all([cl.is_connected() for cl in self._clients]) and self._loop.is_running()
+        return self._state == STATE_CONNECTED
+
+    def get_state(self) -> str:
+        return self._state
+
+    def add_state_callback(self, f):
+        """
+        Registers f(state) to be called on the event loop whenever the connection state changes.
+        """
+        c_id = self._state_callbacks_id
+        self._state_callbacks[c_id] = f
+        self._state_callbacks_id += 1
+        return c_id
+
+    def remove_state_callback(self, c_id):
+        del self._state_callbacks[c_id]
+
+    def _on_client_state(self, client, state):
+        states = [cl.get_state() for cl in self._clients]
+        if STATE_CONNECTING in states:
+            self._set_state(STATE_CONNECTING)
+        elif all(s == STATE_CONNECTED for s in states):
+            self._set_state(STATE_CONNECTED)
+        elif all(s == STATE_CLOSED for s in states):
+            self._set_state(STATE_CLOSED)
+        else:
+            self._set_state(STATE_DEGRADED)
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+        if state == STATE_DEGRADED:
+            logger.warning(f"Connection degraded: {', '.join(f'{type(cl).__name__} {cl.get_state()}' for cl in self._clients)}")
+        self._state = state
+        for f in list(self._state_callbacks.values()):
+            f(state)
 
     def connect(self) -> None:
         assert not self.is_connected(), "Cannot connect while already connected"
 
-        self._thread = threading.Thread(target=self._thread_entry_point, daemon=True)
+        self._ready.clear()
+        self._connect_error = None
+        self._thread = threading.Thread(target=self._thread_entry_point, name='optibook-loop', daemon=True)
         self._thread.start()
 
-        slept_for = 0
-        sleep_duration = 0.1
-        while not self.is_connected() and slept_for < 5:
-            time.sleep(sleep_duration)
-            slept_for += sleep_duration
+        # The clients' connect() returns once their connection is usable, e.g. the info subscription is acknowledged
+        self._ready.wait(CONNECT_TIMEOUT)
         if not self.is_connected():
-            raise Exception("Unable to connect to the exchange")
+            raise Exception(f"Unable to connect to the exchange: {self._connect_error}")
 
     def disconnect(self) -> None:
         if self._loop.is_running():
@@ -52,12 +100,8 @@ class SynchronousWrapper:
             for fut in futures:
                 fut.result()
 
-            # allow some time for the loop to complete
-            slept_for = 0
-            sleep_duration = 0.1
-            while self._loop.is_running() and slept_for < 5:
-                time.sleep(sleep_duration)
-                slept_for += sleep_duration
+            # The loop stops as soon as every client has closed
+            self._thread.join(CONNECT_TIMEOUT)
         assert (not self._loop.is_running())
 
     def run_on_loop(self, awaitable):
@@ -81,21 +125,28 @@ class SynchronousWrapper:
 
     def _thread_entry_point(self):
         logger.debug("background thread started")
+        if self._runtime is not None:
+            self._runtime.on_io_thread_start(self._loop)
         try:
             self._loop.run_until_complete(self._run())
         finally:
-            cs = [cl.disconnect() for cl in self._clients]
-            self._loop.run_until_complete(asyncio.gather(*cs, *asyncio.Task.all_tasks(self._loop), loop=self._loop, return_exceptions=True))
+            try:
+                cs = [cl.disconnect() for cl in self._clients]
+                self._loop.run_until_complete(asyncio.gather(*cs, *asyncio.Task.all_tasks(self._loop), loop=self._loop, return_exceptions=True))
+            finally:
+                self._set_state(STATE_CLOSED)
 
     async def _run(self):
         try:
-            await asyncio.gather(*[cl.connect() for cl in self._clients], loop=self._loop)
-
-            async def wait_connected(cl):
-                while cl.is_connected():
-                    await asyncio.sleep(0.1)
-
-            await asyncio.gather(*[wait_connected(cl) for cl in self._clients], loop=self._loop)
+            try:
+                await asyncio.gather(*[cl.connect() for cl in self._clients], loop=self._loop)
+            except Exception as exc:
+                self._connect_error = exc
+                raise
+            finally:
+                self._ready.set()
+
+            await asyncio.gather(*[cl.wait_closed() for cl in self._clients], loop=self._loop)
         except Exception as exc:
             logger.warning(exc)
 
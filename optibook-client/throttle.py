@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('client')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        assert rate > 0, "rate must be positive"
+        self._rate = float(rate)
+        self._capacity = float(burst if burst is not None else max(1, rate))
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        if now > self._last:
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+
+    def wait_time(self, now):
+        """
+        Returns the number of seconds until a token is available, 0 if one is available now.
+        """
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def consume(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+
+class _QueuedOrder:
+    __slots__ = ['instrument_id', 'side', 'order_type', 'send', 'future', 'queued_at']
+
+    def __init__(self, instrument_id, side, order_type, send, future, queued_at):
+        self.instrument_id = instrument_id
+        self.side = side
+        self.order_type = order_type
+        self.send = send
+        self.future = future
+        self.queued_at = queued_at
+
+
+class OrderThrottle:
+    """
+    Rate limits order requests with a global token bucket and one token bucket per instrument. Inserts, amends and
+    deletes all take a token, amends and deletes are submitted without side and order type.
+
+    Requests that fit within the limits are sent straight away. Others are queued and sent as soon as tokens
+    are available. A queued IOC is superseded by a newer IOC on the same instrument and side: the newer order
+    takes its place in the queue and the older request completes with None without ever being sent.
+    """
+    def __init__(self, max_orders_per_second=None, max_orders_per_second_per_instrument=None, burst=None, instrument_burst=None):
+        self._global_bucket = TokenBucket(max_orders_per_second, burst) if max_orders_per_second else None
+        self._instrument_rate = max_orders_per_second_per_instrument
+        self._instrument_burst = instrument_burst
+        self._instrument_buckets = {}
+        self._queue = []
+        self._drain_task = None
+
+        self._nr_sent = 0
+        self._nr_throttled = 0
+        self._nr_superseded = 0
+        self._max_queue_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _instrument_bucket(self, instrument_id):
+        if not self._instrument_rate:
+            return None
+        bucket = self._instrument_buckets.get(instrument_id)
+        if bucket is None:
+            bucket = TokenBucket(self._instrument_rate, self._instrument_burst)
+            self._instrument_buckets[instrument_id] = bucket
+        return bucket
+
+    def _wait_time(self, instrument_id, now):
+        wait = 0.0
+        if self._global_bucket is not None:
+            wait = self._global_bucket.wait_time(now)
+        bucket = self._instrument_bucket(instrument_id)
+        if bucket is not None:
+            wait = max(wait, bucket.wait_time(now))
+        return wait
+
+    def _consume(self, instrument_id, now):
+        if self._global_bucket is not None:
+            self._global_bucket.consume(now)
+        bucket = self._instrument_bucket(instrument_id)
+        if bucket is not None:
+            bucket.consume(now)
+        self._nr_sent += 1
+
+    async def submit(self, instrument_id, side, order_type, send):
+        """
+        Sends the request created by calling send() once the rate limits allow it and returns its result, or None
+        if the request was superseded while queued. Only IOC inserts are ever superseded.
+        """
+        now = time.monotonic()
+        if not self._queue and self._wait_time(instrument_id, now) == 0:
+            self._consume(instrument_id, now)
+            return await send()
+
+        self._nr_throttled += 1
+        future = asyncio.get_event_loop().create_future()
+        entry = _QueuedOrder(instrument_id, side, order_type, send, future, now)
+        if not self._supersede(entry):
+            self._queue.append(entry)
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.ensure_future(self._drain())
+        return await future
+
+    def _supersede(self, entry):
+        if entry.order_type != 'ioc':
+            return False
+        for i, queued in enumerate(self._queue):
+            if queued.order_type == 'ioc' and queued.instrument_id == entry.instrument_id and queued.side == entry.side:
+                self._queue[i] = entry
+                self._nr_superseded += 1
+                if not queued.future.done():
+                    queued.future.set_result(None)
+                return True
+        return False
+
+    async def _drain(self):
+        while self._queue:
+            now = time.monotonic()
+            min_wait = None
+            for i, entry in enumerate(self._queue):
+                wait = self._wait_time(entry.instrument_id, now)
+                if wait == 0:
+                    del self._queue[i]
+                    self._consume(entry.instrument_id, now)
+                    waited = now - entry.queued_at
+                    self._total_wait += waited
+                    self._max_wait = max(self._max_wait, waited)
+                    asyncio.ensure_future(self._send(entry))
+                    min_wait = 0
+                    break
+                if min_wait is None or wait < min_wait:
+                    min_wait = wait
+            if min_wait:
+                await asyncio.sleep(min_wait)
+
+    @staticmethod
+    async def _send(entry):
+        try:
+            result = await entry.send()
+        except Exception as e:
+            if not entry.future.done():
+                entry.future.set_exception(e)
+        else:
+            if not entry.future.done():
+                entry.future.set_result(result)
+
+    def get_queue_depth(self):
+        return len(self._queue)
+
+    def get_metrics(self):
+        return {
+            'queue_depth': len(self._queue),
+            'max_queue_depth': self._max_queue_depth,
+            'sent': self._nr_sent,
+            'throttled': self._nr_throttled,
+            'superseded': self._nr_superseded,
+            'total_wait': self._total_wait,
+            'max_wait': self._max_wait,
+        }
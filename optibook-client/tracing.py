@@ -0,0 +1,179 @@
+"""
+Tick-to-trade tracing.
+
+Every inbound message is stamped with a monotonic receive time in ns, which ends up in PriceBook.received_ns. A
+strategy opens a trace when it acts on a book with begin(), which sets the trace as the current context. Orders
+inserted from that context, their replies and the resulting fills are then recorded against the trace.
+
+Events go into a preallocated ring buffer, so recording allocates nothing. Decisions are recorded from the strategy
+thread and orders and fills from the event loop thread, a lock hands out the slots so no event overwrites another.
+Tracing is off until enable() is called and costs a single attribute check per stage while off.
+
+To report on a dumped trace file:
+
+    python -m optibook.tracing trace.json
+"""
+import contextvars
+import json
+import sys
+import threading
+import time
+from array import array
+
+STAGE_RECEIVE = 0
+STAGE_DECISION = 1
+STAGE_ORDER_SENT = 2
+STAGE_ORDER_REPLY = 3
+STAGE_FILL = 4
+STAGE_NAMES = ['receive', 'decision', 'order_sent', 'order_reply', 'fill']
+
+NO_TRACE = -1
+DEFAULT_CAPACITY = 1 << 16
+
+current_trace = contextvars.ContextVar('current_trace', default=NO_TRACE)
+
+
+class Tracer:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.enabled = False
+        self._capacity = 0
+        self._labels = []
+        self._label_index = {}
+        self._next_trace_id = 0
+        self._lock = threading.Lock()
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self._capacity = capacity
+        self._trace_id = array('q', [NO_TRACE]) * capacity
+        self._stage = array('b', [0]) * capacity
+        self._t_ns = array('q', [0]) * capacity
+        self._order_id = array('q', [0]) * capacity
+        self._label = array('i', [0]) * capacity
+        self._count = 0
+
+    def enable(self, capacity=DEFAULT_CAPACITY):
+        if capacity != self._capacity:
+            self._allocate(capacity)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def _label_id(self, label):
+        label_id = self._label_index.get(label)
+        if label_id is None:
+            label_id = len(self._labels)
+            self._labels.append(label)
+            self._label_index[label] = label_id
+        return label_id
+
+    def record(self, stage, trace_id=NO_TRACE, order_id=0, t_ns=None, label_id=0):
+        with self._lock:
+            i = self._count % self._capacity
+            self._count += 1
+        self._trace_id[i] = trace_id
+        self._stage[i] = stage
+        self._t_ns[i] = time.monotonic_ns() if t_ns is None else t_ns
+        self._order_id[i] = order_id
+        self._label[i] = label_id
+
+    def begin(self, label, received_ns):
+        """
+        Opens a trace for a decision taken on data received at received_ns and makes it the current trace.
+        Returns the token to pass to end().
+        """
+        trace_id = self._next_trace_id
+        self._next_trace_id += 1
+        label_id = self._label_id(label)
+        self.record(STAGE_RECEIVE, trace_id, t_ns=received_ns, label_id=label_id)
+        self.record(STAGE_DECISION, trace_id, label_id=label_id)
+        return current_trace.set(trace_id)
+
+    def end(self, token):
+        current_trace.reset(token)
+
+    def events(self):
+        """
+        Returns the recorded events, oldest first, as (trace_id, stage, t_ns, order_id, label) tuples.
+        """
+        n = min(self._count, self._capacity)
+        start = self._count - n
+        result = []
+        for k in range(start, self._count):
+            i = k % self._capacity
+            result.append((self._trace_id[i], self._stage[i], self._t_ns[i], self._order_id[i], self._labels[self._label[i]] if self._labels else ''))
+        return result
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump([list(e) for e in self.events()], f)
+
+    def report(self):
+        return report(self.events())
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def report(events):
+    """
+    Computes p50/p99 latencies in microseconds per label from recorded events:
+    tick_to_order from receiving the data to sending the first order of a trace, order_to_fill from sending an order
+    to its first fill.
+    """
+    first_receive = {}
+    label_of = {}
+    first_sent = {}
+    sent_of_order = {}
+    sent_by_trace = {}
+    fill_of_order = {}
+
+    for trace_id, stage, t_ns, order_id, label in events:
+        if stage == STAGE_RECEIVE:
+            first_receive[trace_id] = t_ns
+            label_of[trace_id] = label
+        elif stage == STAGE_ORDER_SENT:
+            first_sent.setdefault(trace_id, t_ns)
+            sent_by_trace.setdefault(trace_id, []).append(t_ns)
+        elif stage == STAGE_ORDER_REPLY:
+            # Orders are sent and answered in order per trace, match the reply to the oldest unmatched send
+            sends = sent_by_trace.get(trace_id)
+            if sends:
+                sent_of_order[order_id] = (trace_id, sends.pop(0))
+        elif stage == STAGE_FILL:
+            fill_of_order.setdefault(order_id, t_ns)
+
+    tick_to_order = {}
+    for trace_id, t_sent in first_sent.items():
+        if trace_id in first_receive and first_receive[trace_id] > 0:
+            tick_to_order.setdefault(label_of[trace_id], []).append((t_sent - first_receive[trace_id]) / 1000)
+
+    order_to_fill = {}
+    for order_id, (trace_id, t_sent) in sent_of_order.items():
+        if order_id in fill_of_order and trace_id in label_of:
+            order_to_fill.setdefault(label_of[trace_id], []).append((fill_of_order[order_id] - t_sent) / 1000)
+
+    result = {}
+    for name, by_label in [('tick_to_order', tick_to_order), ('order_to_fill', order_to_fill)]:
+        for label, values in by_label.items():
+            values.sort()
+            result.setdefault(label, {})[name] = {'count': len(values), 'p50': _percentile(values, 0.5), 'p99': _percentile(values, 0.99)}
+    return result
+
+
+# Process wide tracer, the buffer is only allocated once tracing is enabled
+tracer = Tracer(capacity=0)
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as f:
+        events = [tuple(e) for e in json.load(f)]
+    for label, stats in sorted(report(events).items()):
+        for name, s in stats.items():
+            print(f"{label:30} {name:15} n={s['count']:6}  p50={s['p50']:10.1f}us  p99={s['p99']:10.1f}us")